@@ -11,7 +11,7 @@ from basics.abstract_algorithms import OffPolicyRLAlgorithm
 from basics.actors_and_critics import MLPGaussianActor, MLPCritic
 from basics.convnet import ConvNet
 from basics.replay_buffer import Batch
-from basics.utils import get_device, create_target, polyak_update, save_net, load_net
+from basics.utils import get_device, create_target, TargetNetworks, save_net, load_net, mean_of_weighted_elements
 from basics.lr_scheduler import LRScheduler
 
 
@@ -78,6 +78,14 @@ class ConvolutionalSAC(OffPolicyRLAlgorithm):
         self.Q2 = MLPCritic(input_dim=embedding_dim, action_dim=action_dim).to(get_device())
         self.Q2_targ = create_target(self.Q2)
 
+        # all target networks are Polyak-averaged at once (see TargetNetworks)
+
+        self.target_networks = TargetNetworks([
+            (self.cnn_targ, self.cnn),
+            (self.Q1_targ, self.Q1),
+            (self.Q2_targ, self.Q2),
+        ])
+
         # optimizers
 
         self.cnn_optimizer = optim.Adam(self.cnn.parameters(), lr=lr)
@@ -138,11 +146,11 @@ class ConvolutionalSAC(OffPolicyRLAlgorithm):
 
     def get_current_alpha(self):
         if self.autotune_alpha:
-            return np.exp(float(self.log_alpha))
+            return self.log_alpha.detach().exp()
         else:
             return self.alpha
 
-    def update_networks(self, b: Batch) -> dict:
+    def update_networks(self, b: Batch, return_td_errors: bool = False):
 
         # update learning rate
 
@@ -184,8 +192,8 @@ class ConvolutionalSAC(OffPolicyRLAlgorithm):
 
         # compute td error
 
-        Q1_loss = torch.mean((Q1_predictions - targets) ** 2)
-        Q2_loss = torch.mean((Q2_predictions - targets) ** 2)
+        Q1_loss = mean_of_weighted_elements((Q1_predictions - targets) ** 2, b.w)
+        Q2_loss = mean_of_weighted_elements((Q2_predictions - targets) ** 2, b.w)
 
         assert Q1_loss.shape == ()
         assert Q2_loss.shape == ()
@@ -263,28 +271,36 @@ class ConvolutionalSAC(OffPolicyRLAlgorithm):
 
         else:
 
-            log_alpha_loss = 0  # needed only for logging purposes
+            log_alpha_loss = torch.zeros(1, device=get_device())  # needed only for logging purposes
 
         # update target networks
 
-        polyak_update(targ_net=self.cnn_targ, pred_net=self.cnn, polyak=self.polyak)
-        polyak_update(targ_net=self.Q1_targ, pred_net=self.Q1, polyak=self.polyak)
-        polyak_update(targ_net=self.Q2_targ, pred_net=self.Q2, polyak=self.polyak)
+        self.target_networks.update(self.polyak)
 
-        return {
+        stats = {
             # for learning the q functions
-            '(qfunc) Q1 pred': float(Q1_predictions.mean()),
-            '(qfunc) Q2 pred': float(Q2_predictions.mean()),
-            '(qfunc) Q1 loss': float(Q1_loss),
-            '(qfunc) Q2 loss': float(Q2_loss),
+            '(qfunc) Q1 pred': Q1_predictions.mean().detach(),
+            '(qfunc) Q2 pred': Q2_predictions.mean().detach(),
+            '(qfunc) Q1 loss': Q1_loss.detach(),
+            '(qfunc) Q2 loss': Q2_loss.detach(),
             # for learning the actor
-            '(actor) min Q value': float(min_Q.mean()),
-            '(actor) entropy (sample)': float(sample_entropy.mean()),
+            '(actor) min Q value': min_Q.mean().detach(),
+            '(actor) entropy (sample)': sample_entropy.mean().detach(),
             # for learning the entropy coefficient (alpha)
             '(alpha) alpha': self.get_current_alpha(),
-            '(alpha) log alpha loss': float(log_alpha_loss.mean())
+            '(alpha) log alpha loss': log_alpha_loss.detach()
         }
 
+        if return_td_errors:  # for refreshing priorities in prioritized replay without an extra forward pass
+            td_errors = ((Q1_predictions - targets).abs() + (Q2_predictions - targets).abs()) / 2
+            return stats, td_errors.detach().view(-1)
+
+        return stats
+
+    @property
+    def actor_networks(self) -> list:
+        return [self.cnn, self.actor]
+
     def save_actor(self, save_dir: str) -> None:
         save_net(net=self.cnn, save_dir=save_dir, save_name="cnn.pth")
         save_net(net=self.actor, save_dir=save_dir, save_name="actor.pth")
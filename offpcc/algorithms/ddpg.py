@@ -7,7 +7,8 @@ import torch.optim as optim
 from basics.abstract_algorithms import OffPolicyRLAlgorithm
 from basics.actors_and_critics import MLPTanhActor, MLPCritic
 from basics.replay_buffer import Batch
-from basics.utils import get_device, create_target, polyak_update, save_net, load_net
+from basics.utils import get_device, create_target, TargetNetworks, save_net, load_net, mean_of_weighted_elements
+from basics.utils import compilable_update
 from basics.lr_scheduler import LRScheduler
 
 
@@ -23,6 +24,8 @@ class DDPG(OffPolicyRLAlgorithm):
         lr_schedule=None,
         polyak=0.995,
         action_noise=0.1,
+        compile_update=False,  # if True, update_networks is compiled with torch.compile (see compilable_update)
+        numpy_act=False,  # if True, act runs the actor in numpy on cpu (see NumpyMLP), faster at batch size 1
     ):
 
         # hyper-parameters
@@ -33,6 +36,11 @@ class DDPG(OffPolicyRLAlgorithm):
         self.lr = lr
         self.lr_schedule = lr_schedule
         self.polyak = polyak
+        self.compile_update = compile_update
+        self.numpy_act = numpy_act and get_device() == 'cpu'
+
+        assert not (compile_update and lr_schedule is not None), \
+            "compile_update does not support lr_schedule (every new lr would trigger a recompilation)"
 
         self.action_noise = action_noise
 
@@ -44,6 +52,13 @@ class DDPG(OffPolicyRLAlgorithm):
         self.Q = MLPCritic(input_dim, action_dim).to(get_device())
         self.Q_targ = create_target(self.Q)
 
+        # all target networks are Polyak-averaged at once (see TargetNetworks)
+
+        self.target_networks = TargetNetworks([
+            (self.actor_targ, self.actor),
+            (self.Q_targ, self.Q),
+        ])
+
         # optimizers
 
         self.actor_optimizer = optim.Adam(self.actor.parameters(), lr=lr)
@@ -59,15 +74,21 @@ class DDPG(OffPolicyRLAlgorithm):
             )
 
     def act(self, state: np.array, deterministic: bool) -> np.array:
-        with torch.no_grad():
-            state = torch.tensor(state).unsqueeze(0).float().to(get_device())
-            greedy_action = self.actor(state).view(-1).cpu().numpy()  # view as 1d -> to cpu -> to numpy
-            if deterministic:
-                return greedy_action
-            else:
-                return np.clip(greedy_action + self.action_noise * np.random.randn(self.action_dim), -1.0, 1.0)
-
-    def update_networks(self, b: Batch):
+        return self.act_batch(np.asarray(state)[np.newaxis], deterministic)[0]
+
+    def act_batch(self, states: np.array, deterministic: bool) -> np.array:
+        if self.numpy_act:
+            greedy_actions = self.actor.forward_numpy(np.asarray(states, dtype=np.float32))
+        else:
+            with torch.inference_mode():
+                greedy_actions = self.actor(self.as_act_input(states, batched=True)).cpu().numpy()
+        if deterministic:
+            return greedy_actions
+        else:
+            return np.clip(greedy_actions + self.action_noise * np.random.randn(*greedy_actions.shape), -1.0, 1.0)
+
+    @compilable_update
+    def update_networks(self, b: Batch, return_td_errors: bool = False):
 
         # update learning rate
 
@@ -94,7 +115,7 @@ class DDPG(OffPolicyRLAlgorithm):
 
         # compute td error
 
-        Q_loss = torch.mean((predictions - targets) ** 2)
+        Q_loss = mean_of_weighted_elements((predictions - targets) ** 2, b.w)
 
         assert Q_loss.shape == ()
 
@@ -121,17 +142,25 @@ class DDPG(OffPolicyRLAlgorithm):
 
         # update target networks
 
-        polyak_update(targ_net=self.actor_targ, pred_net=self.actor, polyak=self.polyak)
-        polyak_update(targ_net=self.Q_targ, pred_net=self.Q, polyak=self.polyak)
+        self.target_networks.update(self.polyak)
 
-        return {
+        stats = {
             # for learning the q functions
-            '(qfunc) Q pred': float(predictions.mean()),
-            '(qfunc) Q loss': float(Q_loss),
+            '(qfunc) Q pred': predictions.mean().detach(),
+            '(qfunc) Q loss': Q_loss.detach(),
             # for learning the actor
-            '(actor) Q value': float(Q_values.mean()),
+            '(actor) Q value': Q_values.mean().detach(),
         }
 
+        if return_td_errors:  # for refreshing priorities in prioritized replay without an extra forward pass
+            return stats, (predictions - targets).abs().detach().view(-1)
+
+        return stats
+
+    @property
+    def actor_networks(self) -> list:
+        return [self.actor]
+
     def save_actor(self, save_dir: str) -> None:
         save_net(net=self.actor, save_dir=save_dir, save_name="actor.pth")
 
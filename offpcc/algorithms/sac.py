@@ -8,9 +8,10 @@ import torch.optim as optim
 from torch.distributions import Normal, Independent
 
 from basics.abstract_algorithms import OffPolicyRLAlgorithm
-from basics.actors_and_critics import MLPGaussianActor, MLPCritic
+from basics.actors_and_critics import MLPGaussianActor, MLPCritic, MLPCriticEnsemble
 from basics.replay_buffer import Batch
-from basics.utils import get_device, create_target, polyak_update, save_net, load_net
+from basics.utils import get_device, create_target, TargetNetworks, save_net, load_net, mean_of_weighted_elements
+from basics.utils import compilable_update
 from basics.lr_scheduler import LRScheduler
 
 
@@ -36,6 +37,10 @@ class SAC(OffPolicyRLAlgorithm):
         polyak=0.995,
         alpha=1.0,  # if autotune_alpha, this becomes the initial alpha value
         autotune_alpha: bool = True,
+        critic_ensemble=False,  # if True, Q1 and Q2 are a single MLPCriticEnsemble (Q), with a single optimizer
+        num_critics=2,  # > 2 needs critic_ensemble; targets and the policy loss use the min over all critics
+        compile_update=False,  # if True, update_networks is compiled with torch.compile (see compilable_update)
+        numpy_act=False,  # if True, act runs the actor in numpy on cpu (see NumpyMLP), faster at batch size 1
     ):
 
         # hyperparameters
@@ -46,6 +51,14 @@ class SAC(OffPolicyRLAlgorithm):
         self.lr = lr
         self.lr_schedule = lr_schedule
         self.polyak = polyak
+        self.compile_update = compile_update
+        self.numpy_act = numpy_act and get_device() == 'cpu'
+
+        assert not (compile_update and lr_schedule is not None), \
+            "compile_update does not support lr_schedule (every new lr would trigger a recompilation)"
+        assert critic_ensemble or num_critics == 2, "separate critics are Q1 and Q2; use critic_ensemble for more"
+        self.critic_ensemble = critic_ensemble
+        self.num_critics = num_critics
 
         self.autotune_alpha = autotune_alpha
 
@@ -67,23 +80,42 @@ class SAC(OffPolicyRLAlgorithm):
 
         self.actor = MLPGaussianActor(input_dim=input_dim, action_dim=action_dim).to(get_device())
 
-        self.Q1 = MLPCritic(input_dim=input_dim, action_dim=action_dim).to(get_device())
-        self.Q1_targ = create_target(self.Q1)
+        if critic_ensemble:
+
+            self.Q = MLPCriticEnsemble(input_dim, action_dim, num_critics=num_critics).to(get_device())
+            self.Q_targ = create_target(self.Q)
+
+        else:
+
+            self.Q1 = MLPCritic(input_dim=input_dim, action_dim=action_dim).to(get_device())
+            self.Q1_targ = create_target(self.Q1)
 
-        self.Q2 = MLPCritic(input_dim=input_dim, action_dim=action_dim).to(get_device())
-        self.Q2_targ = create_target(self.Q2)
+            self.Q2 = MLPCritic(input_dim=input_dim, action_dim=action_dim).to(get_device())
+            self.Q2_targ = create_target(self.Q2)
+
+        # all target networks are Polyak-averaged at once (see TargetNetworks)
+
+        self.target_networks = TargetNetworks([
+            *([(self.Q_targ, self.Q)] if critic_ensemble else [(self.Q1_targ, self.Q1), (self.Q2_targ, self.Q2)]),
+        ])
 
         # optimizers
 
         self.actor_optimizer = optim.Adam(self.actor.parameters(), lr=lr)
-        self.Q1_optimizer = optim.Adam(self.Q1.parameters(), lr=lr)
-        self.Q2_optimizer = optim.Adam(self.Q2.parameters(), lr=lr)
+
+        if critic_ensemble:
+            self.Q_optimizer = optim.Adam(self.Q.parameters(), lr=lr)
+            self.Q_optimizers = [self.Q_optimizer]
+        else:
+            self.Q1_optimizer = optim.Adam(self.Q1.parameters(), lr=lr)
+            self.Q2_optimizer = optim.Adam(self.Q2.parameters(), lr=lr)
+            self.Q_optimizers = [self.Q1_optimizer, self.Q2_optimizer]
 
         # lr scheduler
 
         if lr_schedule is not None:
             self.lr_scheduler = LRScheduler(
-                optimizers=[self.actor_optimizer, self.Q1_optimizer, self.Q2_optimizer],
+                optimizers=[self.actor_optimizer, *self.Q_optimizers],
                 init_lr=lr,
                 schedule=lr_schedule
             )
@@ -110,9 +142,11 @@ class SAC(OffPolicyRLAlgorithm):
 
         if deterministic:
             u = means
-        else:
+        elif return_log_prob:
             mu_given_s = Independent(Normal(loc=means, scale=stds), reinterpreted_batch_ndims=1)
             u = mu_given_s.rsample()
+        else:
+            u = means + stds * torch.randn_like(means)  # as rsample, without the overhead of a distribution object
 
         a = torch.tanh(u).view(-1, self.action_dim)  # shape checking
 
@@ -123,18 +157,33 @@ class SAC(OffPolicyRLAlgorithm):
             return a
 
     def act(self, state: np.array, deterministic: bool) -> np.array:
-        with torch.no_grad():
-            state = torch.tensor(state).unsqueeze(0).float().to(get_device())
-            action = self.sample_action_from_distribution(state, deterministic=deterministic, return_log_prob=False)
-            return action.view(-1).cpu().numpy()  # view as 1d -> to cpu -> to numpy
+        return self.act_batch(np.asarray(state)[np.newaxis], deterministic)[0]
+
+    def act_batch(self, states: np.array, deterministic: bool) -> np.array:
+        if self.numpy_act:  # same as sample_action_from_distribution, in numpy (noise from numpy's RNG, not torch's)
+            means, stds = self.actor.forward_numpy(np.asarray(states, dtype=np.float32))
+            return np.tanh(means if deterministic else means + stds * np.random.randn(*means.shape))
+        with torch.inference_mode():
+            states = self.as_act_input(states, batched=True)
+            actions = self.sample_action_from_distribution(states, deterministic=deterministic, return_log_prob=False)
+            return actions.cpu().numpy()
 
     def get_current_alpha(self):
         if self.autotune_alpha:
-            return np.exp(float(self.log_alpha))
+            return self.log_alpha.detach().exp()  # stays on device; float() would block on the host
         else:
             return self.alpha
 
-    def update_networks(self, b: Batch) -> dict:
+    def compute_Q_values(self, states: torch.tensor, actions: torch.tensor, target: bool = False) -> torch.tensor:
+        """Values of all critics, stacked into shape (num_critics, bs, 1), from the target networks if target."""
+        if self.critic_ensemble:
+            return (self.Q_targ if target else self.Q)(states, actions)
+        elif target:
+            return torch.stack([self.Q1_targ(states, actions), self.Q2_targ(states, actions)])
+        return torch.stack([self.Q1(states, actions), self.Q2(states, actions)])
+
+    @compilable_update
+    def update_networks(self, b: Batch, return_td_errors: bool = False):
 
         # update learning rate
 
@@ -145,11 +194,9 @@ class SAC(OffPolicyRLAlgorithm):
 
         # compute predictions
 
-        Q1_predictions = self.Q1(b.s, b.a)
-        Q2_predictions = self.Q2(b.s, b.a)
+        Q_predictions = self.compute_Q_values(b.s, b.a)
 
-        assert Q1_predictions.shape == (bs, 1)
-        assert Q2_predictions.shape == (bs, 1)
+        assert Q_predictions.shape == (self.num_critics, bs, 1)
 
         # compute targets
 
@@ -158,7 +205,7 @@ class SAC(OffPolicyRLAlgorithm):
             na, log_pi_na_given_ns = self.sample_action_from_distribution(b.ns, deterministic=False,
                                                                           return_log_prob=True)
 
-            n_min_Q_targ = torch.min(self.Q1_targ(b.ns, na), self.Q2_targ(b.ns, na))
+            n_min_Q_targ = self.compute_Q_values(b.ns, na, target=True).min(dim=0).values
             n_sample_entropy = - log_pi_na_given_ns
 
             targets = b.r + self.gamma * (1 - b.d) * (n_min_Q_targ + self.get_current_alpha() * n_sample_entropy)
@@ -170,27 +217,23 @@ class SAC(OffPolicyRLAlgorithm):
 
         # compute td error
 
-        Q1_loss = torch.mean((Q1_predictions - targets) ** 2)
-        Q2_loss = torch.mean((Q2_predictions - targets) ** 2)
+        Q_losses = [mean_of_weighted_elements((predictions - targets) ** 2, b.w) for predictions in Q_predictions]
 
-        assert Q1_loss.shape == ()
-        assert Q2_loss.shape == ()
+        assert all(Q_loss.shape == () for Q_loss in Q_losses)
 
-        # reduce td error
+        # reduce td error (critics share no parameters, so one backward of the sum gives each critic its gradients)
 
-        self.Q1_optimizer.zero_grad()
-        Q1_loss.backward()
-        self.Q1_optimizer.step()
-
-        self.Q2_optimizer.zero_grad()
-        Q2_loss.backward()
-        self.Q2_optimizer.step()
+        for optimizer in self.Q_optimizers:
+            optimizer.zero_grad()
+        sum(Q_losses).backward()
+        for optimizer in self.Q_optimizers:
+            optimizer.step()
 
         # compute policy loss
 
         a, log_pi_a_given_s = self.sample_action_from_distribution(b.s, deterministic=False, return_log_prob=True)
 
-        min_Q = torch.min(self.Q1(b.s, a), self.Q2(b.s, a))
+        min_Q = self.compute_Q_values(b.s, a).min(dim=0).values
         sample_entropy = - log_pi_a_given_s
 
         policy_loss = - torch.mean(min_Q + self.get_current_alpha() * sample_entropy)
@@ -244,27 +287,34 @@ class SAC(OffPolicyRLAlgorithm):
 
         else:
 
-            log_alpha_loss = 0  # needed only for logging purposes
+            log_alpha_loss = torch.zeros(1, device=get_device())  # needed only for logging purposes
 
         # update target networks
 
-        polyak_update(targ_net=self.Q1_targ, pred_net=self.Q1, polyak=self.polyak)
-        polyak_update(targ_net=self.Q2_targ, pred_net=self.Q2, polyak=self.polyak)
+        self.target_networks.update(self.polyak)
 
-        return {
+        stats = {
             # for learning the q functions
-            '(qfunc) Q1 pred': float(Q1_predictions.mean()),
-            '(qfunc) Q2 pred': float(Q2_predictions.mean()),
-            '(qfunc) Q1 loss': float(Q1_loss),
-            '(qfunc) Q2 loss': float(Q2_loss),
+            **{f'(qfunc) Q{i + 1} pred': predictions.mean().detach() for i, predictions in enumerate(Q_predictions)},
+            **{f'(qfunc) Q{i + 1} loss': Q_loss.detach() for i, Q_loss in enumerate(Q_losses)},
             # for learning the actor
-            '(actor) min Q value': float(min_Q.mean()),
-            '(actor) entropy (sample)': float(sample_entropy.mean()),
+            '(actor) min Q value': min_Q.mean().detach(),
+            '(actor) entropy (sample)': sample_entropy.mean().detach(),
             # for learning the entropy coefficient (alpha)
             '(alpha) alpha': self.get_current_alpha(),
-            '(alpha) log alpha loss': float(log_alpha_loss.mean())
+            '(alpha) log alpha loss': log_alpha_loss.detach()
         }
 
+        if return_td_errors:  # for refreshing priorities in prioritized replay without an extra forward pass
+            td_errors = (Q_predictions - targets).abs().mean(dim=0)
+            return stats, td_errors.detach().view(-1)
+
+        return stats
+
+    @property
+    def actor_networks(self) -> list:
+        return [self.actor]
+
     def save_actor(self, save_dir: str) -> None:
         save_net(net=self.actor, save_dir=save_dir, save_name="actor.pth")
 
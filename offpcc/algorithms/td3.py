@@ -5,9 +5,10 @@ import torch
 import torch.optim as optim
 
 from basics.abstract_algorithms import OffPolicyRLAlgorithm
-from basics.actors_and_critics import MLPTanhActor, MLPCritic
+from basics.actors_and_critics import MLPTanhActor, MLPCritic, MLPCriticEnsemble
 from basics.replay_buffer import Batch
-from basics.utils import get_device, create_target, polyak_update, save_net, load_net
+from basics.utils import get_device, create_target, TargetNetworks, save_net, load_net, mean_of_weighted_elements
+from basics.utils import compilable_update
 from basics.lr_scheduler import LRScheduler
 
 
@@ -25,7 +26,11 @@ class TD3(OffPolicyRLAlgorithm):
         action_noise=0.1,  # standard deviation of action noise
         target_noise=0.2,  # standard deviation of target smoothing noise
         noise_clip=0.5,  # max abs value of target smoothing noise
-        policy_delay=2
+        policy_delay=2,
+        critic_ensemble=False,  # if True, Q1 and Q2 are a single MLPCriticEnsemble (Q), with a single optimizer
+        num_critics=2,  # > 2 needs critic_ensemble; targets use the min over all critics, the policy loss Q1 only
+        compile_update=False,  # if True, update_networks is compiled with torch.compile (see compilable_update)
+        numpy_act=False,  # if True, act runs the actor in numpy on cpu (see NumpyMLP), faster at batch size 1
     ):
 
         # hyper-parameters
@@ -36,6 +41,11 @@ class TD3(OffPolicyRLAlgorithm):
         self.lr = lr
         self.lr_schedule = lr_schedule
         self.polyak = polyak
+        self.compile_update = compile_update
+        self.numpy_act = numpy_act and get_device() == 'cpu'
+
+        assert not (compile_update and lr_schedule is not None), \
+            "compile_update does not support lr_schedule (every new lr would trigger a recompilation)"
 
         self.action_noise = action_noise
         self.target_noise = target_noise
@@ -43,6 +53,10 @@ class TD3(OffPolicyRLAlgorithm):
 
         self.policy_delay = policy_delay
 
+        assert critic_ensemble or num_critics == 2, "separate critics are Q1 and Q2; use critic_ensemble for more"
+        self.critic_ensemble = critic_ensemble
+        self.num_critics = num_critics
+
         # trackers
 
         self.num_Q_updates = 0  # for delaying updates
@@ -54,35 +68,69 @@ class TD3(OffPolicyRLAlgorithm):
         self.actor = MLPTanhActor(input_dim, action_dim).to(get_device())
         self.actor_targ = create_target(self.actor)
 
-        self.Q1 = MLPCritic(input_dim, action_dim).to(get_device())
-        self.Q1_targ = create_target(self.Q1)
+        if critic_ensemble:
+
+            self.Q = MLPCriticEnsemble(input_dim, action_dim, num_critics=num_critics).to(get_device())
+            self.Q_targ = create_target(self.Q)
+
+        else:
 
-        self.Q2 = MLPCritic(input_dim, action_dim).to(get_device())
-        self.Q2_targ = create_target(self.Q2)
+            self.Q1 = MLPCritic(input_dim, action_dim).to(get_device())
+            self.Q1_targ = create_target(self.Q1)
+
+            self.Q2 = MLPCritic(input_dim, action_dim).to(get_device())
+            self.Q2_targ = create_target(self.Q2)
+
+        # all target networks are Polyak-averaged at once (see TargetNetworks)
+
+        self.target_networks = TargetNetworks([
+            (self.actor_targ, self.actor),
+            *([(self.Q_targ, self.Q)] if critic_ensemble else [(self.Q1_targ, self.Q1), (self.Q2_targ, self.Q2)]),
+        ])
 
         # optimizers
 
         self.actor_optimizer = optim.Adam(self.actor.parameters(), lr=lr)
-        self.Q1_optimizer = optim.Adam(self.Q1.parameters(), lr=lr)
-        self.Q2_optimizer = optim.Adam(self.Q2.parameters(), lr=lr)
+
+        if critic_ensemble:
+            self.Q_optimizer = optim.Adam(self.Q.parameters(), lr=lr)
+            self.Q_optimizers = [self.Q_optimizer]
+        else:
+            self.Q1_optimizer = optim.Adam(self.Q1.parameters(), lr=lr)
+            self.Q2_optimizer = optim.Adam(self.Q2.parameters(), lr=lr)
+            self.Q_optimizers = [self.Q1_optimizer, self.Q2_optimizer]
 
         if lr_schedule is not None:
             self.lr_scheduler = LRScheduler(
-                optimizers=[self.actor_optimizer, self.Q1_optimizer, self.Q2_optimizer],
+                optimizers=[self.actor_optimizer, *self.Q_optimizers],
                 init_lr=lr,
                 schedule=lr_schedule
             )
 
     def act(self, state: np.array, deterministic: bool) -> np.array:
-        with torch.no_grad():
-            state = torch.tensor(state).unsqueeze(0).float().to(get_device())
-            greedy_action = self.actor(state).view(-1).cpu().numpy()  # view as 1d -> to cpu -> to numpy
-            if deterministic:
-                return greedy_action
-            else:
-                return np.clip(greedy_action + self.action_noise * np.random.randn(self.action_dim), -1.0, 1.0)
-
-    def update_networks(self, b: Batch):
+        return self.act_batch(np.asarray(state)[np.newaxis], deterministic)[0]
+
+    def act_batch(self, states: np.array, deterministic: bool) -> np.array:
+        if self.numpy_act:
+            greedy_actions = self.actor.forward_numpy(np.asarray(states, dtype=np.float32))
+        else:
+            with torch.inference_mode():
+                greedy_actions = self.actor(self.as_act_input(states, batched=True)).cpu().numpy()
+        if deterministic:
+            return greedy_actions
+        else:
+            return np.clip(greedy_actions + self.action_noise * np.random.randn(*greedy_actions.shape), -1.0, 1.0)
+
+    def compute_Q_values(self, states: torch.tensor, actions: torch.tensor, target: bool = False) -> torch.tensor:
+        """Values of all critics, stacked into shape (num_critics, bs, 1), from the target networks if target."""
+        if self.critic_ensemble:
+            return (self.Q_targ if target else self.Q)(states, actions)
+        elif target:
+            return torch.stack([self.Q1_targ(states, actions), self.Q2_targ(states, actions)])
+        return torch.stack([self.Q1(states, actions), self.Q2(states, actions)])
+
+    @compilable_update
+    def update_networks(self, b: Batch, return_td_errors: bool = False):
 
         # update learning rate
 
@@ -93,8 +141,9 @@ class TD3(OffPolicyRLAlgorithm):
 
         # compute predictions
 
-        Q1_predictions = self.Q1(b.s, b.a)
-        Q2_predictions = self.Q2(b.s, b.a)
+        Q_predictions = self.compute_Q_values(b.s, b.a)
+
+        assert Q_predictions.shape == (self.num_critics, bs, 1)
 
         # compute targets
 
@@ -106,7 +155,7 @@ class TD3(OffPolicyRLAlgorithm):
             ).to(get_device())
             smoothed_na = torch.clamp(na + noise, -1, 1)
 
-            n_min_Q_targ = torch.min(self.Q1_targ(b.ns, smoothed_na), self.Q2_targ(b.ns, smoothed_na))
+            n_min_Q_targ = self.compute_Q_values(b.ns, smoothed_na, target=True).min(dim=0).values
 
             targets = b.r + self.gamma * (1 - b.d) * n_min_Q_targ
 
@@ -116,21 +165,17 @@ class TD3(OffPolicyRLAlgorithm):
 
         # compute td error
 
-        Q1_loss = torch.mean((Q1_predictions - targets) ** 2)
-        Q2_loss = torch.mean((Q2_predictions - targets) ** 2)
-
-        assert Q1_loss.shape == ()
-        assert Q2_loss.shape == ()
+        Q_losses = [mean_of_weighted_elements((predictions - targets) ** 2, b.w) for predictions in Q_predictions]
 
-        # reduce td error
+        assert all(Q_loss.shape == () for Q_loss in Q_losses)
 
-        self.Q1_optimizer.zero_grad()
-        Q1_loss.backward()
-        self.Q1_optimizer.step()
+        # reduce td error (critics share no parameters, so one backward of the sum gives each critic its gradients)
 
-        self.Q2_optimizer.zero_grad()
-        Q2_loss.backward()
-        self.Q2_optimizer.step()
+        for optimizer in self.Q_optimizers:
+            optimizer.zero_grad()
+        sum(Q_losses).backward()
+        for optimizer in self.Q_optimizers:
+            optimizer.step()
 
         self.num_Q_updates += 1
 
@@ -139,10 +184,10 @@ class TD3(OffPolicyRLAlgorithm):
             # compute policy loss
 
             a = self.actor(b.s)
-            Q1_values = self.Q1(b.s, a)  # val stands for values
+            Q1_values = self.Q(b.s, a, critics=slice(0, 1))[0] if self.critic_ensemble else self.Q1(b.s, a)
             policy_loss = - torch.mean(Q1_values)
 
-            self.mean_Q1_value = float(-policy_loss)
+            self.mean_Q1_value = (-policy_loss).detach()
             assert a.shape == (bs, self.action_dim)
             assert Q1_values.shape == (bs, 1)
             assert policy_loss.shape == ()
@@ -155,20 +200,26 @@ class TD3(OffPolicyRLAlgorithm):
 
             # update target networks
 
-            polyak_update(targ_net=self.actor_targ, pred_net=self.actor, polyak=self.polyak)
-            polyak_update(targ_net=self.Q1_targ, pred_net=self.Q1, polyak=self.polyak)
-            polyak_update(targ_net=self.Q2_targ, pred_net=self.Q2, polyak=self.polyak)
+            self.target_networks.update(self.polyak)
 
-        return {
+        stats = {
             # for learning the q functions
-            '(qfunc) Q1 pred': float(Q1_predictions.mean()),
-            '(qfunc) Q2 pred': float(Q2_predictions.mean()),
-            '(qfunc) Q1 loss': float(Q1_loss),
-            '(qfunc) Q2 loss': float(Q2_loss),
+            **{f'(qfunc) Q{i + 1} pred': predictions.mean().detach() for i, predictions in enumerate(Q_predictions)},
+            **{f'(qfunc) Q{i + 1} loss': Q_loss.detach() for i, Q_loss in enumerate(Q_losses)},
             # for learning the actor
             '(actor) Q1 value': self.mean_Q1_value
         }
 
+        if return_td_errors:  # for refreshing priorities in prioritized replay without an extra forward pass
+            td_errors = (Q_predictions - targets).abs().mean(dim=0)
+            return stats, td_errors.detach().view(-1)
+
+        return stats
+
+    @property
+    def actor_networks(self) -> list:
+        return [self.actor]
+
     def save_actor(self, save_dir: str) -> None:
         save_net(net=self.actor, save_dir=save_dir, save_name="actor.pth")
 
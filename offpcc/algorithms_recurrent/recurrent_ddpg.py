@@ -9,7 +9,9 @@ from basics.abstract_algorithms import RecurrentOffPolicyRLAlgorithm
 from basics.summarizer import Summarizer
 from basics.actors_and_critics import MLPTanhActor, MLPCritic
 from basics.replay_buffer_recurrent import RecurrentBatch
-from basics.utils import get_device, create_target, mean_of_unmasked_elements, polyak_update, save_net, load_net
+from basics.utils import get_device, create_target, mean_of_unmasked_elements, TargetNetworks, save_net, load_net
+from basics.utils import compilable_update
+from basics.utils import make_valid_timesteps_selector
 
 
 @gin.configurable(module=__name__)
@@ -25,7 +27,9 @@ class RecurrentDDPG(RecurrentOffPolicyRLAlgorithm):
         gamma=0.99,
         lr=3e-4,
         polyak=0.995,
-        action_noise=0.1
+        action_noise=0.1,
+        burn_in=None,  # if an int, segments start from stored hidden states after burn_in steps (see buffer)
+        compile_update=False,  # if True, update_networks is compiled with torch.compile (see compilable_update)
     ):
 
         # hyperparameters
@@ -36,8 +40,10 @@ class RecurrentDDPG(RecurrentOffPolicyRLAlgorithm):
         self.gamma = gamma
         self.lr = lr
         self.polyak = polyak
+        self.compile_update = compile_update
 
         self.action_noise = action_noise
+        self.burn_in = burn_in
 
         # trackers
 
@@ -57,6 +63,18 @@ class RecurrentDDPG(RecurrentOffPolicyRLAlgorithm):
         self.Q = MLPCritic(hidden_dim, action_dim).to(get_device())
         self.Q_targ = create_target(self.Q)
 
+        self.summarizers = [self.actor_summarizer, self.critic_summarizer]
+        self.target_summarizers = [self.actor_summarizer_targ, self.critic_summarizer_targ]
+
+        # all target networks are Polyak-averaged at once (see TargetNetworks)
+
+        self.target_networks = TargetNetworks([
+            (self.actor_summarizer_targ, self.actor_summarizer),
+            (self.critic_summarizer_targ, self.critic_summarizer),
+            (self.actor_targ, self.actor),
+            (self.Q_targ, self.Q),
+        ])
+
         # optimizers
 
         self.actor_summarizer_optimizer = optim.Adam(self.actor_summarizer.parameters(), lr=lr)
@@ -67,11 +85,14 @@ class RecurrentDDPG(RecurrentOffPolicyRLAlgorithm):
 
     def reinitialize_hidden(self) -> None:
         self.hidden = None
+        self.critic_hiddens = None
 
     def act(self, observation: np.array, deterministic: bool) -> np.array:
 
-        with torch.no_grad():
-            observation = torch.tensor(observation).unsqueeze(0).unsqueeze(0).float().to(get_device())
+        with torch.inference_mode():
+            observation = self.as_act_input(observation)
+            if self.burn_in is not None:
+                self.record_hidden_states(observation)
             summary, self.hidden = self.actor_summarizer(observation, self.hidden, return_hidden=True)
             greedy_action = self.actor(summary).view(-1).cpu().numpy()  # view as 1d -> to cpu -> to numpy
             if deterministic:
@@ -79,23 +100,40 @@ class RecurrentDDPG(RecurrentOffPolicyRLAlgorithm):
             else:
                 return np.clip(greedy_action + self.action_noise * np.random.randn(self.action_dim), -1.0, 1.0)
 
+    @compilable_update
     def update_networks(self, b: RecurrentBatch):
 
+        assert b.l is None or b.l.device.type == 'cpu', "lengths (b.l) must be on cpu, as pack_padded_sequence expects"
+
         bs, num_bptt = b.r.shape[0], b.r.shape[1]
 
-        # compute summary
+        # compute summary (with lengths, the rnn skips padded timesteps)
+
+        o_lengths = None if b.l is None else b.l + 1
 
-        actor_summary = self.actor_summarizer(b.o)
-        critic_summary = self.critic_summarizer(b.o)
+        # with stored hidden states, segments start from them (after burn-in) instead of from zeros
 
-        actor_summary_targ = self.actor_summarizer_targ(b.o)
-        critic_summary_targ = self.critic_summarizer_targ(b.o)
+        (actor_h, critic_h), (actor_h_targ, critic_h_targ) = self.get_initial_hiddens(b)
+
+        actor_summary = self.actor_summarizer(b.o, actor_h, lengths=o_lengths)
+        critic_summary = self.critic_summarizer(b.o, critic_h, lengths=o_lengths)
+
+        actor_summary_targ = self.actor_summarizer_targ(b.o, actor_h_targ, lengths=o_lengths)
+        critic_summary_targ = self.critic_summarizer_targ(b.o, critic_h_targ, lengths=o_lengths)
 
         actor_summary_1_T, actor_summary_2_Tplus1 = actor_summary[:, :-1, :], actor_summary_targ[:, 1:, :]
         critic_summary_1_T, critic_summary_2_Tplus1 = critic_summary[:, :-1, :], critic_summary_targ[:, 1:, :]
 
         assert actor_summary.shape == (bs, num_bptt+1, self.hidden_dim)
 
+        if b.l is not None:
+            # from here on, MLP heads only see valid timesteps (as bs = num_valid sequences of length 1)
+            select = make_valid_timesteps_selector(b.l, num_bptt, b.r.device)
+            actor_summary_1_T, actor_summary_2_Tplus1 = select(actor_summary_1_T), select(actor_summary_2_Tplus1)
+            critic_summary_1_T, critic_summary_2_Tplus1 = select(critic_summary_1_T), select(critic_summary_2_Tplus1)
+            b = b._replace(o=None, a=select(b.a), r=select(b.r), d=select(b.d), m=select(b.m))
+            bs, num_bptt = b.r.shape[0], 1
+
         # compute predictions
 
         predictions = self.Q(critic_summary_1_T, b.a)
@@ -152,20 +190,20 @@ class RecurrentDDPG(RecurrentOffPolicyRLAlgorithm):
 
         # update target networks
 
-        polyak_update(targ_net=self.actor_targ, pred_net=self.actor, polyak=self.polyak)
-        polyak_update(targ_net=self.Q_targ, pred_net=self.Q, polyak=self.polyak)
-
-        polyak_update(targ_net=self.actor_summarizer_targ, pred_net=self.actor_summarizer, polyak=self.polyak)
-        polyak_update(targ_net=self.critic_summarizer_targ, pred_net=self.critic_summarizer, polyak=self.polyak)
+        self.target_networks.update(self.polyak)
 
         return {
             # for learning the q functions
-            '(qfunc) Q pred': float(mean_of_unmasked_elements(predictions, b.m)),
-            '(qfunc) Q loss': float(Q_loss),
+            '(qfunc) Q pred': mean_of_unmasked_elements(predictions, b.m).detach(),
+            '(qfunc) Q loss': Q_loss.detach(),
             # for learning the actor
-            '(actor) Q value': float(mean_of_unmasked_elements(Q_values, b.m)),
+            '(actor) Q value': mean_of_unmasked_elements(Q_values, b.m).detach(),
         }
 
+    @property
+    def actor_networks(self) -> list:
+        return [self.actor_summarizer, self.actor]
+
     def save_actor(self, save_dir: str) -> None:
         save_net(net=self.actor_summarizer, save_dir=save_dir, save_name="actor_summarizer.pth")
         save_net(net=self.actor, save_dir=save_dir, save_name="actor.pth")
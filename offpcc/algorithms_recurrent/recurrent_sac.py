@@ -8,10 +8,12 @@ import torch.optim as optim
 from torch.distributions import Normal, Independent
 
 from basics.abstract_algorithms import RecurrentOffPolicyRLAlgorithm
-from basics.actors_and_critics import MLPGaussianActor, MLPCritic
+from basics.actors_and_critics import MLPGaussianActor, MLPCritic, MLPCriticEnsemble
 from basics.summarizer import Summarizer
 from basics.replay_buffer_recurrent import RecurrentBatch
-from basics.utils import get_device, create_target, mean_of_unmasked_elements, polyak_update, save_net, load_net
+from basics.utils import get_device, create_target, mean_of_unmasked_elements, TargetNetworks, save_net, load_net
+from basics.utils import compilable_update
+from basics.utils import make_valid_timesteps_selector, correlation_of_unmasked_elements
 
 
 @gin.configurable(module=__name__)
@@ -27,6 +29,10 @@ class RecurrentSAC(RecurrentOffPolicyRLAlgorithm):
         polyak=0.995,
         alpha=1.0,  # if autotune_alpha, this becomes the initial alpha value
         autotune_alpha: bool = True,
+        burn_in=None,  # if an int, segments start from stored hidden states after burn_in steps (see buffer)
+        critic_ensemble=False,  # if True, Q1 and Q2 are a single MLPCriticEnsemble (Q), with a single optimizer
+        num_critics=2,  # > 2 needs critic_ensemble; targets and the policy loss use the min over all critics
+        compile_update=False,  # if True, update_networks is compiled with torch.compile (see compilable_update)
     ):
 
         # hyperparameters
@@ -37,6 +43,12 @@ class RecurrentSAC(RecurrentOffPolicyRLAlgorithm):
         self.gamma = gamma
         self.lr = lr
         self.polyak = polyak
+        self.compile_update = compile_update
+        self.burn_in = burn_in
+
+        assert critic_ensemble or num_critics == 2, "separate critics are Q1 and Q2; use critic_ensemble for more"
+        self.critic_ensemble = critic_ensemble
+        self.num_critics = num_critics
 
         self.autotune_alpha = autotune_alpha
 
@@ -56,32 +68,56 @@ class RecurrentSAC(RecurrentOffPolicyRLAlgorithm):
 
         self.actor_summarizer = Summarizer(input_dim, hidden_dim).to(get_device())
 
-        self.Q1_summarizer = Summarizer(input_dim, hidden_dim).to(get_device())
-        self.Q1_summarizer_targ = create_target(self.Q1_summarizer)
+        # one summarizer (and target summarizer) per critic
+
+        self.Q_summarizers = [Summarizer(input_dim, hidden_dim).to(get_device()) for _ in range(num_critics)]
+        self.Q_summarizers_targ = [create_target(summarizer) for summarizer in self.Q_summarizers]
 
-        self.Q2_summarizer = Summarizer(input_dim, hidden_dim).to(get_device())
-        self.Q2_summarizer_targ = create_target(self.Q2_summarizer)
+        self.summarizers = [self.actor_summarizer, *self.Q_summarizers]
+        self.target_summarizers = [None, *self.Q_summarizers_targ]  # no actor target
 
         self.actor = MLPGaussianActor(input_dim=hidden_dim, action_dim=action_dim).to(get_device())
 
-        self.Q1 = MLPCritic(input_dim=hidden_dim, action_dim=action_dim).to(get_device())
-        self.Q1_targ = create_target(self.Q1)
+        if critic_ensemble:
+
+            self.Q = MLPCriticEnsemble(hidden_dim, action_dim, num_critics=num_critics).to(get_device())
+            self.Q_targ = create_target(self.Q)
+
+        else:
+
+            self.Q1 = MLPCritic(input_dim=hidden_dim, action_dim=action_dim).to(get_device())
+            self.Q1_targ = create_target(self.Q1)
+
+            self.Q2 = MLPCritic(input_dim=hidden_dim, action_dim=action_dim).to(get_device())
+            self.Q2_targ = create_target(self.Q2)
 
-        self.Q2 = MLPCritic(input_dim=hidden_dim, action_dim=action_dim).to(get_device())
-        self.Q2_targ = create_target(self.Q2)
+        # all target networks are Polyak-averaged at once (see TargetNetworks)
+
+        self.target_networks = TargetNetworks([
+            *zip(self.Q_summarizers_targ, self.Q_summarizers),
+            *([(self.Q_targ, self.Q)] if critic_ensemble else [(self.Q1_targ, self.Q1), (self.Q2_targ, self.Q2)]),
+        ])
 
         # optimizers
 
         self.actor_summarizer_optimizer = optim.Adam(self.actor_summarizer.parameters(), lr=lr)
-        self.Q1_summarizer_optimizer = optim.Adam(self.Q1_summarizer.parameters(), lr=lr)
-        self.Q2_summarizer_optimizer = optim.Adam(self.Q2_summarizer.parameters(), lr=lr)
+        self.Q_summarizer_optimizers = [optim.Adam(summarizer.parameters(), lr=lr) for summarizer in self.Q_summarizers]
 
         self.actor_optimizer = optim.Adam(self.actor.parameters(), lr=lr)
-        self.Q1_optimizer = optim.Adam(self.Q1.parameters(), lr=lr)
-        self.Q2_optimizer = optim.Adam(self.Q2.parameters(), lr=lr)
+
+        if critic_ensemble:
+            self.Q_optimizer = optim.Adam(self.Q.parameters(), lr=lr)
+            Q_optimizers = [self.Q_optimizer]
+        else:
+            self.Q1_optimizer = optim.Adam(self.Q1.parameters(), lr=lr)
+            self.Q2_optimizer = optim.Adam(self.Q2.parameters(), lr=lr)
+            Q_optimizers = [self.Q1_optimizer, self.Q2_optimizer]
+
+        self.Q_optimizers = [*self.Q_summarizer_optimizers, *Q_optimizers]
 
     def reinitialize_hidden(self) -> None:
         self.hidden = None
+        self.critic_hiddens = None
 
     def sample_action_from_distribution(
             self,
@@ -98,9 +134,11 @@ class RecurrentSAC(RecurrentOffPolicyRLAlgorithm):
 
         if deterministic:
             u = means
-        else:
+        elif return_log_prob:
             mu_given_s = Independent(Normal(loc=means, scale=stds), reinterpreted_batch_ndims=1)  # normal distribution
             u = mu_given_s.rsample()
+        else:
+            u = means + stds * torch.randn_like(means)  # as rsample, without the overhead of a distribution object
 
         a = torch.tanh(u).view(bs, seq_len, self.action_dim)  # shape checking
 
@@ -111,44 +149,73 @@ class RecurrentSAC(RecurrentOffPolicyRLAlgorithm):
             return a
 
     def act(self, observation: np.array, deterministic: bool) -> np.array:
-        with torch.no_grad():
-            observation = torch.tensor(observation).unsqueeze(0).unsqueeze(0).float().to(get_device())
+        with torch.inference_mode():
+            observation = self.as_act_input(observation)
+            if self.burn_in is not None:
+                self.record_hidden_states(observation)
             summary, self.hidden = self.actor_summarizer(observation, self.hidden, return_hidden=True)
             action = self.sample_action_from_distribution(summary, deterministic=deterministic, return_log_prob=False)
             return action.view(-1).cpu().numpy()  # view as 1d -> to cpu -> to numpy
 
     def get_current_alpha(self):
         if self.autotune_alpha:
-            return np.exp(float(self.log_alpha))
+            return self.log_alpha.detach().exp()
         else:
             return self.alpha
 
+    def compute_Q_values(self, Q_summaries: list, actions: torch.tensor, target: bool = False) -> torch.tensor:
+        """
+        Values of all critics (each on the summary of its own summarizer in Q_summaries), stacked into shape
+        (num_critics, bs, num_bptt, 1), from the target networks if target.
+        """
+        if self.critic_ensemble:
+            return (self.Q_targ if target else self.Q)(Q_summaries, actions)
+        Q1_summary, Q2_summary = Q_summaries
+        if target:
+            return torch.stack([self.Q1_targ(Q1_summary, actions), self.Q2_targ(Q2_summary, actions)])
+        return torch.stack([self.Q1(Q1_summary, actions), self.Q2(Q2_summary, actions)])
+
+    @compilable_update
     def update_networks(self, b: RecurrentBatch) -> dict:
 
+        assert b.l is None or b.l.device.type == 'cpu', "lengths (b.l) must be on cpu, as pack_padded_sequence expects"
+
         bs, num_bptt = b.r.shape[0], b.r.shape[1]
 
-        # compute summary
+        # compute summary (with lengths, the rnn skips padded timesteps)
+
+        o_lengths = None if b.l is None else b.l + 1
+
+        # with stored hidden states, segments start from them (after burn-in) instead of from zeros
 
-        actor_summary = self.actor_summarizer(b.o)
-        Q1_summary = self.Q1_summarizer(b.o)
-        Q2_summary = self.Q2_summarizer(b.o)
+        (actor_h, *Q_hs), (_, *Q_hs_targ) = self.get_initial_hiddens(b)
 
-        Q1_summary_targ = self.Q1_summarizer_targ(b.o)
-        Q2_summary_targ = self.Q2_summarizer_targ(b.o)
+        actor_summary = self.actor_summarizer(b.o, actor_h, lengths=o_lengths)
+        Q_summaries = [summarizer(b.o, h, lengths=o_lengths) for summarizer, h in zip(self.Q_summarizers, Q_hs)]
+        Q_summaries_targ = [
+            summarizer(b.o, h, lengths=o_lengths) for summarizer, h in zip(self.Q_summarizers_targ, Q_hs_targ)
+        ]
 
         actor_summary_1_T, actor_summary_2_Tplus1 = actor_summary[:, :-1, :], actor_summary[:, 1:, :]
-        Q1_summary_1_T, Q1_summary_2_Tplus1 = Q1_summary[:, :-1, :], Q1_summary_targ[:, 1:, :]
-        Q2_summary_1_T, Q2_summary_2_Tplus1 = Q2_summary[:, :-1, :], Q2_summary_targ[:, 1:, :]
+        Q_summaries_1_T = [Q_summary[:, :-1, :] for Q_summary in Q_summaries]
+        Q_summaries_2_Tplus1 = [Q_summary_targ[:, 1:, :] for Q_summary_targ in Q_summaries_targ]
 
         assert actor_summary.shape == (bs, num_bptt+1, self.hidden_dim)
 
+        if b.l is not None:
+            # from here on, MLP heads only see valid timesteps (as bs = num_valid sequences of length 1)
+            select = make_valid_timesteps_selector(b.l, num_bptt, b.r.device)
+            actor_summary_1_T, actor_summary_2_Tplus1 = select(actor_summary_1_T), select(actor_summary_2_Tplus1)
+            Q_summaries_1_T = [select(Q_summary) for Q_summary in Q_summaries_1_T]
+            Q_summaries_2_Tplus1 = [select(Q_summary) for Q_summary in Q_summaries_2_Tplus1]
+            b = b._replace(o=None, a=select(b.a), r=select(b.r), d=select(b.d), m=select(b.m))
+            bs, num_bptt = b.r.shape[0], 1
+
         # compute predictions
 
-        Q1_predictions = self.Q1(Q1_summary_1_T, b.a)
-        Q2_predictions = self.Q2(Q2_summary_1_T, b.a)
+        Q_predictions = self.compute_Q_values(Q_summaries_1_T, b.a)
 
-        assert Q1_predictions.shape == (bs, num_bptt, 1)
-        assert Q2_predictions.shape == (bs, num_bptt, 1)
+        assert Q_predictions.shape == (self.num_critics, bs, num_bptt, 1)
 
         # compute targets
 
@@ -157,8 +224,7 @@ class RecurrentSAC(RecurrentOffPolicyRLAlgorithm):
             na, log_pi_na_given_ns = self.sample_action_from_distribution(actor_summary_2_Tplus1, deterministic=False,
                                                                           return_log_prob=True)
 
-            n_min_Q_targ = torch.min(self.Q1_targ(Q1_summary_2_Tplus1, na),
-                                     self.Q2_targ(Q2_summary_2_Tplus1, na))
+            n_min_Q_targ = self.compute_Q_values(Q_summaries_2_Tplus1, na, target=True).min(dim=0).values
             n_sample_entropy = - log_pi_na_given_ns
 
             targets = b.r + self.gamma * (1 - b.d) * (n_min_Q_targ + self.get_current_alpha() * n_sample_entropy)
@@ -170,36 +236,24 @@ class RecurrentSAC(RecurrentOffPolicyRLAlgorithm):
 
         # compute td error
 
-        Q1_loss_elementwise = (Q1_predictions - targets) ** 2
-        Q1_loss = mean_of_unmasked_elements(Q1_loss_elementwise, b.m)
-
-        Q2_loss_elementwise = (Q2_predictions - targets) ** 2
-        Q2_loss = mean_of_unmasked_elements(Q2_loss_elementwise, b.m)
-
-        assert Q1_loss.shape == ()
-        assert Q2_loss.shape == ()
+        Q_losses = [mean_of_unmasked_elements((predictions - targets) ** 2, b.m) for predictions in Q_predictions]
 
-        # reduce td error
+        assert all(Q_loss.shape == () for Q_loss in Q_losses)
 
-        self.Q1_summarizer_optimizer.zero_grad()
-        self.Q1_optimizer.zero_grad()
-        Q1_loss.backward()
-        self.Q1_summarizer_optimizer.step()
-        self.Q1_optimizer.step()
+        # reduce td error (critics share no parameters, so one backward of the sum gives each critic its gradients)
 
-        self.Q2_summarizer_optimizer.zero_grad()
-        self.Q2_optimizer.zero_grad()
-        Q2_loss.backward()
-        self.Q2_summarizer_optimizer.step()
-        self.Q2_optimizer.step()
+        for optimizer in self.Q_optimizers:
+            optimizer.zero_grad()
+        sum(Q_losses).backward()
+        for optimizer in self.Q_optimizers:
+            optimizer.step()
 
         # compute policy loss
 
         a, log_pi_a_given_s = self.sample_action_from_distribution(actor_summary_1_T, deterministic=False,
                                                                    return_log_prob=True)
 
-        min_Q = torch.min(self.Q1(Q1_summary_1_T.detach(), a),
-                          self.Q2(Q2_summary_1_T.detach(), a))
+        min_Q = self.compute_Q_values([Q_summary.detach() for Q_summary in Q_summaries_1_T], a).min(dim=0).values
         sample_entropy = - log_pi_a_given_s
 
         policy_loss_elementwise = - (min_Q + self.get_current_alpha() * sample_entropy)
@@ -235,41 +289,34 @@ class RecurrentSAC(RecurrentOffPolicyRLAlgorithm):
 
         else:
 
-            log_alpha_loss = 0  # needed only for logging purposes
+            log_alpha_loss = torch.zeros(1, device=get_device())  # needed only for logging purposes
 
         # update target networks
 
-        polyak_update(targ_net=self.Q1_summarizer_targ, pred_net=self.Q1_summarizer, polyak=self.polyak)
-        polyak_update(targ_net=self.Q2_summarizer_targ, pred_net=self.Q2_summarizer, polyak=self.polyak)
+        self.target_networks.update(self.polyak)
 
-        polyak_update(targ_net=self.Q1_targ, pred_net=self.Q1, polyak=self.polyak)
-        polyak_update(targ_net=self.Q2_targ, pred_net=self.Q2, polyak=self.polyak)
-
-        m_numpy = b.m.cpu().numpy().astype(bool)
-        Q1_predictions_numpy = Q1_predictions.detach().cpu().numpy()
-        Q2_predictions_numpy = Q2_predictions.detach().cpu().numpy()
-
-        Q1_predictions_filtered = Q1_predictions_numpy[m_numpy]
-        Q2_predictions_filtered = Q2_predictions_numpy[m_numpy]
-
-        corr_matrix = np.corrcoef(Q1_predictions_filtered, Q2_predictions_filtered)
-        corr = corr_matrix[0, 1]
+        corr = correlation_of_unmasked_elements(Q_predictions[0].detach(), Q_predictions[1].detach(), b.m)
 
         return {
             # for learning the q functions
-            '(qfunc) Q1 pred': float(mean_of_unmasked_elements(Q1_predictions, b.m)),
-            '(qfunc) Q2 pred': float(mean_of_unmasked_elements(Q2_predictions, b.m)),
+            **{
+                f'(qfunc) Q{i + 1} pred': mean_of_unmasked_elements(predictions, b.m).detach()
+                for i, predictions in enumerate(Q_predictions)
+            },
             '(qfunc) Q1 Q2 corr': corr,
-            '(qfunc) Q1 loss': float(Q1_loss),
-            '(qfunc) Q2 loss': float(Q2_loss),
+            **{f'(qfunc) Q{i + 1} loss': Q_loss.detach() for i, Q_loss in enumerate(Q_losses)},
             # for learning the actor
-            '(actor) min Q value': float(mean_of_unmasked_elements(min_Q, b.m)),
-            '(actor) entropy (sample)': float(mean_of_unmasked_elements(sample_entropy, b.m)),
+            '(actor) min Q value': mean_of_unmasked_elements(min_Q, b.m).detach(),
+            '(actor) entropy (sample)': mean_of_unmasked_elements(sample_entropy, b.m).detach(),
             # for learning the entropy coefficient (alpha)
             '(alpha) alpha': self.get_current_alpha(),
-            '(alpha) log alpha loss': float(log_alpha_loss)
+            '(alpha) log alpha loss': log_alpha_loss.detach()
         }
 
+    @property
+    def actor_networks(self) -> list:
+        return [self.actor_summarizer, self.actor]
+
     def save_actor(self, save_dir: str) -> None:
         save_net(net=self.actor_summarizer, save_dir=save_dir, save_name="actor_summarizer.pth")
         save_net(net=self.actor, save_dir=save_dir, save_name="actor.pth")
@@ -282,15 +329,18 @@ class RecurrentSAC(RecurrentOffPolicyRLAlgorithm):
 
         self.actor_summarizer.load_state_dict(algorithm.actor_summarizer.state_dict())
 
-        self.Q1_summarizer.load_state_dict(algorithm.Q1_summarizer.state_dict())
-        self.Q1_summarizer_targ.load_state_dict(algorithm.Q1_summarizer_targ.state_dict())
-
-        self.Q2_summarizer.load_state_dict(algorithm.Q2_summarizer.state_dict())
-        self.Q2_summarizer_targ.load_state_dict(algorithm.Q2_summarizer_targ.state_dict())
+        for summarizer, other_summarizer in zip(self.Q_summarizers, algorithm.Q_summarizers):
+            summarizer.load_state_dict(other_summarizer.state_dict())
+        for summarizer_targ, other_summarizer_targ in zip(self.Q_summarizers_targ, algorithm.Q_summarizers_targ):
+            summarizer_targ.load_state_dict(other_summarizer_targ.state_dict())
 
         self.actor.load_state_dict(algorithm.actor.state_dict())
 
-        self.Q1.load_state_dict(algorithm.Q1.state_dict())
-        self.Q1_targ.load_state_dict(algorithm.Q1_targ.state_dict())
-        self.Q2.load_state_dict(algorithm.Q2.state_dict())
-        self.Q2_targ.load_state_dict(algorithm.Q2_targ.state_dict())
+        if self.critic_ensemble:
+            self.Q.load_state_dict(algorithm.Q.state_dict())
+            self.Q_targ.load_state_dict(algorithm.Q_targ.state_dict())
+        else:
+            self.Q1.load_state_dict(algorithm.Q1.state_dict())
+            self.Q1_targ.load_state_dict(algorithm.Q1_targ.state_dict())
+            self.Q2.load_state_dict(algorithm.Q2.state_dict())
+            self.Q2_targ.load_state_dict(algorithm.Q2_targ.state_dict())
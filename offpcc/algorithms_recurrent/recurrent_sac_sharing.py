@@ -11,7 +11,9 @@ from basics.abstract_algorithms import RecurrentOffPolicyRLAlgorithm
 from basics.actors_and_critics import MLPGaussianActor, MLPCritic
 from basics.summarizer import Summarizer
 from basics.replay_buffer_recurrent import RecurrentBatch
-from basics.utils import get_device, create_target, mean_of_unmasked_elements, polyak_update, save_net, load_net
+from basics.utils import get_device, create_target, mean_of_unmasked_elements, TargetNetworks, save_net, load_net
+from basics.utils import compilable_update
+from basics.utils import make_valid_timesteps_selector, correlation_of_unmasked_elements
 
 
 @gin.configurable(module=__name__)
@@ -32,6 +34,7 @@ class RecurrentSACSharing(RecurrentOffPolicyRLAlgorithm):
         polyak=0.995,
         alpha=1.0,  # if autotune_alpha, this becomes the initial alpha value
         autotune_alpha: bool = True,
+        compile_update=False,  # if True, update_networks is compiled with torch.compile (see compilable_update)
     ):
 
         # hyperparameters
@@ -42,6 +45,7 @@ class RecurrentSACSharing(RecurrentOffPolicyRLAlgorithm):
         self.gamma = gamma
         self.lr = lr
         self.polyak = polyak
+        self.compile_update = compile_update
 
         self.autotune_alpha = autotune_alpha
 
@@ -70,6 +74,14 @@ class RecurrentSACSharing(RecurrentOffPolicyRLAlgorithm):
         self.Q2 = MLPCritic(input_dim=hidden_dim, action_dim=action_dim).to(get_device())
         self.Q2_targ = create_target(self.Q2)
 
+        # all target networks are Polyak-averaged at once (see TargetNetworks)
+
+        self.target_networks = TargetNetworks([
+            (self.summarizer_targ, self.summarizer),
+            (self.Q1_targ, self.Q1),
+            (self.Q2_targ, self.Q2),
+        ])
+
         # optimizers
 
         self.summarizer_optimizer = optim.Adam(self.summarizer.parameters(), lr=lr)
@@ -96,9 +108,11 @@ class RecurrentSACSharing(RecurrentOffPolicyRLAlgorithm):
 
         if deterministic:
             u = means
-        else:
+        elif return_log_prob:
             mu_given_s = Independent(Normal(loc=means, scale=stds), reinterpreted_batch_ndims=1)  # normal distribution
             u = mu_given_s.rsample()
+        else:
+            u = means + stds * torch.randn_like(means)  # as rsample, without the overhead of a distribution object
 
         a = torch.tanh(u).view(bs, seq_len, self.action_dim)  # shape checking
 
@@ -109,31 +123,43 @@ class RecurrentSACSharing(RecurrentOffPolicyRLAlgorithm):
             return a
 
     def act(self, observation: np.array, deterministic: bool) -> np.array:
-        with torch.no_grad():
-            observation = torch.tensor(observation).unsqueeze(0).unsqueeze(0).float().to(get_device())
+        with torch.inference_mode():
+            observation = self.as_act_input(observation)
             summary, self.hidden = self.summarizer(observation, self.hidden, return_hidden=True)
             action = self.sample_action_from_distribution(summary, deterministic=deterministic, return_log_prob=False)
             return action.view(-1).cpu().numpy()  # view as 1d -> to cpu -> to numpy
 
     def get_current_alpha(self):
         if self.autotune_alpha:
-            return np.exp(float(self.log_alpha))
+            return self.log_alpha.detach().exp()
         else:
             return self.alpha
 
+    @compilable_update
     def update_networks(self, b: RecurrentBatch) -> dict:
 
+        assert b.l is None or b.l.device.type == 'cpu', "lengths (b.l) must be on cpu, as pack_padded_sequence expects"
+
         bs, num_bptt = b.r.shape[0], b.r.shape[1]
 
-        # compute summary
+        # compute summary (with lengths, the rnn skips padded timesteps)
+
+        o_lengths = None if b.l is None else b.l + 1
 
-        summary = self.summarizer(b.o)
-        summary_targ = self.summarizer_targ(b.o)
+        summary = self.summarizer(b.o, lengths=o_lengths)
+        summary_targ = self.summarizer_targ(b.o, lengths=o_lengths)
 
         summary_1_T, summary_2_Tplus1 = summary[:, :-1, :], summary_targ[:, 1:, :]
 
         assert summary.shape == (bs, num_bptt+1, self.hidden_dim)
 
+        if b.l is not None:
+            # from here on, MLP heads only see valid timesteps (as bs = num_valid sequences of length 1)
+            select = make_valid_timesteps_selector(b.l, num_bptt, b.r.device)
+            summary_1_T, summary_2_Tplus1 = select(summary_1_T), select(summary_2_Tplus1)
+            b = b._replace(o=None, a=select(b.a), r=select(b.r), d=select(b.d), m=select(b.m))
+            bs, num_bptt = b.r.shape[0], 1
+
         # compute predictions
 
         Q1_predictions = self.Q1(summary_1_T, b.a)
@@ -174,16 +200,14 @@ class RecurrentSACSharing(RecurrentOffPolicyRLAlgorithm):
         # reduce td error
 
         self.summarizer_optimizer.zero_grad()
-
         self.Q1_optimizer.zero_grad()
-        Q1_loss.backward(retain_graph=True)
-        self.Q1_optimizer.step()
-
         self.Q2_optimizer.zero_grad()
-        Q2_loss.backward()
-        self.Q2_optimizer.step()
 
-        self.summarizer_optimizer.step()  # take the step after both critics have backward-ed gradient to summarizer
+        (Q1_loss + Q2_loss).backward()  # the summarizer gets the gradients of both critics
+
+        self.Q1_optimizer.step()
+        self.Q2_optimizer.step()
+        self.summarizer_optimizer.step()
 
         # compute policy loss
 
@@ -226,40 +250,33 @@ class RecurrentSACSharing(RecurrentOffPolicyRLAlgorithm):
 
         else:
 
-            log_alpha_loss = 0  # needed only for logging purposes
+            log_alpha_loss = torch.zeros(1, device=get_device())  # needed only for logging purposes
 
         # update target networks
 
-        polyak_update(targ_net=self.summarizer_targ, pred_net=self.summarizer, polyak=self.polyak)
+        self.target_networks.update(self.polyak)
 
-        polyak_update(targ_net=self.Q1_targ, pred_net=self.Q1, polyak=self.polyak)
-        polyak_update(targ_net=self.Q2_targ, pred_net=self.Q2, polyak=self.polyak)
-
-        m_numpy = b.m.cpu().numpy().astype(bool)
-        Q1_predictions_numpy = Q1_predictions.detach().cpu().numpy()
-        Q2_predictions_numpy = Q2_predictions.detach().cpu().numpy()
-
-        Q1_predictions_filtered = Q1_predictions_numpy[m_numpy]
-        Q2_predictions_filtered = Q2_predictions_numpy[m_numpy]
-
-        corr_matrix = np.corrcoef(Q1_predictions_filtered, Q2_predictions_filtered)
-        corr = corr_matrix[0, 1]
+        corr = correlation_of_unmasked_elements(Q1_predictions.detach(), Q2_predictions.detach(), b.m)
 
         return {
             # for learning the q functions
-            '(qfunc) Q1 pred': float(mean_of_unmasked_elements(Q1_predictions, b.m)),
-            '(qfunc) Q2 pred': float(mean_of_unmasked_elements(Q2_predictions, b.m)),
+            '(qfunc) Q1 pred': mean_of_unmasked_elements(Q1_predictions, b.m).detach(),
+            '(qfunc) Q2 pred': mean_of_unmasked_elements(Q2_predictions, b.m).detach(),
             '(qfunc) Q1 Q2 corr': corr,
-            '(qfunc) Q1 loss': float(Q1_loss),
-            '(qfunc) Q2 loss': float(Q2_loss),
+            '(qfunc) Q1 loss': Q1_loss.detach(),
+            '(qfunc) Q2 loss': Q2_loss.detach(),
             # for learning the actor
-            '(actor) min Q value': float(mean_of_unmasked_elements(min_Q, b.m)),
-            '(actor) entropy (sample)': float(mean_of_unmasked_elements(sample_entropy, b.m)),
+            '(actor) min Q value': mean_of_unmasked_elements(min_Q, b.m).detach(),
+            '(actor) entropy (sample)': mean_of_unmasked_elements(sample_entropy, b.m).detach(),
             # for learning the entropy coefficient (alpha)
             '(alpha) alpha': self.get_current_alpha(),
-            '(alpha) log alpha loss': float(log_alpha_loss)
+            '(alpha) log alpha loss': log_alpha_loss.detach()
         }
 
+    @property
+    def actor_networks(self) -> list:
+        return [self.summarizer, self.actor]
+
     def save_actor(self, save_dir: str) -> None:
         save_net(net=self.summarizer, save_dir=save_dir, save_name="summarizer.pth")
         save_net(net=self.actor, save_dir=save_dir, save_name="actor.pth")
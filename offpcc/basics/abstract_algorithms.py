@@ -1,19 +1,49 @@
 from abc import ABC, abstractmethod
 
 import numpy as np
+import torch
 
 from basics.replay_buffer import Batch
 from basics.replay_buffer_recurrent import RecurrentBatch
+from basics.utils import get_device
 
 
 class OffPolicyRLAlgorithm(ABC):
 
+    compile_update = False  # see compilable_update
+    act_input = None
+
+    def as_act_input(self, states: np.array, batched: bool = False) -> torch.tensor:
+        """
+        states (a single state, or a batch of them if batched) as a (batch_size, *state_shape) float tensor on device,
+        copied into a preallocated tensor, which is only reallocated when batch_size changes.
+        """
+        states = torch.from_numpy(np.asarray(states))
+        states = states if batched else states.unsqueeze(0)
+        if self.act_input is None or self.act_input.shape != states.shape:
+            self.act_input = torch.empty(states.shape, device=get_device())
+        return self.act_input.copy_(states)  # also casts, e.g., float64 -> float32
+
     @abstractmethod
     def act(self, state: np.array, deterministic: bool) -> np.array:
         pass
 
+    def act_batch(self, states: np.array, deterministic: bool) -> np.array:
+        """
+        Actions for a batch of states (e.g., one per parallel env), of shape (batch_size, action_dim). Subclasses
+        override this with a single batched forward pass.
+        """
+        return np.stack([self.act(state, deterministic) for state in states])
+
+    @abstractmethod
+    def update_networks(self, b: Batch, return_td_errors: bool = False):
+        """Returns a dict of stats, or (dict of stats, per-sample td errors) if return_td_errors"""
+        pass
+
+    @property
     @abstractmethod
-    def update_networks(self, b: Batch) -> dict:
+    def actor_networks(self) -> list:
+        """Networks used by act (the ones saved by save_actor), e.g., to send their weights to actor processes."""
         pass
 
     @abstractmethod
@@ -29,8 +59,59 @@ class RecurrentOffPolicyRLAlgorithm(ABC):
 
     """
     Based on Liskov Substitution Principle, this class should not inherit from OffPolicyRLAlgorithm
+
+    Subclasses that support stored hidden states (see RecurrentReplayBuffer) set burn_in to an int (instead of None)
+    to enable them, and list their summarizers (the actor one first) and the summarizers used for targets alongside
+    each of them (None if unused); act then calls record_hidden_states, and update_networks starts from
+    get_initial_hiddens.
     """
 
+    burn_in = None
+    compile_update = False  # see compilable_update
+    summarizers, target_summarizers = [], []
+    hidden, critic_hiddens = None, None
+    act_input = None
+
+    def as_act_input(self, observation: np.array) -> torch.tensor:
+        """observation as a (1, 1, *observation_shape) float tensor on device, copied into a preallocated tensor."""
+        observation = torch.from_numpy(np.asarray(observation)).view(1, 1, -1)
+        if self.act_input is None:
+            self.act_input = torch.empty(observation.shape, device=get_device())
+        return self.act_input.copy_(observation)
+
+    @property
+    def hidden_state_size(self) -> int:
+        return sum(summarizer.hidden_state_size for summarizer in self.summarizers)
+
+    def record_hidden_states(self, observation: torch.tensor) -> None:
+        """
+        Records the hidden states of all summarizers before observation (flattened and concatenated, for the
+        buffer) as recorded_hidden_state, and steps the critic summarizers on observation (act steps the actor one).
+        """
+        critic_hiddens = self.critic_hiddens or [None] * (len(self.summarizers) - 1)
+        hiddens = [self.hidden] + critic_hiddens
+        self.recorded_hidden_state = torch.cat([
+            summarizer.flatten_hidden(hidden) for summarizer, hidden in zip(self.summarizers, hiddens)
+        ], dim=1).view(-1).cpu().numpy()
+        self.critic_hiddens = [
+            summarizer(observation, hidden, return_hidden=True)[1]
+            for summarizer, hidden in zip(self.summarizers[1:], critic_hiddens)
+        ]
+
+    def get_initial_hiddens(self, b: RecurrentBatch):
+        """
+        Initial hidden states of summarizers and target_summarizers for b: the stored ones (b.h) after the burn-in
+        prefix (see Summarizer.burn_in), or zeros (None) if b has none.
+        """
+        if b.h is None:
+            return [None] * len(self.summarizers), [None] * len(self.target_summarizers)
+        flat_hiddens = torch.split(b.h, [summarizer.hidden_state_size for summarizer in self.summarizers], dim=1)
+        hiddens = [s.burn_in(h, b.bo, b.bm) for s, h in zip(self.summarizers, flat_hiddens)]
+        hiddens_targ = [
+            None if s is None else s.burn_in(h, b.bo, b.bm) for s, h in zip(self.target_summarizers, flat_hiddens)
+        ]
+        return hiddens, hiddens_targ
+
     @abstractmethod
     def reinitialize_hidden(self) -> None:
         pass
@@ -43,6 +124,12 @@ class RecurrentOffPolicyRLAlgorithm(ABC):
     def update_networks(self, b: RecurrentBatch) -> dict:
         pass
 
+    @property
+    @abstractmethod
+    def actor_networks(self) -> list:
+        """Networks used by act (the ones saved by save_actor), e.g., to send their weights to actor processes."""
+        pass
+
     @abstractmethod
     def save_actor(self, save_dir: str) -> None:
         pass
@@ -1,4 +1,5 @@
 import gin
+import numpy as np
 import torch
 import torch.nn as nn
 
@@ -38,15 +39,63 @@ def make_MLP(num_in, num_out, final_activation, hidden_dimensions=(256, 256)):
         return net  # actual_num_out would just be num_out
 
 
+class NumpyMLP:
+
+    """
+    Forward pass of a sequence of nn.Linear, nn.ReLU and nn.Tanh layers in numpy, for acting at batch size 1 on cpu,
+    where the per-op overhead of torch dominates the actual math of small MLPs.
+
+    Weights are zero-copy numpy views of the parameters, so they are always in sync with them, since optimizer steps,
+    Polyak updates and load_state_dict all update parameters in place. Views are rebuilt whenever they no longer point
+    to the parameters, e.g., in a deepcopy (whose views are copies).
+    """
+
+    def __init__(self, *layers):
+        self.layers = []
+        for module in layers:
+            self.layers.extend(module if isinstance(module, nn.Sequential) else [module])
+        self.linear = next(layer for layer in self.layers if isinstance(layer, nn.Linear))
+        self.views = None
+
+    def make_views(self) -> list:
+        views = []
+        for layer in self.layers:
+            if isinstance(layer, nn.Linear):
+                views.append((layer.weight.detach().numpy().T, layer.bias.detach().numpy()))
+            elif isinstance(layer, (nn.ReLU, nn.Tanh)):
+                views.append(type(layer))
+            else:
+                raise TypeError(f"{type(layer).__name__} is not supported by NumpyMLP")
+        return views
+
+    def __call__(self, x: np.array) -> np.array:
+        if self.views is None or self.views[0][0].__array_interface__['data'][0] != self.linear.weight.data_ptr():
+            self.views = self.make_views()
+        for view in self.views:
+            if view is nn.ReLU:
+                x = np.maximum(x, 0)
+            elif view is nn.Tanh:
+                x = np.tanh(x)
+            else:
+                weight_t, bias = view
+                x = x @ weight_t + bias
+        return x
+
+
 class MLPTanhActor(nn.Module):
     """Output actions from [-1, 1]."""
     def __init__(self, input_dim, action_dim):
         super().__init__()
         self.net = make_MLP(num_in=input_dim, num_out=action_dim, final_activation=nn.Tanh())
+        self.numpy_net = NumpyMLP(self.net)
 
     def forward(self, states: torch.tensor):
         return self.net(states)
 
+    def forward_numpy(self, states: np.array) -> np.array:
+        """Same as forward, in numpy (see NumpyMLP); parameters must be on cpu."""
+        return self.numpy_net(states)
+
 
 class MLPGaussianActor(nn.Module):
     """Output parameters for some multi-dimensional zero-covariance Gaussian distribution."""
@@ -61,12 +110,22 @@ class MLPGaussianActor(nn.Module):
         self.LOG_STD_MAX = 2
         self.LOG_STD_MIN = -20
 
+        self.numpy_shared_net = NumpyMLP(self.shared_net)
+        self.numpy_means_layer, self.numpy_log_stds_layer = NumpyMLP(self.means_layer), NumpyMLP(self.log_stds_layer)
+
     def forward(self, states: torch.tensor) -> tuple:
         out = self.shared_net(states)
         means, log_stds = self.means_layer(out), self.log_stds_layer(out)
         stds = torch.exp(torch.clamp(log_stds, self.LOG_STD_MIN, self.LOG_STD_MAX))
         return means, stds
 
+    def forward_numpy(self, states: np.array) -> tuple:
+        """Same as forward, in numpy (see NumpyMLP); parameters must be on cpu."""
+        out = self.numpy_shared_net(states)
+        means, log_stds = self.numpy_means_layer(out), self.numpy_log_stds_layer(out)
+        stds = np.exp(np.clip(log_stds, self.LOG_STD_MIN, self.LOG_STD_MAX))
+        return means, stds
+
 
 class MLPCritic(nn.Module):
 
@@ -76,3 +135,53 @@ class MLPCritic(nn.Module):
 
     def forward(self, states: torch.tensor, actions: torch.tensor):
         return self.net(torch.cat([states, actions], dim=-1))
+
+
+@gin.configurable(module=__name__)
+class MLPCriticEnsemble(nn.Module):
+
+    """
+    num_critics critics with the architecture of MLPCritic, evaluated together: the weights of each layer are stacked
+    into a (num_critics, num_in, num_out) tensor, so that each layer is a single batched matmul (baddbmm) over all
+    critics instead of one small matmul per critic, and a single optimizer updates all critics at once. Outputs have
+    shape (num_critics, *batch_shape, 1).
+
+    states is either one tensor shared by all critics (e.g., SAC, TD3) or a list of one tensor per critic (e.g., the
+    summaries of separate summarizers in recurrent algorithms); actions are always shared. critics (a slice) selects
+    a subset of critics to evaluate, e.g., slice(0, 1) for the first one only.
+
+    Each critic is initialized like nn.Linear layers are by default, and critics share no parameters, so summing their
+    losses before backward gives each critic the same gradients as separate backward passes.
+    """
+
+    def __init__(self, input_dim, action_dim, num_critics=2, hidden_dimensions=(256, 256)):
+
+        super().__init__()
+
+        self.num_critics = num_critics
+
+        tensor_dimensions = [input_dim + action_dim, *hidden_dimensions, 1]
+
+        self.weights, self.biases = nn.ParameterList(), nn.ParameterList()
+        for num_in, num_out in zip(tensor_dimensions[:-1], tensor_dimensions[1:]):
+            bound = 1 / np.sqrt(num_in)
+            self.weights.append(nn.Parameter(torch.empty(num_critics, num_in, num_out).uniform_(-bound, bound)))
+            self.biases.append(nn.Parameter(torch.empty(num_critics, 1, num_out).uniform_(-bound, bound)))
+
+    def forward(self, states, actions: torch.tensor, critics=slice(None)) -> torch.tensor:
+
+        if isinstance(states, (list, tuple)):
+            inputs = torch.stack([torch.cat([s, actions], dim=-1) for s in states[critics]])
+        else:
+            inputs = torch.cat([states, actions], dim=-1).unsqueeze(0)
+
+        batch_shape = inputs.shape[1:-1]
+        num_critics = len(self.weights[0][critics])
+
+        x = inputs.reshape(inputs.shape[0], -1, inputs.shape[-1]).expand(num_critics, -1, -1)
+        for i, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+            x = torch.baddbmm(bias[critics], x, weight[critics])
+            if i < len(self.weights) - 1:
+                x = torch.relu(x)
+
+        return x.view(num_critics, *batch_shape, 1)
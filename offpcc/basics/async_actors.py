@@ -0,0 +1,198 @@
+import multiprocessing
+import queue
+from collections import namedtuple
+
+import cloudpickle
+import numpy as np
+import torch
+
+from basics.abstract_algorithms import RecurrentOffPolicyRLAlgorithm
+
+
+# transitions collected by an actor process; version holds, for each transition, the version of the weights that
+# chose its action (see SharedWeights), and episode_lens / episode_rets the stats of the episodes that ended in it
+
+Chunk = namedtuple('Chunk', 's a r ns d cutoff hidden_states version episode_lens episode_rets')
+
+
+def get_networks_to_share(algorithm) -> list:
+    """actor_networks, plus all summarizers if act records their hidden states (see record_hidden_states)."""
+    networks = list(algorithm.actor_networks)
+    if isinstance(algorithm, RecurrentOffPolicyRLAlgorithm) and algorithm.burn_in is not None:
+        networks += [summarizer for summarizer in algorithm.summarizers if summarizer not in networks]
+    return networks
+
+
+class SharedWeights:
+
+    """
+    A copy of the parameters and buffers of some networks in shared memory, written by the learner with publish and
+    read by actor processes with load_into, along with a version number (the number of updates done so far by the
+    learner). Both go through the lock of version, so a reader never sees half of a publish.
+
+    load_into copies into the existing tensors of the networks (in place), so numpy views of them (see NumpyMLP) stay
+    valid.
+    """
+
+    def __init__(self, networks, context):
+        self.tensors = [tensor.detach().cpu().clone().share_memory_() for tensor in self.get_tensors(networks)]
+        self.version = context.Value('q', 0)
+
+    @staticmethod
+    def get_tensors(networks) -> list:
+        return [tensor for network in networks for tensor in network.state_dict().values()]
+
+    def publish(self, networks, version) -> None:
+        with self.version.get_lock():
+            for shared_tensor, tensor in zip(self.tensors, self.get_tensors(networks)):
+                shared_tensor.copy_(tensor)
+            self.version.value = version
+
+    def load_into(self, networks) -> int:
+        with self.version.get_lock():
+            for tensor, shared_tensor in zip(self.get_tensors(networks), self.tensors):
+                tensor.copy_(shared_tensor)
+            return self.version.value
+
+
+def get_done_and_cutoff(done, info, episode_len, max_episode_steps) -> tuple:
+    """Same as in train: at max_episode_steps, done is only True if the episode was not truncated by TimeLimit."""
+    if episode_len == max_episode_steps:
+        cutoff = bool(info.get('TimeLimit.truncated'))  # this key is only available at max_steps_per_episode
+        done = not cutoff
+    else:
+        cutoff = False
+    return done, cutoff
+
+
+def run_actor(seed, pickled_env_fn, algorithm, weights, chunks, stop_event, env_steps, update_after, chunk_len) -> None:
+
+    """
+    Loop of an actor process: steps its own env with algorithm (a copy of the learner's one, refreshed from weights
+    whenever they have a new version) and puts Chunks of transitions on chunks.
+
+    As in train, actions are uniformly random until update_after env steps (counted across actors in env_steps) have
+    been taken. Recurrent algorithms only pick up new weights between episodes (like algorithm in train), and their
+    chunks hold whole episodes, since RecurrentReplayBuffer needs the transitions of an episode to be pushed together;
+    otherwise, a chunk is sent every chunk_len transitions (and at the end of each episode). chunk_len=None also
+    sends whole episodes, e.g., for a ReplayBuffer with deduplicate_ns.
+    """
+
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.set_num_threads(1)  # acting happens at batch size 1; leave the cores to the learner and other actors
+
+    env = cloudpickle.loads(pickled_env_fn)()
+    env_is_pbc = env.spec.id.startswith("pbc")
+
+    recurrent = isinstance(algorithm, RecurrentOffPolicyRLAlgorithm)
+    stores_hidden_states = recurrent and algorithm.burn_in is not None
+    networks = get_networks_to_share(algorithm)
+    version = weights.load_into(networks)
+
+    fields = {key: [] for key in ['s', 'a', 'r', 'ns', 'd', 'cutoff', 'hidden_states', 'version']}
+    episode_lens, episode_rets = [], []
+
+    state, episode_len, episode_ret = env.reset(), 0, 0
+
+    while not stop_event.is_set():
+
+        if not (recurrent and episode_len > 0) and weights.version.value != version:
+            version = weights.load_into(networks)
+
+        with env_steps.get_lock():
+            env_steps.value += 1
+            exploration_is_done = env_steps.value > update_after
+
+        if exploration_is_done:
+            action = algorithm.act(state, deterministic=False)
+        else:
+            if stores_hidden_states:
+                algorithm.act(state, deterministic=False)  # only to keep track of hidden states
+            action = env.action_space.sample()
+
+        next_state, reward, done, info = env.step(action)
+        episode_len += 1
+        episode_ret += (0 if reward <= 0 else 1) if env_is_pbc else reward
+        done, cutoff = get_done_and_cutoff(done, info, episode_len, env.spec.max_episode_steps)
+
+        for key, value in zip(fields, [state, action, reward, next_state, done, cutoff, None, version]):
+            fields[key].append(value)
+        if stores_hidden_states:
+            fields['hidden_states'][-1] = algorithm.recorded_hidden_state
+
+        state = next_state
+
+        if done or cutoff:
+            episode_lens.append(episode_len)
+            episode_rets.append(episode_ret)
+            state, episode_len, episode_ret = env.reset(), 0, 0
+            if recurrent:
+                algorithm.reinitialize_hidden()
+
+        if episode_len == 0 or (not recurrent and chunk_len is not None and len(fields['r']) == chunk_len):
+            chunks.put(Chunk(
+                **{key: np.stack(values) for key, values in fields.items() if key != 'hidden_states'},
+                hidden_states=np.stack(fields['hidden_states']) if stores_hidden_states else None,
+                episode_lens=episode_lens, episode_rets=episode_rets
+            ))
+            fields = {key: [] for key in fields}
+            episode_lens, episode_rets = [], []
+
+    env.close()
+
+
+class ActorPool:
+
+    """
+    num_actors actor processes (see run_actor), each with its own env built from env_fn, collecting data with copies
+    of algorithm whose weights are refreshed from a SharedWeights every time the learner calls publish.
+
+    Actors are forked from the learner (on cpu only; cuda does not survive a fork), each with its own seed drawn from
+    numpy's global RNG, so that their exploration noise differs. env_fn is sent to them with cloudpickle.
+    """
+
+    def __init__(self, env_fn, algorithm, num_actors, update_after, chunk_len):
+
+        context = multiprocessing.get_context('fork')
+
+        self.networks = get_networks_to_share(algorithm)
+        self.weights = SharedWeights(self.networks, context)
+        self.chunks = context.Queue()
+        self.stop_event = context.Event()
+        self.env_steps = context.Value('q', 0)
+
+        self.processes = [
+            context.Process(target=run_actor, daemon=True, args=(
+                seed, cloudpickle.dumps(env_fn), algorithm, self.weights, self.chunks, self.stop_event, self.env_steps,
+                update_after, chunk_len
+            ))
+            for seed in np.random.randint(2 ** 31, size=num_actors)
+        ]
+        for process in self.processes:
+            process.start()
+
+    def publish(self, version) -> None:
+        """Makes the current weights of the learner's networks the ones that actors act with."""
+        self.weights.publish(self.networks, version)
+
+    def get(self, block) -> list:
+        """All chunks sent so far; if block, waits for at least one."""
+        chunks = []
+        try:
+            chunks.append(self.chunks.get(block=block))
+            while True:
+                chunks.append(self.chunks.get_nowait())
+        except queue.Empty:
+            return chunks
+
+    def close(self) -> None:
+        """Stops actors; chunks still on their way are dropped (a process does not exit until its chunks are read)."""
+        self.stop_event.set()
+        while any(process.is_alive() for process in self.processes):
+            try:
+                self.chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for process in self.processes:
+            process.join()
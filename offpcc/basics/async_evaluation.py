@@ -0,0 +1,123 @@
+import multiprocessing
+import queue
+from collections import deque
+
+import cloudpickle
+import numpy as np
+import torch
+
+
+def run_evaluator(seed, pickled_env_fn, algorithm, test_fn, tasks, results) -> None:
+
+    """
+    Loop of an EvaluatorPool worker: for each task (submission index, weights), loads weights into the actor networks
+    of its own copy of algorithm (unless they are already loaded) and puts (submission index, episode length, episode
+    return) of one test episode, run with test_fn, on results. Since the copy belongs to this worker, test_fn's reset of
+    its hidden states (for recurrent algorithms) does not interfere with other workers or with training.
+    """
+
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.set_num_threads(1)  # acting happens at batch size 1; leave the cores to the learner
+
+    env = cloudpickle.loads(pickled_env_fn)()
+    loaded_index = None
+
+    while True:
+
+        task = tasks.get()
+        if task is None:
+            break
+
+        index, weights = task
+        if index != loaded_index:
+            tensors = [tensor for network in algorithm.actor_networks for tensor in network.state_dict().values()]
+            for tensor, array in zip(tensors, weights):
+                tensor.copy_(torch.from_numpy(array))
+            loaded_index = index
+
+        results.put((index, *test_fn(env, algorithm)))
+
+    env.close()
+
+
+class EvaluatorPool:
+
+    """
+    num_workers worker processes (see run_evaluator), each with its own test env built from env_fn and its own copy of
+    algorithm, that run the num_episodes test episodes of each submission in parallel with training (and with each
+    other). submit sends a snapshot of the weights of the actor networks of an algorithm along with a payload (e.g.,
+    the stats of an epoch to log along with the test results); get_finished returns, in submission order, the payloads
+    of the submissions whose episodes are all done, with their episode lengths and returns.
+
+    As with ActorPool, workers are forked from the learner, so this only works on cpu.
+    """
+
+    def __init__(self, env_fn, algorithm, num_workers, num_episodes, test_fn):
+
+        context = multiprocessing.get_context('fork')
+
+        self.num_episodes = num_episodes
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.submissions = deque()  # [payload, episode lengths, episode returns] of each unfinished submission
+        self.num_submissions = 0
+
+        self.processes = [
+            context.Process(target=run_evaluator, daemon=True, args=(
+                seed, cloudpickle.dumps(env_fn), algorithm, test_fn, self.tasks, self.results
+            ))
+            for seed in np.random.randint(2 ** 31, size=num_workers)
+        ]
+        for process in self.processes:
+            process.start()
+
+    def submit(self, networks, payload) -> None:
+        tensors = [tensor for network in networks for tensor in network.state_dict().values()]
+        weights = [tensor.detach().cpu().numpy().copy() for tensor in tensors]  # a snapshot, as networks keep changing
+        for _ in range(self.num_episodes):
+            self.tasks.put((self.num_submissions, weights))
+        self.submissions.append([payload, [], []])
+        self.num_submissions += 1
+
+    @property
+    def num_unfinished(self) -> int:
+        return len(self.submissions)
+
+    def get_finished(self, block) -> list:
+        """(payload, episode lengths, episode returns) of each finished submission; if block, waits for at least one."""
+
+        first_index = self.num_submissions - len(self.submissions)  # of the oldest unfinished submission
+
+        while True:
+            try:
+                index, episode_len, episode_ret = self.results.get(block=block and self.num_finished == 0)
+            except queue.Empty:
+                break
+            _, episode_lens, episode_rets = self.submissions[index - first_index]
+            episode_lens.append(episode_len)
+            episode_rets.append(episode_ret)
+
+        return [tuple(self.submissions.popleft()) for _ in range(self.num_finished)]
+
+    @property
+    def num_finished(self) -> int:
+        """Number of the oldest submissions (in submission order) whose episodes are all done."""
+        num_finished = 0
+        for _, episode_lens, _ in self.submissions:
+            if len(episode_lens) < self.num_episodes:
+                break
+            num_finished += 1
+        return num_finished
+
+    def close(self) -> None:
+        """Stops workers (once they are done with the tasks already submitted); results not yet returned are dropped."""
+        for _ in self.processes:
+            self.tasks.put(None)
+        while any(process.is_alive() for process in self.processes):
+            try:
+                self.results.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for process in self.processes:
+            process.join()
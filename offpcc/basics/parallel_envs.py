@@ -0,0 +1,106 @@
+import multiprocessing
+
+import cloudpickle
+import numpy as np
+
+
+class SerialEnvs:
+
+    """
+    num_envs environments built from env_fn and stepped one after the other in this process, for cheap environments
+    where the round trip to a worker would cost more than a step.
+
+    Unlike gym's vector envs, there is no automatic reset: step returns the true next observation of each env (also at
+    the end of an episode), and the caller resets the envs whose episode ended with reset(indices).
+    """
+
+    def __init__(self, env_fn, num_envs):
+        self.envs = [env_fn() for _ in range(num_envs)]
+        self.num_envs = num_envs
+        self.spec = self.envs[0].spec
+        self.observation_space = self.envs[0].observation_space
+        self.action_space = self.envs[0].action_space
+
+    def reset(self, indices=None) -> np.array:
+        """Observations of the envs at indices (all envs if None) after resetting them, stacked."""
+        indices = range(self.num_envs) if indices is None else indices
+        return np.stack([self.envs[i].reset() for i in indices])
+
+    def step(self, actions: np.array) -> tuple:
+        """(next observations, rewards, dones, infos), the first three stacked and infos a list (one dict per env)."""
+        next_observations, rewards, dones, infos = zip(*[env.step(a) for env, a in zip(self.envs, actions)])
+        return np.stack(next_observations), np.array(rewards), np.array(dones), list(infos)
+
+    def close(self) -> None:
+        for env in self.envs:
+            env.close()
+
+
+def work(remote, pickled_env_fn) -> None:
+
+    """Loop of a SubprocessEnvs worker, which owns a single env."""
+
+    env = cloudpickle.loads(pickled_env_fn)()
+
+    while True:
+        command, data = remote.recv()
+        if command == 'step':
+            remote.send(env.step(data))
+        elif command == 'reset':
+            remote.send(env.reset())
+        elif command == 'get_spaces':
+            remote.send(cloudpickle.dumps((env.spec, env.observation_space, env.action_space)))
+        elif command == 'close':
+            env.close()
+            remote.close()
+            break
+
+
+class SubprocessEnvs(SerialEnvs):
+
+    """
+    Same as SerialEnvs, except that each env lives in a worker process of its own, so that expensive environments
+    (e.g., pybullet, mujoco, dm_control) step in parallel. env_fn is sent to workers with cloudpickle, so it can be a
+    closure (like env_fn in launch.py).
+
+    Commands are sent to all workers before any reply is read, so a step takes as long as the slowest env.
+    """
+
+    def __init__(self, env_fn, num_envs):
+
+        self.num_envs = num_envs
+
+        context = multiprocessing.get_context()
+        self.remotes, worker_remotes = zip(*[context.Pipe() for _ in range(num_envs)])
+        self.processes = [
+            context.Process(target=work, args=(worker_remote, cloudpickle.dumps(env_fn)), daemon=True)
+            for worker_remote in worker_remotes
+        ]
+        for process, worker_remote in zip(self.processes, worker_remotes):
+            process.start()
+            worker_remote.close()  # only the worker uses its end
+
+        self.remotes[0].send(('get_spaces', None))
+        self.spec, self.observation_space, self.action_space = cloudpickle.loads(self.remotes[0].recv())
+
+    def reset(self, indices=None) -> np.array:
+        indices = range(self.num_envs) if indices is None else indices
+        for i in indices:
+            self.remotes[i].send(('reset', None))
+        return np.stack([self.remotes[i].recv() for i in indices])
+
+    def step(self, actions: np.array) -> tuple:
+        for remote, a in zip(self.remotes, actions):
+            remote.send(('step', a))
+        next_observations, rewards, dones, infos = zip(*[remote.recv() for remote in self.remotes])
+        return np.stack(next_observations), np.array(rewards), np.array(dones), list(infos)
+
+    def close(self) -> None:
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for process in self.processes:
+            process.join()
+
+
+def make_parallel_envs(env_fn, num_envs, use_subprocesses):
+    return SubprocessEnvs(env_fn, num_envs) if use_subprocesses else SerialEnvs(env_fn, num_envs)
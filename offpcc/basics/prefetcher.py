@@ -0,0 +1,164 @@
+import gin
+import queue
+import threading
+import time
+
+import torch
+
+from basics.storage import StagingArea
+
+
+@gin.configurable(module=__name__)
+class BatchPrefetcher:
+
+    """
+    Samples the next num_batches batches from a ReplayBuffer or RecurrentReplayBuffer on a worker thread, so that
+    sampling (fancy indexing, copies to device, augmentation) overlaps with update_networks.
+
+    Each batch is materialized into one of num_batches + 2 staging areas, used in a round-robin fashion: at any time,
+    at most num_batches batches are waiting in the queue, one is being used by the learner and one is being filled,
+    so a staging area is never refilled while the learner still uses it (as long as the learner drops a batch before
+    asking for the next one, which is what train does).
+
+    On cuda, a staging area is a pair of StagingAreas: rows are first gathered into the pinned tensors of a host_only
+    one, and then copied (on a side stream, so that copies overlap with kernels of the learner) to the tensors of a
+    device one. Host order is not enough to reuse them safely, since the device runs behind the host: before its
+    copies, the side stream waits for the release event recorded on the learner's stream when the learner moved on
+    from the previous batch of the same area (i.e., after all kernels reading that batch), and before gathering into
+    the host tensors again, the worker waits for the copies out of them to be done.
+
+    All accesses to the buffer go through a lock, so push (and push_batch, update_priorities) can be called concurrently
+    from the training loop. The lock is only held while indices are drawn and rows are gathered into host tensors (and,
+    for buffers that do so, while images are augmented), not during copies to device.
+
+    Fields in HOST_FIELDS are left on the host, as update_networks expects them there: the lengths (l) of a
+    RecurrentBatch go to pack_padded_sequence, which only takes cpu lengths.
+
+    The learner's idle time removed by prefetching is the time spent sampling by the worker minus the time the
+    learner spent waiting for batches.
+    """
+
+    HOST_FIELDS = ('l',)
+
+    def __init__(self, buffer, num_batches=2, pin_memory=True):
+
+        self.buffer = buffer
+        self.lock = threading.Lock()
+
+        self.queue = queue.Queue(maxsize=num_batches)
+        self.host_staging_areas = [StagingArea(pin_memory=pin_memory, host_only=True) for _ in range(num_batches + 2)]
+
+        # on cuda, copies to device happen on a side stream so that they overlap with kernels of the learner
+
+        self.stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+
+        if self.stream is not None:
+            self.device_staging_areas = [StagingArea(pin_memory=pin_memory) for _ in range(num_batches + 2)]
+            self.copy_events = [None] * (num_batches + 2)  # recorded on the side stream after the copies of each area
+            self.release_events = [None] * (num_batches + 2)  # recorded on the learner's stream (see sample)
+            self.learner_staging_idx = None  # area of the batch being used by the learner
+
+        self.stop_event = threading.Event()
+        self.thread = None  # started on the first call to sample, when the buffer has enough data
+
+        # stats trackers (in seconds)
+
+        self.sampling_time = 0
+        self.waiting_time = 0
+
+    def push(self, *args, **kwargs) -> None:
+        with self.lock:
+            self.buffer.push(*args, **kwargs)
+
+    def push_batch(self, *args, **kwargs) -> None:
+        with self.lock:
+            self.buffer.push_batch(*args, **kwargs)
+
+    def update_priorities(self, *args, **kwargs) -> None:
+        with self.lock:
+            self.buffer.update_priorities(*args, **kwargs)
+
+    def sample_on_worker(self, staging_idx):
+
+        if self.stream is None:
+            with self.lock:
+                return self.buffer.sample(staging=self.host_staging_areas[staging_idx]), None
+
+        if self.copy_events[staging_idx] is not None:
+            self.copy_events[staging_idx].synchronize()  # the copies out of these host tensors are done
+
+        with torch.cuda.stream(self.stream):
+
+            with self.lock:
+                host_batch = self.buffer.sample(staging=self.host_staging_areas[staging_idx])
+
+            if self.release_events[staging_idx] is not None:
+                self.stream.wait_event(self.release_events[staging_idx])  # the learner is done with these tensors
+
+            device_staging = self.device_staging_areas[staging_idx]
+            batch = type(host_batch)(*[
+                device_staging.to_device(key, value)
+                if isinstance(value, torch.Tensor) and key not in self.HOST_FIELDS else value
+                for key, value in zip(host_batch._fields, host_batch)
+            ])
+
+            ready_event = torch.cuda.Event()
+            ready_event.record(self.stream)
+
+        self.copy_events[staging_idx] = ready_event
+
+        return batch, ready_event
+
+    def work(self) -> None:
+
+        staging_idx = 0
+
+        while not self.stop_event.is_set():
+
+            start_time = time.perf_counter()
+            batch, ready_event = self.sample_on_worker(staging_idx)
+            self.sampling_time += time.perf_counter() - start_time
+
+            while not self.stop_event.is_set():
+                try:
+                    self.queue.put((batch, ready_event, staging_idx), timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+
+            staging_idx = (staging_idx + 1) % len(self.host_staging_areas)
+
+    def sample(self):
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.work, daemon=True)
+            self.thread.start()
+
+        if self.stream is not None and self.learner_staging_idx is not None:
+            # the learner drops its previous batch: once the kernels issued so far are done, its area can be refilled
+            release_event = torch.cuda.Event()
+            release_event.record(torch.cuda.current_stream())
+            self.release_events[self.learner_staging_idx] = release_event
+
+        start_time = time.perf_counter()
+        batch, ready_event, staging_idx = self.queue.get()
+        self.waiting_time += time.perf_counter() - start_time
+
+        if ready_event is not None:
+            self.learner_staging_idx = staging_idx
+            # make the learner's stream wait for the copies, and tell the caching allocator that these tensors are
+            # now used on the learner's stream as well
+            ready_event.wait()
+            for tensor in batch:
+                if isinstance(tensor, torch.Tensor) and tensor.is_cuda:
+                    tensor.record_stream(torch.cuda.current_stream())
+
+        return batch
+
+    def get_idle_time_removed(self) -> float:
+        return self.sampling_time - self.waiting_time
+
+    def close(self) -> None:
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
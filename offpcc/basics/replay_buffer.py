@@ -4,12 +4,16 @@ import torch
 import torch.nn as nn
 from collections import namedtuple
 from basics.utils import get_device
+from basics.sum_tree import SumTree
+from basics.storage import ArrayStorage, StagingArea, num_bytes
+from basics.snapshot import save_snapshot, load_snapshot_state, load_snapshot_arrays
 import kornia
 # import random
 # from collections import deque
 
 Transition = namedtuple('Transition', 's a r ns d')
-Batch = namedtuple('Batch', 's a r ns d')
+Batch = namedtuple('Batch', 's a r ns d w idx')
+Batch.__new__.__defaults__ = (None, None)  # w (importance-sampling weights) and idx are only set by prioritized replay
 
 
 # @gin.configurable(module=__name__)
@@ -36,8 +40,10 @@ Batch = namedtuple('Batch', 's a r ns d')
 #         return Batch(*list(map(lambda x: x.to(get_device()), [s, a, r, ns, d])))
 
 
-def as_tensor_on_device(np_array: np.array):
-    return torch.tensor(np_array).float().to(get_device())
+def as_uint8_image(image: np.array) -> np.array:
+    if image.dtype == np.uint8:
+        return image  # raw frames
+    return np.round(np.clip(image, 0, 1) * 255).astype(np.uint8)  # frames already normalized to [0, 1]
 
 
 @gin.configurable(module=__name__)
@@ -50,26 +56,131 @@ class ReplayBuffer:
 
     For future reference, note that in pytorch images are usually stored as (bs, depth, height, width).
     Therefore, we recommend that you store channel-first images rather than channel-last images.
+
+    If deduplicate_ns is True, observations are stored only once in a single ring (self.s) and ns is rebuilt at
+    sampling time. Slot i holds the observation of step i of some episode, so the ns of a transition stored at slot
+    i is always at slot i + 1. The last ns of an episode (terminal or cutoff) takes a slot of its own from which no
+    transition starts; self.valid marks the slots from which a transition starts. Therefore, with this option, the
+    buffer holds slightly fewer than capacity transitions (one slot is spent per episode).
+
+    If store_img_as_uint8 is True (image observations only), frames are stored as uint8 (4x smaller than float32)
+    and only the sampled minibatch is converted to float and divided by 255, after being copied to device. Frames
+    can be pushed either raw (uint8) or already normalized to [0, 1] (e.g., by Normalize255Image), in which case they
+    are rounded to the nearest multiple of 1 / 255. Batches are float32 in [0, 1] in both cases, so nothing needs to
+    change on the algorithm side.
+
+    If frame_stack > 1 (image observations produced by ConcatImages(window_size=frame_stack) only), only the newest
+    frame of each observation is stored, in the single ring described above (deduplicate_ns is implied). Stacked s
+    and ns are rebuilt at sampling time from the frame_stack slots ending at i and i + 1 respectively; frames from
+    before the start of an episode are zeros, just like what ConcatImages.reset does. Each frame is then stored once
+    instead of 2 * frame_stack times.
+
+    If prioritized is True, transitions are sampled proportionally to their priority (|td error| + priority_eps) **
+    priority_exponent, which is kept in a sum tree (Schaul et al., 2016). Batches then also contain importance-sampling
+    weights (w) and the sampled indices (idx), which should be handed back to update_priorities together with the
+    td errors returned by update_networks(b, return_td_errors=True). New transitions get the max priority seen so far.
+
+    If storage is 'memmap', placeholder arrays are memory-mapped files under memmap_dir (see ArrayStorage), so that
+    capacity can exceed RAM. Sampled indices are then sorted (the order within a batch does not matter) so that
+    reads sweep the files in one direction, and sample_chunk_len > 1 can be used to draw batches as blocks of
+    consecutive slots, touching far fewer pages per batch at the cost of correlated samples within a block.
+
+    If storage is 'device', placeholders are torch tensors on the compute device; indices are then drawn with a torch
+    generator (seeded from numpy's global RNG on creation) and batches are gathered without touching numpy. This is
+    meant for small vector observations (e.g., pendulum, cartpole, water-maze), so it does not support the options
+    above that keep numpy metadata (deduplicate_ns, frame_stack, prioritized) or images.
+
+    save and load write / read a snapshot of the filled region only (see basics/snapshot.py), e.g., to survive the
+    preemption of a long run.
     """
 
-    def __init__(self, input_shape, action_dim, capacity=int(1e6), batch_size=100, use_aug_for_img=True):
+    def __init__(
+        self,
+        input_shape,
+        action_dim,
+        capacity=int(1e6),
+        batch_size=100,
+        use_aug_for_img=True,
+        deduplicate_ns=False,
+        store_img_as_uint8=False,
+        frame_stack=1,
+        prioritized=False,
+        priority_exponent=0.6,
+        importance_sampling_exponent=0.4,
+        priority_eps=1e-6,
+        storage='memory',
+        memmap_dir=None,
+        sample_chunk_len=1
+    ):
 
         self.input_shape = input_shape
         self.action_dim = action_dim
         self.capacity = capacity
         self.batch_size = batch_size
         self.use_aug_for_img = use_aug_for_img
+        self.deduplicate_ns = deduplicate_ns or frame_stack > 1
+        self.store_img_as_uint8 = store_img_as_uint8
+        self.frame_stack = frame_stack
+        self.prioritized = prioritized
+        self.priority_exponent = priority_exponent
+        self.importance_sampling_exponent = importance_sampling_exponent
+        self.priority_eps = priority_eps
+        self.storage = ArrayStorage(backend=storage, memmap_dir=memmap_dir)
+        self.sample_chunk_len = sample_chunk_len
 
         assert len(self.input_shape) == 1 or len(self.input_shape) == 3  # vector or image (nothing else)
 
-        self.s = np.empty((capacity, *input_shape), dtype=np.float32)
-        self.a = np.empty((capacity, action_dim), dtype=np.float32)
-        self.r = np.empty((capacity, 1), dtype=np.float32)
-        self.ns = np.empty((capacity, *input_shape), dtype=np.float32)
-        self.d = np.empty((capacity, 1), dtype=np.float32)
+        if self.store_img_as_uint8:
+            assert len(self.input_shape) == 3, "store_img_as_uint8 only makes sense for image observations"
+            obs_dtype = np.uint8
+        else:
+            obs_dtype = np.float32
+
+        if self.frame_stack > 1:
+            assert len(self.input_shape) == 3, "frame_stack only makes sense for image observations"
+            assert self.input_shape[0] % self.frame_stack == 0
+            self.frame_shape = (self.input_shape[0] // self.frame_stack, *self.input_shape[1:])
+        else:
+            self.frame_shape = self.input_shape
+
+        assert self.batch_size % self.sample_chunk_len == 0
+
+        if self.storage.backend == 'device':
+            assert len(self.input_shape) == 1, "device storage is meant for vector observations"
+            assert not (self.deduplicate_ns or self.prioritized), "device storage only supports the plain layout"
+            self.generator = torch.Generator(device=get_device())
+            self.generator.manual_seed(np.random.randint(2 ** 31))
+
+        self.s = self.storage.empty('s', (capacity, *self.frame_shape), dtype=obs_dtype)
+        self.a = self.storage.empty('a', (capacity, action_dim), dtype=np.float32)
+        self.r = self.storage.empty('r', (capacity, 1), dtype=np.float32)
+        self.d = self.storage.empty('d', (capacity, 1), dtype=np.float32)
+
+        if self.deduplicate_ns:
+            self.ns = None  # rebuilt from self.s at sampling time
+            # small metadata arrays always stay in RAM
+            self.valid = np.zeros((capacity,), dtype=bool)  # whether a transition starts at this slot
+            self.ep_step = np.zeros((capacity,), dtype=np.int32)  # index of the observation within its episode
+            self.starting_new_episode = True
+        else:
+            self.ns = self.storage.empty('ns', (capacity, *input_shape), dtype=obs_dtype)
+
+        # zero-copy tensor views of the placeholders, which sampled rows are gathered from
+
+        self.s_tensor = self.storage.as_tensor(self.s)
+        self.a_tensor = self.storage.as_tensor(self.a)
+        self.r_tensor = self.storage.as_tensor(self.r)
+        self.d_tensor = self.storage.as_tensor(self.d)
+        self.ns_tensor = None if self.deduplicate_ns else self.storage.as_tensor(self.ns)
+
+        self.staging = StagingArea()
 
         self.ptr = 0
-        self.num_transitions = 0
+        self.num_transitions = 0  # with deduplicate_ns, this is the number of filled slots
+
+        if self.prioritized:
+            self.sum_tree = SumTree(capacity)  # slots from which no transition starts have zero priority
+            self.max_priority = 1.0
 
         if len(self.input_shape) == 3 and self.use_aug_for_img:
 
@@ -85,35 +196,292 @@ class ReplayBuffer:
                 kornia.augmentation.RandomCrop((self.input_shape[1], self.input_shape[2]))
             )
 
-    def push(self, s, a, r, ns, d):
+    def get_storage_size_in_gb(self) -> tuple:
+        """(GB taken by the arrays of the buffer, GB they would take with full s and ns for each transition)."""
+        arrays = [self.s, self.a, self.r, self.d]
+        if self.deduplicate_ns:
+            arrays.extend([self.valid, self.ep_step])
+        else:
+            arrays.append(self.ns)
+        actual_num_bytes = sum(num_bytes(array) for array in arrays)
+        naive_num_bytes = num_bytes(self.a) + num_bytes(self.r) + num_bytes(self.d) + \
+            2 * self.capacity * int(np.prod(self.input_shape)) * self.s_tensor.element_size()
+        return actual_num_bytes / 1024 ** 3, naive_num_bytes / 1024 ** 3
+
+    def store_obs(self, slot, obs, ep_step) -> None:
+        """Used when deduplicate_ns is True. Also invalidates the transitions that relied on the overwritten slot."""
+        self.s[slot] = obs[-self.frame_shape[0]:] if self.frame_stack > 1 else obs  # newest frame is the last one
+        self.ep_step[slot] = ep_step
+        # no transition starts here until its action gets pushed; the transitions starting at the next
+        # (frame_stack - 1) slots would have rebuilt their s from the old content of this slot
+        invalidated_slots = (slot + np.arange(self.frame_stack)) % self.capacity
+        self.valid[invalidated_slots] = False
+        if self.prioritized:
+            self.sum_tree.update(invalidated_slots, 0)
+        self.num_transitions = max(self.num_transitions, slot + 1)
+
+    def push(self, s, a, r, ns, d, cutoff=False):
+
+        """cutoff only matters when deduplicate_ns is True, where episode boundaries need to be known."""
 
         assert s.shape == self.input_shape
         assert len(a) == self.action_dim
 
-        self.s[self.ptr] = s
-        self.a[self.ptr] = a
-        self.r[self.ptr] = r
-        self.ns[self.ptr] = ns
-        self.d[self.ptr] = d
+        if self.store_img_as_uint8:
+            s, ns = as_uint8_image(s), as_uint8_image(ns)
+
+        if self.storage.backend == 'device':
+            s, a, ns, r, d = torch.as_tensor(s), torch.as_tensor(a), torch.as_tensor(ns), float(r), float(d)
+
+        if self.deduplicate_ns:
+
+            if self.starting_new_episode:
+                self.store_obs(self.ptr, s, ep_step=0)  # otherwise, s is already stored as the previous ns
+                self.starting_new_episode = False
+
+            self.a[self.ptr] = a
+            self.r[self.ptr] = r
+            self.d[self.ptr] = d
+            self.valid[self.ptr] = True
+            if self.prioritized:
+                self.sum_tree.update_one(self.ptr, self.max_priority)
+
+            # the slot after is overwritten by ns; the transition that used to start there is lost
+
+            ns_slot = (self.ptr + 1) % self.capacity
+            self.store_obs(ns_slot, ns, ep_step=self.ep_step[self.ptr] + 1)
+            self.ptr = ns_slot
+
+            if d or cutoff:
+                # keep the last ns of this episode; the next episode starts from a fresh slot
+                self.ptr = (self.ptr + 1) % self.capacity
+                self.starting_new_episode = True
+
+        else:
+
+            self.s[self.ptr] = s
+            self.a[self.ptr] = a
+            self.r[self.ptr] = r
+            self.ns[self.ptr] = ns
+            self.d[self.ptr] = d
+            if self.prioritized:
+                self.sum_tree.update_one(self.ptr, self.max_priority)
+
+            self.ptr = (self.ptr + 1) % self.capacity
+            if self.num_transitions < self.capacity:
+                self.num_transitions += 1
+
+    def push_batch(self, s, a, r, ns, d, cutoff=None) -> None:
+
+        """
+        Vectorized push of many transitions at once (e.g., an offline dataset, random-exploration warmup data or
+        the transitions of several environments), in the order in which they should enter the ring. Arrays have a
+        leading dimension of size num_transitions; r, d and cutoff can be of shape (num_transitions,) or
+        (num_transitions, 1). If there are more transitions than capacity, only the last capacity of them are kept.
+
+        With deduplicate_ns, where slots depend on episode boundaries, this goes through push one transition at a
+        time, so consecutive transitions must then belong to the same episode until d or cutoff.
+        """
+
+        num_transitions = len(s)
+        assert s.shape[1:] == self.input_shape
+        assert a.shape == (num_transitions, self.action_dim)
+
+        if self.deduplicate_ns:
+            cutoff = np.zeros((num_transitions,), dtype=bool) if cutoff is None else np.asarray(cutoff).reshape(-1)
+            d = np.asarray(d).reshape(-1)
+            r = np.asarray(r).reshape(-1)
+            for i in range(num_transitions):
+                self.push(s[i], a[i], r[i], ns[i], d[i], cutoff[i])
+            return
+
+        if self.store_img_as_uint8:
+            s, ns = as_uint8_image(s), as_uint8_image(ns)
+
+        r = np.asarray(r, dtype=np.float32).reshape(num_transitions, 1)
+        d = np.asarray(d, dtype=np.float32).reshape(num_transitions, 1)
+
+        # older transitions would be overwritten within this very call anyway
+
+        num_skipped = max(0, num_transitions - self.capacity)
+        self.ptr = (self.ptr + num_skipped) % self.capacity
+        num_transitions -= num_skipped
+
+        fields = [(self.s, s), (self.a, a), (self.r, r), (self.ns, ns), (self.d, d)]
 
-        self.ptr = (self.ptr + 1) % self.capacity
-        if self.num_transitions < self.capacity:
-            self.num_transitions += 1
+        # the ring wraps around at most once, so each field is written as (at most) two contiguous blocks
 
-    def sample(self):
+        num_before_wrap = min(num_transitions, self.capacity - self.ptr)
+        for placeholder, values in fields:
+            values = values[num_skipped:]
+            if self.storage.backend == 'device':
+                values = torch.as_tensor(values)
+            placeholder[self.ptr:self.ptr + num_before_wrap] = values[:num_before_wrap]
+            placeholder[:num_transitions - num_before_wrap] = values[num_before_wrap:]
+
+        if self.prioritized:
+            self.sum_tree.update((self.ptr + np.arange(num_transitions)) % self.capacity, self.max_priority)
+
+        self.ptr = (self.ptr + num_transitions) % self.capacity
+        self.num_transitions = min(self.capacity, self.num_transitions + num_transitions)
+
+    def get_snapshot_arrays(self, num_transitions) -> dict:
+        """Views of the first num_transitions slots of each array that a snapshot holds."""
+        arrays = dict(s=self.s, a=self.a, r=self.r, d=self.d)
+        if self.deduplicate_ns:
+            arrays.update(valid=self.valid, ep_step=self.ep_step)
+        else:
+            arrays.update(ns=self.ns)
+        if self.prioritized:
+            arrays.update(priorities=self.sum_tree.leaves)
+        return {name: array[:num_transitions] for name, array in arrays.items()}
+
+    def save(self, save_dir, compress=False) -> None:
+
+        """
+        Saves the filled slots, the pointers and the state of the RNG used for sampling (numpy's global RNG, or the
+        torch generator of device storage) to save_dir. Arrays are streamed chunk by chunk, so saving does not need
+        any extra memory beyond one chunk; compress (zlib) trades saving / loading speed for disk space.
+        """
+
+        state = dict(ptr=self.ptr, num_transitions=self.num_transitions, numpy_rng_state=np.random.get_state())
+        if self.deduplicate_ns:
+            state.update(starting_new_episode=self.starting_new_episode)
+        if self.prioritized:
+            state.update(max_priority=self.max_priority)
+        if self.storage.backend == 'device':
+            state.update(torch_rng_state=self.generator.get_state())
+
+        save_snapshot(save_dir, self.get_snapshot_arrays(self.num_transitions), state, compress)
+
+    def load(self, save_dir) -> None:
+
+        """
+        Loads a snapshot written by save (with the same input_shape, action_dim, capacity and options) in place. The
+        episode being pushed when saving (if any) is considered cut off, since a resumed run starts a new one.
+        """
+
+        state = load_snapshot_state(save_dir)
+        load_snapshot_arrays(save_dir, self.get_snapshot_arrays(state['num_transitions']), state)
+
+        self.ptr = state['ptr']
+        self.num_transitions = state['num_transitions']
+        np.random.set_state(state['numpy_rng_state'])
+
+        if self.deduplicate_ns and not state['starting_new_episode']:
+            self.ptr = (self.ptr + 1) % self.capacity  # keep the last ns stored, just like push does on cutoff
+            self.starting_new_episode = True
+        if self.prioritized:
+            self.max_priority = state['max_priority']
+            self.sum_tree.rebuild()
+        if self.storage.backend == 'device':
+            self.generator.set_state(state['torch_rng_state'])
+
+    def sample_indices(self) -> np.array:
+
+        if self.prioritized:
+
+            # stratified: one prefix sum drawn uniformly from each of batch_size equal-mass segments
+            segment_mass = self.sum_tree.total / self.batch_size
+            prefix_sums = (np.arange(self.batch_size) + np.random.rand(self.batch_size)) * segment_mass
+            indices = self.sum_tree.find(prefix_sums)
+
+        else:
+
+            if self.sample_chunk_len > 1:
+                starts = np.random.randint(self.num_transitions, size=self.batch_size // self.sample_chunk_len)
+                indices = (starts[:, np.newaxis] + np.arange(self.sample_chunk_len)[np.newaxis, :]).reshape(-1)
+                indices %= self.num_transitions
+            else:
+                indices = np.random.randint(self.num_transitions, size=self.batch_size)
+
+            if self.deduplicate_ns:
+                # re-draw the (few) slots from which no transition starts, i.e., the slot holding the last ns of an
+                # episode and the slot holding the ns of the most recent transition
+                invalid = ~self.valid[indices]
+                while invalid.any():
+                    indices[invalid] = np.random.randint(self.num_transitions, size=int(invalid.sum()))
+                    invalid = ~self.valid[indices]
+
+        if self.storage.backend == 'memmap':
+            indices.sort()  # sequential reads from the files
+
+        return indices
+
+    def get_importance_sampling_weights(self, indices) -> np.array:
+        probas = self.sum_tree.get(indices) / self.sum_tree.total
+        weights = (self.num_transitions * probas) ** (- self.importance_sampling_exponent)
+        return weights / np.max(weights)  # normalize by the max weight within the batch (only ever scales down)
+
+    def update_priorities(self, indices, td_errors) -> None:
+        priorities = (np.abs(td_errors) + self.priority_eps) ** self.priority_exponent
+        self.max_priority = max(self.max_priority, float(np.max(priorities)))
+        if self.deduplicate_ns:
+            priorities = np.where(self.valid[indices], priorities, 0)  # the slot may have been overwritten since
+        self.sum_tree.update(indices, priorities)
+
+    def gather_obs(self, slots, staging: StagingArea, key: str) -> torch.tensor:
+
+        """Used when deduplicate_ns is True. Rebuilds the (stacked) observations stored at slots."""
+
+        if self.frame_stack == 1:
+            return staging.gather(key, self.s_tensor, torch.from_numpy(slots), dtype=self.s_tensor.dtype)
+
+        # (bs, frame_stack) grid of slots holding the frames of each observation, oldest frame first
+
+        offsets = np.arange(self.frame_stack - 1, -1, -1)
+        frame_slots = (slots[:, np.newaxis] - offsets[np.newaxis, :]) % self.capacity
+
+        frames = staging.host(key, (len(slots), self.frame_stack, *self.frame_shape), dtype=self.s_tensor.dtype)
+        frame_slots = torch.from_numpy(frame_slots.reshape(-1))
+        torch.index_select(self.s_tensor, 0, frame_slots, out=frames.view(-1, *self.frame_shape))
+
+        before_episode_start = self.ep_step[slots][:, np.newaxis] < offsets[np.newaxis, :]
+        frames[torch.from_numpy(before_episode_start)] = 0
+
+        return staging.to_device(key, frames.view(len(slots), *self.input_shape))
+
+    def sample(self, staging: StagingArea = None):
+
+        """
+        Batch tensors are materialized in staging (self.staging by default; see StagingArea), which means that they
+        are only valid until the next call to sample with the same staging.
+        """
 
         assert self.num_transitions >= self.batch_size
 
-        indices = np.random.randint(self.num_transitions, size=self.batch_size)
-        s = as_tensor_on_device(self.s[indices]).view(self.batch_size, *self.input_shape)
-        a = as_tensor_on_device(self.a[indices]).view(self.batch_size, self.action_dim)
-        r = as_tensor_on_device(self.r[indices]).view(self.batch_size, 1)
-        ns = as_tensor_on_device(self.ns[indices]).view(self.batch_size, *self.input_shape)
-        d = as_tensor_on_device(self.d[indices]).view(self.batch_size, 1)
+        staging = self.staging if staging is None else staging
+
+        if self.storage.backend == 'device':
+            indices_tensor = torch.randint(
+                self.num_transitions, size=(self.batch_size,), generator=self.generator, device=get_device()
+            )
+        else:
+            indices = self.sample_indices()
+            indices_tensor = torch.from_numpy(indices)
+
+        if self.deduplicate_ns:
+            s = self.gather_obs(indices, staging, 's')
+            ns = self.gather_obs((indices + 1) % self.capacity, staging, 'ns')
+        else:
+            s = staging.gather('s', self.s_tensor, indices_tensor, dtype=self.s_tensor.dtype)
+            ns = staging.gather('ns', self.ns_tensor, indices_tensor, dtype=self.ns_tensor.dtype)
+
+        if self.store_img_as_uint8:
+            s = staging.as_normalized_image('s', s)
+            ns = staging.as_normalized_image('ns', ns)
+
+        a = staging.gather('a', self.a_tensor, indices_tensor)
+        r = staging.gather('r', self.r_tensor, indices_tensor)
+        d = staging.gather('d', self.d_tensor, indices_tensor)
 
         if len(self.input_shape) == 3 and self.use_aug_for_img:
             with torch.no_grad():
                 s = self.augmentator(s)
                 ns = self.augmentator(ns)
 
+        if self.prioritized:
+            w = staging.from_numpy('w', self.get_importance_sampling_weights(indices).reshape(self.batch_size, 1))
+            return Batch(s, a, r, ns, d, w, indices)
+
         return Batch(s, a, r, ns, d)
@@ -3,25 +3,76 @@ import gin
 from collections import namedtuple
 import numpy as np
 import torch
+import torch.nn as nn
+import kornia
 
-from basics.utils import get_device
+from basics.replay_buffer import as_uint8_image
+from basics.storage import ArrayStorage, StagingArea
+from basics.sum_tree import SumTree
+from basics.snapshot import save_snapshot, load_snapshot_state, load_snapshot_arrays
 
 
-RecurrentBatch = namedtuple('RecurrentBatch', 'o a r d m')
+# l (number of valid steps of each item) is only set if return_lengths; h (stored hidden states at the start of the
+# burn-in prefix), bo (observations of the burn-in prefix) and bm (mask of the burn-in prefix) only if hidden_state_size
+RecurrentBatch = namedtuple('RecurrentBatch', 'o a r d m l h bo bm')
+RecurrentBatch.__new__.__defaults__ = (None, None, None, None)
 
 
 def as_probas(positive_values: np.array) -> np.array:
     return positive_values / np.sum(positive_values)
 
 
-def as_tensor_on_device(np_array: np.array):
-    return torch.tensor(np_array).float().to(get_device())
-
-
 @gin.configurable(module=__name__)
 class RecurrentReplayBuffer:
 
-    """Use this version when num_bptt == max_episode_len"""
+    """
+    Use this version when num_bptt == max_episode_len
+
+    Episodes are stored one after the other in flat (num_rows, dim) arrays. The episode in episode slot k spans rows
+    ep_offset[k] to ep_offset[k] + ep_len[k] included; its last row only holds the final observation (a, r and d are
+    unused there). Episodes are evicted first-in-first-out, and sampled batches are padded (with zeros, and m = 0)
+    up to the longest episode (or to segment_len) in the batch.
+
+    If ragged is False, each episode is given max_episode_len + 1 rows and capacity is a number of episodes, exactly
+    like with (capacity, max_episode_len + 1, dim) placeholders. If ragged is True, each episode only takes
+    ep_len + 1 rows out of the same capacity * (max_episode_len + 1) rows, and the oldest episodes are evicted only
+    when their rows are needed; for envs with early termination (e.g., cartpole-balance, pbc bump envs), the same
+    memory then holds many more episodes.
+
+    If return_lengths is True, batches also contain the number of valid steps of each item (l, an int64 tensor on
+    cpu, as expected by pack_padded_sequence), with which recurrent algorithms skip padded steps (see Summarizer and
+    select_valid_timesteps).
+
+    Episodes are sampled proportionally to their length, through a sum tree over episode slots (see SumTree) whose
+    leaves are updated when an episode is completed or evicted, so that sampling a batch is O(batch_size * log
+    num_episode_slots) instead of O(num_episode_slots). Leaves can be scaled by per-episode priorities if needed.
+
+    If num_length_buckets > 1, episodes are also grouped by length into num_length_buckets log-spaced buckets over
+    [1, max_episode_len] (so that the longest episode of a bucket is at most about max_episode_len **
+    (1 / num_length_buckets) times longer than the shortest one), each with its own sum tree, and each batch is drawn
+    from a single bucket: the bucket is drawn with probability proportional to the total length of its episodes, then
+    items are drawn proportionally to their length within the bucket. Each item is then still drawn proportionally to
+    its length overall (only items of the same batch are no longer independent), while episodes of a batch have
+    similar lengths, so that full-episode batches (padded up to the longest episode in the batch) waste fewer padded
+    steps. padding_ratio holds the fraction of padded steps of the last sampled batch.
+
+    If storage is 'memmap', placeholder arrays are memory-mapped files under memmap_dir (see ArrayStorage), so that
+    capacity can exceed RAM. Each episode occupies a contiguous block of each file, so sampling an episode (or a
+    segment of it) only touches a few consecutive pages.
+
+    save and load write / read a snapshot of the filled rows and episode slots only (see basics/snapshot.py), e.g.,
+    to survive the preemption of a long run.
+
+    If hidden_state_size > 0 (segment_len only, not ragged), push also takes the (flattened) hidden states of the
+    agent's summarizers before o, recorded during collection, and keeps those at the start of the burn-in prefix of
+    each segment, i.e., burn_in steps before each segment start (R2D2-style). Batches then also contain these hidden
+    states (h) and the burn_in observations before each segment (bo, with mask bm), so that algorithms can start
+    segments from the stored states, refreshed by a burn-in pass without gradients, instead of from zeros. Since
+    burn_in <= segment_len, the prefix is either complete, or empty (bm = 0) for the first segment of an episode,
+    which starts from the zero state anyway.
+    """
+
+    o_dtype = np.float32
 
     def __init__(
         self,
@@ -31,27 +82,72 @@ class RecurrentReplayBuffer:
         segment_len=None,  # for non-overlapping truncated bptt, maybe need a large batch size
         capacity=gin.REQUIRED,
         batch_size=gin.REQUIRED,
+        storage='memory',
+        memmap_dir=None,
+        ragged=False,
+        return_lengths=False,
+        num_length_buckets=1,
+        hidden_state_size=0,
+        burn_in=0
     ):
 
         # placeholders
 
-        self.o = np.zeros((capacity, max_episode_len + 1, o_dim))
-        self.a = np.zeros((capacity, max_episode_len, a_dim))
-        self.r = np.zeros((capacity, max_episode_len, 1))
-        self.d = np.zeros((capacity, max_episode_len, 1))
-        self.m = np.zeros((capacity, max_episode_len, 1))
-        self.ep_len = np.zeros((capacity,))
-        self.ready_for_sampling = np.zeros((capacity,))
+        assert storage != 'device', "device storage is only supported by ReplayBuffer"
+        self.storage = ArrayStorage(backend=storage, memmap_dir=memmap_dir)
+
+        self.num_rows = capacity * (max_episode_len + 1)
+        self.o_shape = tuple(int(size) for size in np.atleast_1d(o_dim))  # (o_dim,), or (c, h, w) for subclasses
+
+        # float32, since batches are float32 anyway
+
+        self.o = self.storage.zeros('o', (self.num_rows, *self.o_shape), dtype=self.o_dtype)
+        self.a = self.storage.zeros('a', (self.num_rows, a_dim), dtype=np.float32)
+        self.r = self.storage.zeros('r', (self.num_rows, 1), dtype=np.float32)
+        self.d = self.storage.zeros('d', (self.num_rows, 1), dtype=np.float32)
+
+        # stored hidden states, one per segment of each episode (the first one, for step 0, is always zeros)
+
+        if hidden_state_size > 0:
+            assert segment_len is not None and not ragged, "stored hidden states need segment_len and ragged=False"
+            assert 0 <= burn_in <= segment_len
+            self.h = self.storage.zeros(
+                'h', (capacity, max_episode_len // segment_len, hidden_state_size), dtype=np.float32
+            )
+            self.h_tensor = torch.from_numpy(self.h).view(-1, hidden_state_size)
+
+        # episode slots; every episode takes at least 2 rows, plus one slot for the episode being pushed
+
+        self.num_episode_slots = self.num_rows // 2 + 1 if ragged else capacity
+
+        self.ep_offset = np.zeros((self.num_episode_slots,), dtype=np.int64)
+        self.ep_len = np.zeros((self.num_episode_slots,), dtype=np.int64)
+        self.ready_for_sampling = np.zeros((self.num_episode_slots,), dtype=bool)
+        self.sum_tree = SumTree(self.num_episode_slots)  # ep_len of stored episodes, 0 elsewhere
+        self.bucket_trees = [SumTree(self.num_episode_slots) for _ in range(num_length_buckets)] \
+            if num_length_buckets > 1 else []  # same, but only for the episodes in each length bucket
+
+        # zero-copy tensor views of the placeholders, which sampled steps are gathered from
+
+        self.o_tensor = torch.from_numpy(self.o)
+        self.a_tensor = torch.from_numpy(self.a)
+        self.r_tensor = torch.from_numpy(self.r)
+        self.d_tensor = torch.from_numpy(self.d)
+
+        self.staging = StagingArea()
 
         # pointers
 
         self.episode_ptr = 0
         self.time_ptr = 0
+        self.row_ptr = 0  # first row of the next episode (ragged only)
 
         # trackers
 
         self.starting_new_episode = True
-        self.num_episodes = 0
+        self.num_episodes = 0  # the stored (complete) episodes are in the num_episodes slots before episode_ptr
+        self.num_rows_used = 0  # high-water marks, for snapshots
+        self.num_episode_slots_used = 0
 
         # hyper-parameters
 
@@ -59,6 +155,12 @@ class RecurrentReplayBuffer:
         self.o_dim = o_dim
         self.a_dim = a_dim
         self.batch_size = batch_size
+        self.ragged = ragged
+        self.return_lengths = return_lengths
+        self.num_length_buckets = num_length_buckets
+        self.padding_ratio = 0.0
+        self.hidden_state_size = hidden_state_size
+        self.burn_in = burn_in
 
         self.max_episode_len = max_episode_len
 
@@ -67,119 +169,394 @@ class RecurrentReplayBuffer:
 
         self.segment_len = segment_len
 
-    def push(self, o, a, r, no, d, cutoff):
+    def length_buckets(self, ep_lens):
+        buckets = (np.log(ep_lens) / np.log(self.max_episode_len + 1) * self.num_length_buckets).astype(np.int64)
+        return np.minimum(buckets, self.num_length_buckets - 1)
+
+    def update_sampling_weight(self, episode_ptr, weight) -> None:
+        self.sum_tree.update_one(episode_ptr, weight)
+        if self.num_length_buckets > 1:
+            self.bucket_trees[self.length_buckets(self.ep_len[episode_ptr])].update_one(episode_ptr, weight)
+
+    def evict_oldest_episode(self) -> None:
+        oldest_episode_ptr = (self.episode_ptr - self.num_episodes) % self.num_episode_slots
+        self.ready_for_sampling[oldest_episode_ptr] = False
+        self.update_sampling_weight(oldest_episode_ptr, 0)
+        self.num_episodes -= 1
+
+    def evict_episodes_overlapping(self, start_row, end_row) -> None:
+
+        """
+        Evicts the stored episodes with rows in [start_row, end_row) before these rows get overwritten. Since rows are
+        written in a circular fashion, those are always the oldest ones.
+        """
+
+        while self.num_episodes > 0:
+            oldest_episode_ptr = (self.episode_ptr - self.num_episodes) % self.num_episode_slots
+            oldest_start_row = self.ep_offset[oldest_episode_ptr]
+            oldest_end_row = oldest_start_row + self.ep_len[oldest_episode_ptr] + 1
+            if oldest_start_row >= end_row or oldest_end_row <= start_row:
+                break
+            self.evict_oldest_episode()
+
+    def start_episode(self) -> None:
+
+        if self.num_episodes == self.num_episode_slots:
+            self.evict_oldest_episode()  # its slot is episode_ptr
+
+        if self.ragged:
+            if self.row_ptr + self.max_episode_len + 1 > self.num_rows:
+                # episodes are contiguous, so the next one starts over from the first row if it may not fit;
+                # the rows left at the end are given up (until the next time around)
+                self.evict_episodes_overlapping(self.row_ptr, self.num_rows)
+                self.row_ptr = 0
+            self.ep_offset[self.episode_ptr] = self.row_ptr
+        else:
+            self.ep_offset[self.episode_ptr] = self.episode_ptr * (self.max_episode_len + 1)
+
+        self.ep_len[self.episode_ptr] = 0
+        self.ready_for_sampling[self.episode_ptr] = False
+        self.num_episode_slots_used = max(self.num_episode_slots_used, self.episode_ptr + 1)
 
-        # zero-out current slot at the beginning of an episode
+        self.starting_new_episode = False
+
+    def end_episode(self) -> None:
+
+        self.ready_for_sampling[self.episode_ptr] = True
+        self.update_sampling_weight(self.episode_ptr, self.ep_len[self.episode_ptr])
+        self.row_ptr = self.ep_offset[self.episode_ptr] + self.ep_len[self.episode_ptr] + 1
+
+        # reset pointers
+
+        self.episode_ptr = (self.episode_ptr + 1) % self.num_episode_slots
+        self.time_ptr = 0
+
+        # update trackers
+
+        self.starting_new_episode = True
+        self.num_episodes += 1
+
+    def store_hidden_states(self, time_steps: np.array, hidden_states: np.array) -> None:
+        """Keeps the hidden states (before each of time_steps) that are at the start of a burn-in prefix."""
+        segments, offsets = np.divmod(time_steps + self.burn_in, self.segment_len)
+        keep = (offsets == 0) & (segments >= 1) & (segments < self.h.shape[1])
+        self.h[self.episode_ptr, segments[keep]] = hidden_states[keep]
+
+    def push(self, o, a, r, no, d, cutoff, hidden_state=None):
 
         if self.starting_new_episode:
+            self.start_episode()
 
-            self.o[self.episode_ptr] = 0
-            self.a[self.episode_ptr] = 0
-            self.r[self.episode_ptr] = 0
-            self.d[self.episode_ptr] = 0
-            self.m[self.episode_ptr] = 0
-            self.ep_len[self.episode_ptr] = 0
-            self.ready_for_sampling[self.episode_ptr] = 0
+        assert self.time_ptr < self.max_episode_len, "episode longer than max_episode_len"
 
-            self.starting_new_episode = False
+        row = self.ep_offset[self.episode_ptr] + self.time_ptr
+        num_rows_to_write = 2 if (d or cutoff) else 1
+        self.evict_episodes_overlapping(row, row + num_rows_to_write)
+        self.num_rows_used = max(self.num_rows_used, row + num_rows_to_write)
 
         # fill placeholders
 
-        self.o[self.episode_ptr, self.time_ptr] = o
-        self.a[self.episode_ptr, self.time_ptr] = a
-        self.r[self.episode_ptr, self.time_ptr] = r
-        self.d[self.episode_ptr, self.time_ptr] = d
-        self.m[self.episode_ptr, self.time_ptr] = 1
+        self.o[row] = o
+        self.a[row] = a
+        self.r[row] = r
+        self.d[row] = d
         self.ep_len[self.episode_ptr] += 1
 
+        if self.hidden_state_size > 0:
+            self.store_hidden_states(np.array([self.time_ptr]), np.reshape(hidden_state, (1, -1)))
+
         if d or cutoff:
 
-            # fill placeholders
+            self.o[row + 1] = no
+            self.end_episode()
 
-            self.o[self.episode_ptr, self.time_ptr+1] = no
-            self.ready_for_sampling[self.episode_ptr] = 1
+        else:
 
-            # reset pointers
+            # update pointers
 
-            self.episode_ptr = (self.episode_ptr + 1) % self.capacity
-            self.time_ptr = 0
+            self.time_ptr += 1
 
-            # update trackers
+    def push_batch(self, o, a, r, no, d, cutoff, hidden_states=None) -> None:
+
+        """
+        Vectorized push of consecutive transitions (e.g., an offline dataset or random-exploration warmup data), which
+        may continue the episode being pushed, span several episodes and end in the middle of one. Arrays have a
+        leading dimension of size num_transitions; r, d and cutoff can be of shape (num_transitions,) or
+        (num_transitions, 1). Each episode is written with one slice assignment per field. hidden_states, of shape
+        (num_transitions, hidden_state_size), is needed if hidden_state_size > 0 (see push).
+        """
+
+        num_transitions = len(o)
+        r = np.asarray(r, dtype=np.float32).reshape(num_transitions, 1)
+        d = np.asarray(d, dtype=np.float32).reshape(num_transitions, 1)
+        is_end = np.logical_or(d[:, 0], np.asarray(cutoff).reshape(-1))
+        ends = np.flatnonzero(is_end)
+
+        # consecutive runs of transitions that belong to the same episode
+
+        run_starts = np.concatenate([[0], ends + 1])
+        run_ends = np.concatenate([ends + 1, [num_transitions]])
+
+        for start, end in zip(run_starts, run_ends):
+
+            if start == end:
+                continue  # no unfinished episode at the end of the batch
+
+            if self.starting_new_episode:
+                self.start_episode()
+
+            run_len = end - start
+            assert self.time_ptr + run_len <= self.max_episode_len, "episode longer than max_episode_len"
+
+            first_row = self.ep_offset[self.episode_ptr] + self.time_ptr
+            num_rows_to_write = run_len + 1 if is_end[end - 1] else run_len
+            self.evict_episodes_overlapping(first_row, first_row + num_rows_to_write)
+            self.num_rows_used = max(self.num_rows_used, first_row + num_rows_to_write)
+
+            rows = slice(first_row, first_row + run_len)
+            self.o[rows] = o[start:end]
+            self.a[rows] = a[start:end]
+            self.r[rows] = r[start:end]
+            self.d[rows] = d[start:end]
+            self.ep_len[self.episode_ptr] += run_len
+
+            if self.hidden_state_size > 0:
+                self.store_hidden_states(self.time_ptr + np.arange(run_len), hidden_states[start:end])
+
+            if is_end[end - 1]:
+                self.o[first_row + run_len] = no[end - 1]
+                self.end_episode()
+            else:
+                self.time_ptr += run_len
+
+    def get_snapshot_arrays(self, num_rows_used, num_episode_slots_used) -> dict:
+        """Views of the used rows and episode slots of each array that a snapshot holds."""
+        arrays = dict(
+            o=self.o[:num_rows_used], a=self.a[:num_rows_used], r=self.r[:num_rows_used], d=self.d[:num_rows_used],
+            ep_offset=self.ep_offset[:num_episode_slots_used], ep_len=self.ep_len[:num_episode_slots_used],
+            ready_for_sampling=self.ready_for_sampling[:num_episode_slots_used]
+        )
+        if self.hidden_state_size > 0:
+            arrays['h'] = self.h[:num_episode_slots_used]
+        return arrays
+
+    def save(self, save_dir, compress=False) -> None:
+
+        """
+        Saves the used rows and episode slots, the pointers and numpy's global RNG state (used for sampling) to
+        save_dir. Arrays are streamed chunk by chunk, so saving does not need any extra memory beyond one chunk;
+        compress (zlib) trades saving / loading speed for disk space.
+        """
+
+        state = dict(
+            episode_ptr=self.episode_ptr, row_ptr=self.row_ptr, num_episodes=self.num_episodes,
+            num_rows_used=self.num_rows_used, num_episode_slots_used=self.num_episode_slots_used,
+            numpy_rng_state=np.random.get_state()
+        )
+        arrays = self.get_snapshot_arrays(self.num_rows_used, self.num_episode_slots_used)
+        save_snapshot(save_dir, arrays, state, compress)
+
+    def load(self, save_dir) -> None:
+
+        """
+        Loads a snapshot written by save (with the same dimensions, capacity and ragged) in place. The episode being
+        pushed when saving (if any) is dropped, since a resumed run starts a new one; its slot is reused by the next
+        push.
+        """
+
+        state = load_snapshot_state(save_dir)
+        arrays = self.get_snapshot_arrays(state['num_rows_used'], state['num_episode_slots_used'])
+        load_snapshot_arrays(save_dir, arrays, state)
+
+        self.episode_ptr = state['episode_ptr']
+        self.row_ptr = state['row_ptr']
+        self.num_episodes = state['num_episodes']
+        self.num_rows_used = state['num_rows_used']
+        self.num_episode_slots_used = state['num_episode_slots_used']
+        np.random.set_state(state['numpy_rng_state'])
 
-            self.starting_new_episode = True
-            if self.num_episodes < self.capacity:
-                self.num_episodes += 1
+        self.time_ptr = 0
+        self.starting_new_episode = True
 
-        else:
+        used = slice(0, self.num_episode_slots_used)
+        self.sum_tree.leaves[used] = self.ep_len[used] * self.ready_for_sampling[used]
+        self.sum_tree.rebuild()
 
-            # update pointers
+        for bucket, bucket_tree in enumerate(self.bucket_trees):
+            bucket_tree.leaves[used] = self.sum_tree.leaves[used] * (self.length_buckets(self.ep_len[used]) == bucket)
+            bucket_tree.rebuild()
 
-            self.time_ptr += 1
+    def gather_o(self, staging: StagingArea, key, rows: np.array) -> torch.tensor:
+        """Observations of a (batch_size, num_steps) grid of rows, as a (batch_size, num_steps, *o_shape) tensor."""
+        return staging.gather(key, self.o_tensor, torch.from_numpy(rows.reshape(-1))).view(*rows.shape, *self.o_shape)
 
-    def sample(self):
+    def o_mask_shape(self, time_steps: np.array) -> tuple:
+        return time_steps.shape + (1,) * len(self.o_shape)  # broadcasts over o_shape
 
-        assert self.num_episodes >= self.batch_size
+    def gather_steps(self, staging: StagingArea, choices: np.array, start_steps: np.array, num_steps: int):
+
+        """
+        Gathers num_steps steps of the episodes in slots choices, starting from step start_steps (one per item), with
+        a single index_select per field over a precomputed (batch_size, num_steps + 1) grid of rows. Rows past the end
+        of an episode (which belong to the next episode when ragged) are zeroed out afterwards.
+        """
+
+        time_steps = start_steps[:, np.newaxis] + np.arange(num_steps + 1)[np.newaxis, :]
+        rows = self.ep_offset[choices][:, np.newaxis] + time_steps
+        np.minimum(rows, self.num_rows - 1, out=rows)  # for the padding of episodes near the last row
+
+        other_rows = torch.from_numpy(rows[:, :-1].reshape(-1))
+
+        o = self.gather_o(staging, 'o', rows)
+        a = staging.gather('a', self.a_tensor, other_rows).view(len(choices), num_steps, self.a_dim)
+        r = staging.gather('r', self.r_tensor, other_rows).view(len(choices), num_steps, 1)
+        d = staging.gather('d', self.d_tensor, other_rows).view(len(choices), num_steps, 1)
 
-        # sample episode indices
+        ep_lens = self.ep_len[choices][:, np.newaxis]
+        num_valid_steps = np.clip(ep_lens[:, 0] - start_steps, 0, num_steps)
+        self.padding_ratio = 1 - np.sum(num_valid_steps) / (len(choices) * num_steps)
+        o_mask = staging.from_numpy('o mask', (time_steps <= ep_lens).reshape(self.o_mask_shape(time_steps)))
+        m = staging.from_numpy('m', (time_steps[:, :-1] < ep_lens)[:, :, np.newaxis])
 
-        options = np.where(self.ready_for_sampling == 1)[0]
-        ep_lens_of_options = self.ep_len[options]
-        probas_of_options = as_probas(ep_lens_of_options)
-        choices = np.random.choice(options, p=probas_of_options, size=self.batch_size)
+        o.mul_(o_mask)
+        a.mul_(m)
+        r.mul_(m)
+        d.mul_(m)
 
+        lengths = torch.from_numpy(num_valid_steps) if self.return_lengths else None
+
+        return RecurrentBatch(o, a, r, d, m, lengths)
+
+    def gather_burn_in(self, staging: StagingArea, choices: np.array, start_steps: np.array):
+
+        """
+        Gathers the stored hidden states at the start of the burn-in prefix of the segments starting at start_steps
+        (multiples of segment_len), and the burn_in observations of the prefix (zeros, with bm = 0, for segments
+        starting at step 0).
+        """
+
+        h_rows = torch.from_numpy(choices * self.h.shape[1] + start_steps // self.segment_len)
+        h = staging.gather('h', self.h_tensor, h_rows)
+
+        time_steps = start_steps[:, np.newaxis] + np.arange(-self.burn_in, 0)[np.newaxis, :]
+        rows = np.maximum(self.ep_offset[choices][:, np.newaxis] + time_steps, 0)
+
+        bo = self.gather_o(staging, 'bo', rows)
+        bm = staging.from_numpy('bm', (time_steps >= 0)[:, :, np.newaxis])
+        bo.mul_(bm.view(self.o_mask_shape(time_steps)))
+
+        return h, bo, bm
+
+    def sample_episode_slots(self) -> np.array:
+        """
+        Slots of batch_size episodes sampled (with replacement) proportionally to their length; from the same length
+        bucket if num_length_buckets > 1.
+        """
+        if self.num_length_buckets == 1:
+            return self.sum_tree.find(np.random.rand(self.batch_size) * self.sum_tree.total)
+        bucket_totals = np.array([bucket_tree.total for bucket_tree in self.bucket_trees])
+        bucket_tree = self.bucket_trees[np.random.choice(self.num_length_buckets, p=as_probas(bucket_totals))]
+        return bucket_tree.find(np.random.rand(self.batch_size) * bucket_tree.total)
+
+    def sample(self, staging: StagingArea = None):
+
+        """
+        Batch tensors are materialized in staging (self.staging by default; see StagingArea), which means that they
+        are only valid until the next call to sample with the same staging.
+        """
+
+        assert self.num_episodes >= self.batch_size
+
+        staging = self.staging if staging is None else staging
+
+        choices = self.sample_episode_slots()
         ep_lens_of_choices = self.ep_len[choices]
 
         if self.segment_len is None:
 
-            # grab the corresponding numpy array
-            # and save computational effort for lstm
+            # gather only the first max_ep_len_in_batch steps of the chosen episodes
+            # to save computational effort for lstm
 
             max_ep_len_in_batch = int(np.max(ep_lens_of_choices))
 
-            o = self.o[choices][:, :max_ep_len_in_batch+1, :]
-            a = self.a[choices][:, :max_ep_len_in_batch, :]
-            r = self.r[choices][:, :max_ep_len_in_batch, :]
-            d = self.d[choices][:, :max_ep_len_in_batch, :]
-            m = self.m[choices][:, :max_ep_len_in_batch, :]
+            return self.gather_steps(staging, choices, np.zeros_like(choices), max_ep_len_in_batch)
 
-            # convert to tensors on the right device
+        else:
 
-            o = as_tensor_on_device(o).view(self.batch_size, max_ep_len_in_batch+1, self.o_dim)
-            a = as_tensor_on_device(a).view(self.batch_size, max_ep_len_in_batch, self.a_dim)
-            r = as_tensor_on_device(r).view(self.batch_size, max_ep_len_in_batch, 1)
-            d = as_tensor_on_device(d).view(self.batch_size, max_ep_len_in_batch, 1)
-            m = as_tensor_on_device(m).view(self.batch_size, max_ep_len_in_batch, 1)
+            # one segment per item, drawn uniformly among the (non-overlapping) segments of its episode
 
-            return RecurrentBatch(o, a, r, d, m)
+            num_segments_for_each_item = np.ceil(ep_lens_of_choices / self.segment_len).astype(int)
+            start_steps = np.random.randint(num_segments_for_each_item) * self.segment_len
 
-        else:
+            batch = self.gather_steps(staging, choices, start_steps, self.segment_len)
 
-            num_segments_for_each_item = np.ceil(ep_lens_of_choices / self.segment_len).astype(int)
+            if self.hidden_state_size > 0:
+                h, bo, bm = self.gather_burn_in(staging, choices, start_steps)
+                batch = batch._replace(h=h, bo=bo, bm=bm)
+
+            return batch
+
+
+@gin.configurable(module=__name__)
+class RecurrentImageReplayBuffer(RecurrentReplayBuffer):
+
+    """
+    RecurrentReplayBuffer for image observations of shape o_shape = (c, h, w), e.g., from dmc-*-img-* envs.
+
+    Frames are stored as uint8 (4x smaller than float32; see store_img_as_uint8 in ReplayBuffer), and can be pushed
+    either raw or already normalized to [0, 1]. Sampled frames are copied to device as uint8 and only then converted
+    to float32 in [0, 1], so batches are exactly like those of RecurrentReplayBuffer, except that o (and bo) have
+    shape (batch_size, num_steps + 1, c, h, w). Full-episode and segment sampling, ragged, length buckets, stored
+    hidden states and snapshots all work the same.
+
+    If use_aug_for_img is True, batches are augmented by random shifts (replication padding + random crop, as in
+    ReplayBuffer), with one shift per sequence: all frames of an item (including its burn-in prefix, if any) are
+    cropped together, as channels of a single (num_steps * c, h, w) image, so that the motion between consecutive
+    frames is preserved.
+    """
+
+    o_dtype = np.uint8
+
+    def __init__(self, o_shape, a_dim, max_episode_len, use_aug_for_img=True, **kwargs):
+
+        assert len(o_shape) == 3, "RecurrentImageReplayBuffer is for (c, h, w) image observations"
+
+        super().__init__(o_shape, a_dim, max_episode_len, **kwargs)
+
+        self.use_aug_for_img = use_aug_for_img
+
+        if self.use_aug_for_img:
+            self.augmentator = nn.Sequential(
+                nn.ReplicationPad2d(4),
+                kornia.augmentation.RandomCrop((o_shape[1], o_shape[2]))
+            )
+
+    def push(self, o, a, r, no, d, cutoff, hidden_state=None):
+        super().push(as_uint8_image(o), a, r, as_uint8_image(no), d, cutoff, hidden_state)
+
+    def push_batch(self, o, a, r, no, d, cutoff, hidden_states=None) -> None:
+        super().push_batch(as_uint8_image(o), a, r, as_uint8_image(no), d, cutoff, hidden_states)
+
+    def gather_o(self, staging: StagingArea, key, rows: np.array) -> torch.tensor:
+        frames = staging.gather(key, self.o_tensor, torch.from_numpy(rows.reshape(-1)), dtype=torch.uint8)
+        return staging.as_normalized_image(key, frames).view(*rows.shape, *self.o_shape)
+
+    def augment(self, frames: torch.tensor) -> torch.tensor:
+        """Random shift of (batch_size, num_steps, c, h, w) frames, one per item."""
+        bs, num_steps = frames.shape[:2]
+        with torch.no_grad():
+            shifted = self.augmentator(frames.reshape(bs, num_steps * self.o_shape[0], *self.o_shape[1:]))
+        return shifted.view(bs, num_steps, *self.o_shape)
+
+    def sample(self, staging: StagingArea = None):
+
+        batch = super().sample(staging)
+
+        if self.use_aug_for_img:
+            if batch.bo is None:
+                batch = batch._replace(o=self.augment(batch.o))
+            else:
+                frames = self.augment(torch.cat([batch.bo, batch.o], dim=1))
+                batch = batch._replace(bo=frames[:, :self.burn_in], o=frames[:, self.burn_in:])
 
-            o = self.o[choices]
-            a = self.a[choices]
-            r = self.r[choices]
-            d = self.d[choices]
-            m = self.m[choices]
-
-            o_seg = np.zeros((self.batch_size, self.segment_len + 1, self.o_dim))
-            a_seg = np.zeros((self.batch_size, self.segment_len, self.a_dim))
-            r_seg = np.zeros((self.batch_size, self.segment_len, 1))
-            d_seg = np.zeros((self.batch_size, self.segment_len, 1))
-            m_seg = np.zeros((self.batch_size, self.segment_len, 1))
-
-            for i in range(self.batch_size):
-                start_idx = np.random.randint(num_segments_for_each_item[i]) * self.segment_len
-                o_seg[i] = o[i][start_idx:start_idx + self.segment_len + 1]
-                a_seg[i] = a[i][start_idx:start_idx + self.segment_len]
-                r_seg[i] = r[i][start_idx:start_idx + self.segment_len]
-                d_seg[i] = d[i][start_idx:start_idx + self.segment_len]
-                m_seg[i] = m[i][start_idx:start_idx + self.segment_len]
-
-            o_seg = as_tensor_on_device(o_seg)
-            a_seg = as_tensor_on_device(a_seg)
-            r_seg = as_tensor_on_device(r_seg)
-            d_seg = as_tensor_on_device(d_seg)
-            m_seg = as_tensor_on_device(m_seg)
-
-            return RecurrentBatch(o_seg, a_seg, r_seg, d_seg, m_seg)
+        return batch
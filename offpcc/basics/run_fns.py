@@ -15,6 +15,12 @@ import cv2
 from basics.abstract_algorithms import OffPolicyRLAlgorithm, RecurrentOffPolicyRLAlgorithm
 from basics.replay_buffer import ReplayBuffer
 from basics.replay_buffer_recurrent import RecurrentReplayBuffer
+from basics.prefetcher import BatchPrefetcher
+from basics.parallel_envs import make_parallel_envs
+from basics.async_actors import ActorPool
+from basics.async_evaluation import EvaluatorPool
+from basics.utils import get_device
+from basics.utils import StatsTracker
 
 
 BASE_LOG_DIR = '../results'
@@ -147,6 +153,137 @@ def load_and_visualize_policy(
         print('Episode lengths:', ep_lens)
 
 
+def log_epoch(
+        epoch,
+        num_epochs,
+        timesteps,
+        hours_elapsed,
+        train_episode_lens,
+        train_episode_rets,
+        test_episode_lens,
+        test_episode_rets,
+        env_is_pbc,
+        other_stats: dict
+) -> None:
+    """
+    Logs the stats of an epoch to wandb (at step timesteps) and to the console, along with other_stats (e.g., algo
+    specific stats averaged across update steps), which go to wandb only. Test stats are unused if env_is_pbc.
+    """
+
+    # @@@@@@@@@@ training stats (averaged across episodes) @@@@@@@@@@
+
+    mean_train_episode_len = float(np.mean(train_episode_lens))
+    mean_train_episode_ret = float(np.mean(train_episode_rets))
+
+    # @@@@@@@@@@ testing stats (averaged across episodes) @@@@@@@@@@
+
+    if not env_is_pbc:
+
+        mean_test_episode_len = float(np.mean(test_episode_lens))
+        mean_test_episode_ret = float(np.mean(test_episode_rets))
+
+    # @@@@@@@@@@ wandb logging @@@@@@@@@@
+
+    dict_for_wandb = {}
+
+    if env_is_pbc:
+
+        dict_for_wandb.update({
+            'Success Rate': mean_train_episode_ret,
+            'Episode Length': mean_train_episode_len,
+            'Hours': hours_elapsed
+        })
+
+    else:
+
+        dict_for_wandb.update({
+            'Episode Length (Train)': mean_train_episode_len,
+            'Episode Return (Train)': mean_train_episode_ret,
+            'Episode Length (Test)': mean_test_episode_len,
+            'Episode Return (Test)': mean_test_episode_ret,
+            'Hours': hours_elapsed
+        })
+
+    dict_for_wandb.update(other_stats)
+
+    wandb.log(dict_for_wandb, step=timesteps)
+
+    # @@@@@@@@@@ console logging @@@@@@@@@@
+
+    if env_is_pbc:
+
+        stats_string = (
+            f"===============================================================\n"
+            f"| Epochs                  | {epoch}/{num_epochs}\n"
+            f"| Timesteps               | {timesteps}\n"
+            f"| Episode Length (Train)  | {round(mean_train_episode_len, 2)}\n"
+            f"| Episode Return (Train)  | {round(mean_train_episode_ret, 2)}\n"
+            f"| Hours                   | {round(hours_elapsed, 2)}\n"
+            f"==============================================================="
+        )  # this is a weird syntax trick but it just creates a single string
+
+    else:
+
+        stats_string = (
+            f"===============================================================\n"
+            f"| Epochs                  | {epoch}/{num_epochs}\n"
+            f"| Timesteps               | {timesteps}\n"
+            f"| Episode Length (Train)  | {round(mean_train_episode_len, 2)}\n"
+            f"| Episode Return (Train)  | {round(mean_train_episode_ret, 2)}\n"
+            f"| Episode Length (Test)   | {round(mean_test_episode_len, 2)}\n"
+            f"| Episode Return (Test)   | {round(mean_test_episode_ret, 2)}\n"
+            f"| Hours                   | {round(hours_elapsed, 2)}\n"
+            f"==============================================================="
+        )  # this is a weird syntax trick but it just creates a single string
+
+    print(stats_string)
+
+
+def test_and_log_epoch(epoch_stats: dict, test_env, test_algorithm, num_test_episodes_per_epoch, evaluators) -> None:
+
+    """
+    Tests test_algorithm (unless env is pbc) and logs epoch_stats (the keyword arguments of log_epoch other than the
+    test stats) along with the test stats. With evaluators (an EvaluatorPool), testing happens out of band, on a
+    snapshot of the actor networks of test_algorithm, and epoch_stats are only logged once its test episodes are done
+    (see log_tested_epochs), at the same step as without evaluators.
+    """
+
+    if epoch_stats['env_is_pbc']:
+        log_epoch(**epoch_stats, test_episode_lens=None, test_episode_rets=None)
+    elif evaluators is not None:
+        evaluators.submit(test_algorithm.actor_networks, payload=epoch_stats)
+    else:
+        test_episode_lens, test_episode_rets = [], []
+        for j in range(num_test_episodes_per_epoch):
+            test_episode_len, test_episode_ret = test_for_one_episode(test_env, test_algorithm)
+            test_episode_lens.append(test_episode_len)
+            test_episode_rets.append(test_episode_ret)
+        log_epoch(**epoch_stats, test_episode_lens=test_episode_lens, test_episode_rets=test_episode_rets)
+
+
+def make_evaluators(env_fn, algorithm, num_test_workers, num_test_episodes_per_epoch, env_is_pbc):
+    """An EvaluatorPool if num_test_workers > 0 (and there is testing at all, i.e., env is not pbc), otherwise None."""
+    if num_test_workers == 0 or env_is_pbc:
+        return None
+    assert get_device() == 'cpu', "evaluation workers are forked from the learner, which cuda does not support"
+    return EvaluatorPool(env_fn, algorithm, num_workers=num_test_workers, num_episodes=num_test_episodes_per_epoch,
+                         test_fn=test_for_one_episode)
+
+
+def close_evaluators(evaluators) -> None:
+    """Logs the epochs still being tested (waiting for their test episodes) and stops the workers."""
+    if evaluators is not None:
+        while evaluators.num_unfinished > 0:
+            log_tested_epochs(evaluators, block=True)
+        evaluators.close()
+
+
+def log_tested_epochs(evaluators, block=False) -> None:
+    """Logs the epochs whose test episodes (submitted by test_and_log_epoch) are done; if block, waits for one."""
+    for epoch_stats, test_episode_lens, test_episode_rets in evaluators.get_finished(block):
+        log_epoch(**epoch_stats, test_episode_lens=test_episode_lens, test_episode_rets=test_episode_rets)
+
+
 @gin.configurable(module=__name__)
 def train(
         env_fn,
@@ -157,6 +294,15 @@ def train(
         num_test_episodes_per_epoch=gin.REQUIRED,
         update_every=1,
         update_after=gin.REQUIRED,
+        prefetch_batches=0,
+        num_envs=1,
+        use_subprocess_envs=False,
+        num_actor_processes=0,
+        max_replay_ratio=1.0,
+        sync_weights_every=100,
+        actor_chunk_len=50,
+        num_test_workers=0,
+        log_stats_every=None,
 ) -> None:
     """
     Function containing the main loop for environment interaction / learning / testing.
@@ -170,12 +316,56 @@ def train(
     @param num_test_episodes_per_epoch:
     @param update_every: number of env interactions between grad updates; but the ratio is locked to 1-to-1
     @param update_after: for exploration; during the first update_after steps, no update & uniformly random action
+    @param prefetch_batches: if > 0, this many batches are sampled ahead of time on a worker thread (BatchPrefetcher)
+    @param num_envs: number of envs collecting data in parallel, with a single act_batch call per step of all of them;
+                     all step counts (num_steps_per_epoch, update_every, update_after) are in total env steps
+    @param use_subprocess_envs: if True, each env steps in a worker process of its own (see SubprocessEnvs), which is
+                                worth it for expensive envs (pybullet, mujoco, dm_control) only
+    @param num_actor_processes: if > 0, data is collected asynchronously by this many actor processes while the
+                                learner updates continuously (see train_async); num_envs and update_every are not used
+    @param max_replay_ratio: (asynchronous mode) max number of updates per env step collected after update_after
+    @param sync_weights_every: (asynchronous mode) number of updates between two refreshes of the actors' weights
+    @param actor_chunk_len: (asynchronous mode) number of transitions sent by an actor at once (see run_actor)
+    @param num_test_workers: if > 0, test episodes run in this many worker processes (see EvaluatorPool) while
+                             training goes on, and the stats of each epoch are logged once its test episodes are done
+    @param log_stats_every: if not None, algo specific stats are averaged over and logged to wandb every this many
+                            updates (at the current env step) instead of once per epoch along with the other stats;
+                            each log copies them to host, so a small value costs a sync per log on cuda
     @return:
     """
 
+    assert log_stats_every is None or (num_actor_processes == 0 and num_test_workers == 0), \
+        "with actor processes or test workers, epochs are logged at earlier env steps than the current one, " \
+        "which wandb would drop after a log of log_stats_every"
+
+    if num_actor_processes > 0:
+        train_async(
+            env_fn=env_fn,
+            algorithm=algorithm,
+            buffer=buffer,
+            num_epochs=num_epochs,
+            num_steps_per_epoch=num_steps_per_epoch,
+            num_test_episodes_per_epoch=num_test_episodes_per_epoch,
+            update_after=update_after,
+            prefetch_batches=prefetch_batches,
+            num_actor_processes=num_actor_processes,
+            max_replay_ratio=max_replay_ratio,
+            sync_weights_every=sync_weights_every,
+            actor_chunk_len=actor_chunk_len,
+            num_test_workers=num_test_workers
+        )
+        return
+
+    assert num_steps_per_epoch % num_envs == 0, "num_steps_per_epoch must be a multiple of num_envs"
+    assert num_envs == 1 or isinstance(algorithm, OffPolicyRLAlgorithm), \
+        "recurrent algorithms keep a single hidden state and only pick up new networks between episodes, " \
+        "so they collect data from one env"
+    assert num_envs == 1 or not buffer.deduplicate_ns, \
+        "with deduplicate_ns (or frame_stack), consecutive pushes must belong to the same episode, so use one env"
+
     # prepare environments
 
-    env = env_fn()
+    env = make_parallel_envs(env_fn, num_envs, use_subprocess_envs)  # stepped all at once
 
     # pbc stands for pybullet custom
     # when env is pbc, then we avoid testing entirely, and compute success rate instead of return
@@ -184,23 +374,34 @@ def train(
 
     env_is_pbc = env.spec.id.startswith("pbc")
 
-    if not env_is_pbc:
-        test_env = env_fn()
+    evaluators = make_evaluators(env_fn, algorithm, num_test_workers, num_test_episodes_per_epoch, env_is_pbc)
+
+    # only testing in this process needs a test env (evaluators build their own)
+
+    test_env = env_fn() if not env_is_pbc and evaluators is None else None
 
     # prepare stats trackers
 
-    episode_len = 0
-    episode_ret = 0
+    episode_lens = np.zeros(num_envs, dtype=int)
+    episode_rets = np.zeros(num_envs)
     train_episode_lens = []
     train_episode_rets = []
-    algo_specific_stats_tracker = []
+    algo_specific_stats_tracker = StatsTracker()  # on device; copied to host once per epoch (or log_stats_every)
+    num_updates = 0
 
     start_time = time.perf_counter()
     total_time_for_update_networks = 0
 
+    # all pushes and samples go through sampler, which is the buffer itself unless prefetching
+
+    if prefetch_batches > 0:
+        sampler = BatchPrefetcher(buffer, num_batches=prefetch_batches)
+    else:
+        sampler = buffer
+
     # @@@@@@@@@@ training loop @@@@@@@@@@
 
-    state = env.reset()
+    states = env.reset()  # one row per env
 
     if isinstance(algorithm, RecurrentOffPolicyRLAlgorithm):
 
@@ -211,26 +412,41 @@ def train(
 
         algorithm_clone = deepcopy(algorithm)  # algorithm is for action; algorithm_clone is for updates and testing
 
-    for t in range(num_steps_per_epoch * num_epochs):
+    # with stored hidden states, the hidden states recorded by algorithm.act are pushed along with each transition
+
+    stores_hidden_states = isinstance(algorithm, RecurrentOffPolicyRLAlgorithm) and algorithm.burn_in is not None
+
+    # each iteration steps all envs once; t is the number of env steps taken before it (across envs), so that
+    # t_next = t + num_envs is the number of env steps taken after it
+
+    for t in range(0, num_steps_per_epoch * num_epochs, num_envs):
+
+        t_next = t + num_envs
 
         # @@@@@@@@@@ environment interaction @@@@@@@@@@
 
         if t >= update_after:  # exploration is done
-            action = algorithm.act(state, deterministic=False)
+            if num_envs == 1:
+                actions = algorithm.act(states[0], deterministic=False)[np.newaxis]
+            else:
+                actions = algorithm.act_batch(states, deterministic=False)
         else:
-            action = env.action_space.sample()
+            if stores_hidden_states:
+                algorithm.act(states[0], deterministic=False)  # only to keep track of hidden states
+            actions = np.stack([env.action_space.sample() for _ in range(num_envs)])
 
-        next_state, reward, done, info = env.step(action)
-        episode_len += 1
+        next_states, rewards, dones, infos = env.step(actions)
+        cutoffs = np.zeros(num_envs, dtype=bool)
+        episode_lens += 1
 
         if env.spec.id.startswith("pbc"):
-            episode_ret += 0 if reward <= 0 else 1  # for pbc envs, reward is 1 only when the task is accomplished
+            episode_rets += rewards > 0  # for pbc envs, reward is 1 only when the task is accomplished
         else:
-            episode_ret += reward
+            episode_rets += rewards
 
-        # carefully decide what "done" should be at max_episode_steps
+        # carefully decide what "done" should be at max_episode_steps (for each env)
 
-        if episode_len == env.spec.max_episode_steps:
+        for i in np.flatnonzero(episode_lens == env.spec.max_episode_steps):
 
             # here's how truncated is computed behind the scene
             # - at max_episode_steps & done=True -> truncated=False
@@ -238,35 +454,37 @@ def train(
             # better than SpinUp's way, since SpinUp assumes truncated whenever at max_episode_steps
             # ref: https://github.com/openai/gym/blob/master/gym/wrappers/time_limit.py#L14 for calculation of truncated
 
-            cutoff = info.get('TimeLimit.truncated')  # this key is only available at max_steps_per_episode
-            done = False if cutoff else True
+            cutoffs[i] = infos[i].get('TimeLimit.truncated')  # this key is only available at max_steps_per_episode
+            dones[i] = False if cutoffs[i] else True
 
-            assert done or cutoff, "Both done and cutoff are false at max_episode_steps"
+            assert dones[i] or cutoffs[i], "Both done and cutoff are false at max_episode_steps"
 
-        else:
+        # when not at max_episode_steps, done's given by the original env and the TimeLimit wrapper are the same
+        # caution: by original env I mean the env NOT wrapped by a TimeLimit wrapper; by default all envs from
+        # OpenAI gym are wrapped by a TimeLimit wrapper
 
-            # when not at max_episode_steps, done's given by the original env and the TimeLimit wrapper are the same
-            # caution: by original env I mean the env NOT wrapped by a TimeLimit wrapper; by default all envs from
-            # OpenAI gym are wrapped by a TimeLimit wrapper
-
-            cutoff = False
-
-        # store the transition
-        if isinstance(algorithm, RecurrentOffPolicyRLAlgorithm):
-            buffer.push(state, action, reward, next_state, done, cutoff)
-        elif isinstance(algorithm, OffPolicyRLAlgorithm):
-            buffer.push(state, action, reward, next_state, done)
+        # store the transitions
+        if num_envs > 1:
+            sampler.push_batch(states, actions, rewards, next_states, dones, cutoffs)  # in the order of envs
+        elif stores_hidden_states:
+            sampler.push(states[0], actions[0], rewards[0], next_states[0], dones[0], cutoffs[0],
+                         hidden_state=algorithm.recorded_hidden_state)
+        else:
+            sampler.push(states[0], actions[0], rewards[0], next_states[0], dones[0], cutoffs[0])
 
         # crucial, crucial preparation for next step
-        state = next_state
+        states = next_states
 
         # @@@@@@@@@@ end of trajectory handling @@@@@@@@@@
 
-        if done or cutoff:
+        ended = np.flatnonzero(np.logical_or(dones, cutoffs))
+
+        if len(ended) > 0:
 
-            train_episode_lens.append(episode_len)
-            train_episode_rets.append(episode_ret)
-            state, episode_len, episode_ret = env.reset(), 0, 0  # reset state and stats trackers
+            train_episode_lens.extend(episode_lens[ended].tolist())
+            train_episode_rets.extend(episode_rets[ended].tolist())
+            states[ended] = env.reset(ended)  # reset states and stats trackers of these envs only
+            episode_lens[ended], episode_rets[ended] = 0, 0
 
             if isinstance(algorithm, RecurrentOffPolicyRLAlgorithm):
 
@@ -275,127 +493,261 @@ def train(
 
         # @@@@@@@@@@ update handling @@@@@@@@@@
 
-        if t >= update_after and (t + 1) % update_every == 0:
-            for j in range(update_every):
+        # update_every updates for every update_every env steps, as with a single env; with more envs, the updates
+        # due for the last num_envs env steps are done all at once
 
-                batch = buffer.sample()
+        if t >= update_after:
+            for j in range((t_next // update_every - t // update_every) * update_every):
+
+                batch = sampler.sample()
 
                 if isinstance(algorithm, RecurrentOffPolicyRLAlgorithm):
                     algo_specific_stats = algorithm_clone.update_networks(batch)
                 elif isinstance(algorithm, OffPolicyRLAlgorithm):
-                    algo_specific_stats = algorithm.update_networks(batch)
+                    if buffer.prioritized:
+                        algo_specific_stats, td_errors = algorithm.update_networks(batch, return_td_errors=True)
+                        sampler.update_priorities(batch.idx, td_errors.cpu().numpy())
+                    else:
+                        algo_specific_stats = algorithm.update_networks(batch)
+
+                algo_specific_stats_tracker.add(algo_specific_stats)
+                num_updates += 1
 
-                algo_specific_stats_tracker.append(algo_specific_stats)
+                if log_stats_every is not None and num_updates % log_stats_every == 0:
+                    wandb.log(algo_specific_stats_tracker.mean(), step=t_next)
+
+        # @@@@@@@@@@ out-of-band testing handling @@@@@@@@@@
+
+        if evaluators is not None and evaluators.num_unfinished > 0:
+            log_tested_epochs(evaluators)
 
         # @@@@@@@@@@ end of epoch handling @@@@@@@@@@
 
-        if (t + 1) % num_steps_per_epoch == 0:
+        if t_next % num_steps_per_epoch == 0:
 
-            epoch = (t + 1) // num_steps_per_epoch
+            epoch = t_next // num_steps_per_epoch
 
             # @@@@@@@@@@ algo specific stats (averaged across update steps) @@@@@@@@@@
 
-            algo_specific_stats_over_epoch = {}
+            # with log_stats_every, they are logged on their own, and the updates since the last log count towards
+            # the next one
+            algo_specific_stats_over_epoch = algo_specific_stats_tracker.mean() if log_stats_every is None else {}
 
-            if len(algo_specific_stats_tracker) != 0:
-                # get keys from the first one; all dicts SHOULD share the same keys
-                keys = algo_specific_stats_tracker[0].keys()
-                for k in keys:
-                    values = []
-                    for dictionary in algo_specific_stats_tracker:
-                        values.append(dictionary[k])
-                    algo_specific_stats_over_epoch[k] = np.mean(values)
-                algo_specific_stats_tracker = []
+            if prefetch_batches > 0:
+                algo_specific_stats_over_epoch['Hours of Learner Idle Time Removed'] = \
+                    sampler.get_idle_time_removed() / 60 / 60
 
-            # @@@@@@@@@@ training stats (averaged across episodes) @@@@@@@@@@
-
-            mean_train_episode_len = float(np.mean(train_episode_lens))
-            mean_train_episode_ret = float(np.mean(train_episode_rets))
+            if isinstance(algorithm, RecurrentOffPolicyRLAlgorithm):
+                # testing may happen during the middle of an episode, and hence "algorithm" may not contain the
+                # latest parameters (evaluators only take a snapshot of them, so there is nothing to copy then)
+                test_algorithm = algorithm_clone if evaluators is not None else deepcopy(algorithm_clone)
+            elif isinstance(algorithm, OffPolicyRLAlgorithm):
+                test_algorithm = algorithm
+
+            test_and_log_epoch(
+                epoch_stats=dict(
+                    epoch=epoch,
+                    num_epochs=num_epochs,
+                    timesteps=t_next,
+                    hours_elapsed=(time.perf_counter() - start_time) / 60 / 60,
+                    train_episode_lens=train_episode_lens,
+                    train_episode_rets=train_episode_rets,
+                    env_is_pbc=env_is_pbc,
+                    other_stats=algo_specific_stats_over_epoch
+                ),
+                test_env=test_env,
+                test_algorithm=test_algorithm,
+                num_test_episodes_per_epoch=num_test_episodes_per_epoch,
+                evaluators=evaluators
+            )
 
             train_episode_lens = []
             train_episode_rets = []
 
-             # @@@@@@@@@@ testing stats (averaged across episodes) @@@@@@@@@@
+    close_evaluators(evaluators)
 
-            if not env_is_pbc:
+    if prefetch_batches > 0:
+        sampler.close()
 
-                test_episode_lens, test_episode_rets = [], []
+    env.close()
 
-                if isinstance(algorithm, RecurrentOffPolicyRLAlgorithm):
-                    # testing may happen during the middle of an episode, and hence "algorithm" may not contain the
-                    # latest parameters
-                    test_algorithm = deepcopy(algorithm_clone)
-                elif isinstance(algorithm, OffPolicyRLAlgorithm):
-                    test_algorithm = algorithm
+    # save stats and model after training loop finishes
+    algorithm.save_actor(wandb.run.dir)  # will get uploaded to cloud after script finishes
 
-                for j in range(num_test_episodes_per_epoch):
-                    test_episode_len, test_episode_ret = test_for_one_episode(test_env, test_algorithm)
-                    test_episode_lens.append(test_episode_len)
-                    test_episode_rets.append(test_episode_ret)
 
-                mean_test_episode_len = float(np.mean(test_episode_lens))
-                mean_test_episode_ret = float(np.mean(test_episode_rets))
+def train_async(
+        env_fn,
+        algorithm: Union[OffPolicyRLAlgorithm, RecurrentOffPolicyRLAlgorithm],
+        buffer: Union[ReplayBuffer, RecurrentReplayBuffer],
+        num_epochs,
+        num_steps_per_epoch,
+        num_test_episodes_per_epoch,
+        update_after,
+        prefetch_batches,
+        num_actor_processes,
+        max_replay_ratio,
+        sync_weights_every,
+        actor_chunk_len,
+        num_test_workers,
+) -> None:
+    """
+    Asynchronous version of train, where collection and updates overlap: num_actor_processes actor processes (see
+    ActorPool) step their own env with a copy of the policy, while this process (the learner) pushes the transitions
+    they send and updates algorithm continuously, publishing its weights to the actors every sync_weights_every updates.
+
+    Updates start once update_after env steps have been collected, and the learner waits for more data whenever it has
+    done max_replay_ratio updates per env step collected since then, so that learning does not outrun data (there is
+    no limit the other way around: when the learner is the bottleneck, the replay ratio drops below max_replay_ratio).
+    Epochs are num_steps_per_epoch env steps (across actors) long, as in train. On top of the stats of train, each
+    epoch logs the replay ratio achieved during it and the mean staleness of the transitions collected during it (the
+    number of updates done by the learner between the version of the weights that chose their actions and their push).
+
+    This is meant for cpu nodes, where env stepping (e.g., pybullet, mujoco) and learning compete for the same cores.
+    """
 
-            # @@@@@@@@@@ hours elapsed @@@@@@@@@@
+    assert get_device() == 'cpu', "actor processes are forked from the learner, which cuda does not support"
 
-            current_time = time.perf_counter()
-            hours_elapsed = (current_time - start_time) / 60 / 60
+    recurrent = isinstance(algorithm, RecurrentOffPolicyRLAlgorithm)
+    stores_hidden_states = recurrent and algorithm.burn_in is not None
+    whole_episodes = recurrent or buffer.deduplicate_ns  # see run_actor
 
-            # @@@@@@@@@@ wandb logging @@@@@@@@@@
+    # prepare environments (those of the actors and evaluators are built in their processes); the learner has no
+    # env of its own, so the test env also tells whether env is pbc, and is only kept for testing in this process
 
-            dict_for_wandb = {}
+    test_env = env_fn()
+    env_is_pbc = test_env.spec.id.startswith("pbc")  # see train
 
-            if env_is_pbc:
+    evaluators = make_evaluators(env_fn, algorithm, num_test_workers, num_test_episodes_per_epoch, env_is_pbc)
 
-                dict_for_wandb.update({
-                    'Success Rate': mean_train_episode_ret,
-                    'Episode Length': mean_train_episode_len,
-                    'Hours': hours_elapsed
-                })
+    if env_is_pbc or evaluators is not None:
+        test_env.close()
+        test_env = None
 
-            else:
+    # prepare stats trackers
 
-                dict_for_wandb.update({
-                    'Episode Length (Train)': mean_train_episode_len,
-                    'Episode Return (Train)': mean_train_episode_ret,
-                    'Episode Length (Test)': mean_test_episode_len,
-                    'Episode Return (Test)': mean_test_episode_ret,
-                    'Hours': hours_elapsed
-                })
+    train_episode_lens = []
+    train_episode_rets = []
+    algo_specific_stats_tracker = StatsTracker()  # on device; copied to host once per epoch
 
-            dict_for_wandb.update(algo_specific_stats_over_epoch)
+    num_env_steps, num_updates = 0, 0
+    num_env_steps_before_epoch, num_updates_before_epoch = 0, 0
+    total_staleness_over_epoch = 0
 
-            wandb.log(dict_for_wandb, step=t+1)
+    start_time = time.perf_counter()
 
-            # @@@@@@@@@@ console logging @@@@@@@@@@
+    # all pushes and samples go through sampler, which is the buffer itself unless prefetching
 
-            if env_is_pbc:
+    if prefetch_batches > 0:
+        sampler = BatchPrefetcher(buffer, num_batches=prefetch_batches)
+    else:
+        sampler = buffer
 
-                stats_string = (
-                    f"===============================================================\n"
-                    f"| Epochs                  | {epoch}/{num_epochs}\n"
-                    f"| Timesteps               | {t + 1}\n"
-                    f"| Episode Length (Train)  | {round(mean_train_episode_len, 2)}\n"
-                    f"| Episode Return (Train)  | {round(mean_train_episode_ret, 2)}\n"
-                    f"| Hours                   | {round(hours_elapsed, 2)}\n"
-                    f"==============================================================="
-                )  # this is a weird syntax trick but it just creates a single string
+    actors = ActorPool(
+        env_fn, algorithm, num_actors=num_actor_processes, update_after=update_after,
+        chunk_len=None if whole_episodes else actor_chunk_len
+    )
 
+    # @@@@@@@@@@ training loop @@@@@@@@@@
+
+    epoch = 0
+
+    while epoch < num_epochs:
+
+        # @@@@@@@@@@ data from actors @@@@@@@@@@
+
+        # waits for data only when updates are throttled
+
+        can_update = num_updates < max_replay_ratio * (num_env_steps - update_after)
+
+        for chunk in actors.get(block=not can_update):
+
+            if stores_hidden_states:
+                sampler.push_batch(chunk.s, chunk.a, chunk.r, chunk.ns, chunk.d, chunk.cutoff,
+                                   hidden_states=chunk.hidden_states)
             else:
+                sampler.push_batch(chunk.s, chunk.a, chunk.r, chunk.ns, chunk.d, chunk.cutoff)
+
+            num_env_steps += len(chunk.r)
+            total_staleness_over_epoch += int(np.sum(num_updates - chunk.version))
+            train_episode_lens.extend(chunk.episode_lens)
+            train_episode_rets.extend(chunk.episode_rets)
+
+        # @@@@@@@@@@ update handling @@@@@@@@@@
+
+        if num_updates < max_replay_ratio * (num_env_steps - update_after):
+
+            batch = sampler.sample()
+
+            if isinstance(algorithm, RecurrentOffPolicyRLAlgorithm):
+                algo_specific_stats = algorithm.update_networks(batch)
+            elif isinstance(algorithm, OffPolicyRLAlgorithm):
+                if buffer.prioritized:
+                    algo_specific_stats, td_errors = algorithm.update_networks(batch, return_td_errors=True)
+                    sampler.update_priorities(batch.idx, td_errors.cpu().numpy())
+                else:
+                    algo_specific_stats = algorithm.update_networks(batch)
+
+            algo_specific_stats_tracker.add(algo_specific_stats)
+            num_updates += 1
+
+            if num_updates % sync_weights_every == 0:
+                actors.publish(version=num_updates)
+
+        # @@@@@@@@@@ out-of-band testing handling @@@@@@@@@@
+
+        if evaluators is not None and evaluators.num_unfinished > 0:
+            log_tested_epochs(evaluators)
+
+        # @@@@@@@@@@ end of epoch handling @@@@@@@@@@
+
+        if num_env_steps >= (epoch + 1) * num_steps_per_epoch:
+
+            epoch += 1
+
+            # @@@@@@@@@@ algo specific and asynchronous stats @@@@@@@@@@
+
+            algo_specific_stats_over_epoch = algo_specific_stats_tracker.mean()
+
+            num_env_steps_over_epoch = num_env_steps - num_env_steps_before_epoch
+            algo_specific_stats_over_epoch.update({
+                'Replay Ratio': (num_updates - num_updates_before_epoch) / num_env_steps_over_epoch,
+                'Policy Staleness (Updates)': total_staleness_over_epoch / num_env_steps_over_epoch,
+            })
+            num_env_steps_before_epoch, num_updates_before_epoch = num_env_steps, num_updates
+            total_staleness_over_epoch = 0
+
+            if prefetch_batches > 0:
+                algo_specific_stats_over_epoch['Hours of Learner Idle Time Removed'] = \
+                    sampler.get_idle_time_removed() / 60 / 60
+
+            # actors never act with algorithm itself, so it can be tested in place (test_for_one_episode resets the
+            # hidden states of recurrent algorithms)
+
+            test_and_log_epoch(
+                epoch_stats=dict(
+                    epoch=epoch,
+                    num_epochs=num_epochs,
+                    timesteps=epoch * num_steps_per_epoch,  # a few more env steps may have been taken by now
+                    hours_elapsed=(time.perf_counter() - start_time) / 60 / 60,
+                    train_episode_lens=train_episode_lens,
+                    train_episode_rets=train_episode_rets,
+                    env_is_pbc=env_is_pbc,
+                    other_stats=algo_specific_stats_over_epoch
+                ),
+                test_env=test_env,
+                test_algorithm=algorithm,
+                num_test_episodes_per_epoch=num_test_episodes_per_epoch,
+                evaluators=evaluators
+            )
+
+            train_episode_lens = []
+            train_episode_rets = []
+
+    actors.close()
+    close_evaluators(evaluators)
 
-                stats_string = (
-                    f"===============================================================\n"
-                    f"| Epochs                  | {epoch}/{num_epochs}\n"
-                    f"| Timesteps               | {t+1}\n"
-                    f"| Episode Length (Train)  | {round(mean_train_episode_len, 2)}\n"
-                    f"| Episode Return (Train)  | {round(mean_train_episode_ret, 2)}\n"
-                    f"| Episode Length (Test)   | {round(mean_test_episode_len, 2)}\n"
-                    f"| Episode Return (Test)   | {round(mean_test_episode_ret, 2)}\n"
-                    f"| Hours                   | {round(hours_elapsed, 2)}\n"
-                    f"==============================================================="
-                )  # this is a weird syntax trick but it just creates a single string
-
-            print(stats_string)
+    if prefetch_batches > 0:
+        sampler.close()
 
     # save stats and model after training loop finishes
     algorithm.save_actor(wandb.run.dir)  # will get uploaded to cloud after script finishes
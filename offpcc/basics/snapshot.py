@@ -0,0 +1,101 @@
+import os
+import pickle
+import struct
+import zlib
+
+import numpy as np
+import torch
+
+
+CHUNK_NUM_BYTES = 2 ** 24  # 16 MB of uncompressed data per chunk
+HEADER = struct.Struct('<QQ')  # (number of rows, number of payload bytes) of each chunk
+
+
+def as_numpy(rows) -> np.array:
+    return rows.cpu().numpy() if isinstance(rows, torch.Tensor) else np.asarray(rows)
+
+
+def save_array(path, array, compress=False) -> None:
+
+    """
+    Streams array to path as a sequence of chunks of about CHUNK_NUM_BYTES each, optionally compressed with zlib, so
+    that only one chunk is ever copied in memory at a time. array can be a np.array, a np.memmap or a torch tensor
+    (e.g., device storage), in which case each chunk is copied to host on its own.
+    """
+
+    row_num_bytes = max(1, int(np.prod(array.shape[1:])) * as_numpy(array[:0]).itemsize)
+    chunk_len = max(1, CHUNK_NUM_BYTES // row_num_bytes)
+
+    with open(path, 'wb') as f:
+        for start in range(0, len(array), chunk_len):
+            rows = np.ascontiguousarray(as_numpy(array[start:start + chunk_len]))
+            payload = rows.data.cast('B')  # flat bytes view
+            payload = zlib.compress(payload, 1) if compress else payload
+            f.write(HEADER.pack(len(rows), len(payload)))
+            f.write(payload)
+
+
+def load_array(path, array, compressed=False) -> int:
+
+    """Reads chunks written by save_array directly into array (from its first row on); returns the number of rows."""
+
+    num_rows = 0
+
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) == 0:
+                break
+            chunk_len, payload_num_bytes = HEADER.unpack(header)
+            payload = f.read(payload_num_bytes)
+            if compressed:
+                payload = zlib.decompress(payload)
+            rows = np.frombuffer(payload, dtype=as_numpy(array[:0]).dtype).reshape(chunk_len, *array.shape[1:])
+            array[num_rows:num_rows + chunk_len] = torch.from_numpy(rows.copy()) if isinstance(array, torch.Tensor) \
+                else rows
+            num_rows += chunk_len
+
+    return num_rows
+
+
+def save_snapshot(save_dir, arrays: dict, state: dict, compress=False) -> None:
+
+    """
+    Writes each array in arrays (name -> array; usually a view of the filled region of a placeholder) to
+    save_dir/{name}.chunks and state (a picklable dict of pointers, counters and RNG states) to save_dir/state.pkl.
+    state.pkl is written last, so a snapshot interrupted halfway (e.g., by preemption) is never mistaken for a
+    complete one.
+    """
+
+    os.makedirs(save_dir, exist_ok=True)
+
+    state_path = os.path.join(save_dir, 'state.pkl')
+    if os.path.exists(state_path):
+        os.remove(state_path)
+
+    for name, array in arrays.items():
+        save_array(os.path.join(save_dir, f'{name}.chunks'), array, compress)
+
+    state = dict(state, compressed=compress, shapes={name: tuple(array.shape) for name, array in arrays.items()})
+    with open(state_path + '.tmp', 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(state_path + '.tmp', state_path)
+
+
+def load_snapshot_state(save_dir) -> dict:
+    state_path = os.path.join(save_dir, 'state.pkl')
+    if not os.path.exists(state_path):
+        raise FileNotFoundError(f"no complete snapshot in {save_dir}: {state_path} is missing (e.g., saving was "
+                                f"interrupted)")
+    with open(state_path, 'rb') as f:
+        return pickle.load(f)
+
+
+def load_snapshot_arrays(save_dir, arrays: dict, state: dict) -> None:
+
+    """Fills arrays (name -> array; views of the same shapes as when saving, given state) in place."""
+
+    for name, array in arrays.items():
+        assert state['shapes'][name] == tuple(array.shape), \
+            f"{name} has shape {tuple(array.shape)}, but {state['shapes'][name]} in the snapshot"
+        load_array(os.path.join(save_dir, f'{name}.chunks'), array, state['compressed'])
@@ -0,0 +1,144 @@
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+import torch
+
+from basics.utils import get_device
+
+
+def as_torch_dtype(np_dtype) -> torch.dtype:
+    return torch.from_numpy(np.empty((0,), dtype=np_dtype)).dtype
+
+
+def num_bytes(array) -> int:
+    if isinstance(array, torch.Tensor):
+        return array.element_size() * array.numel()
+    return array.nbytes
+
+
+class ArrayStorage:
+
+    """
+    Allocates the placeholder arrays of a replay buffer, either in RAM, as memory-mapped files on disk, or as torch
+    tensors on the compute device.
+
+    With backend='memmap', each array is a np.memmap backed by a file in a fresh temporary directory (dir, under
+    memmap_dir, or the system default if None), which is removed when the buffer is garbage collected. Since np.memmap
+    is a subclass of np.ndarray, buffers index these arrays exactly like in-memory ones; pages are only faulted in when
+    touched, so capacities larger than RAM are fine as long as the disk can hold them. Files are created sparse, so
+    they read as zeros until written (like np.zeros).
+
+    With backend='device', arrays are torch tensors on get_device() (cuda if available, otherwise cpu), which is only
+    sensible when the whole buffer fits in (accelerator) memory, e.g., for small vector observations. Buffers then
+    sample and gather batches with torch only, without any round trip through host / numpy.
+    """
+
+    BACKENDS = ('memory', 'memmap', 'device')
+
+    def __init__(self, backend='memory', memmap_dir=None):
+
+        assert backend in self.BACKENDS, f"{backend} not recognized; choose among {self.BACKENDS}"
+
+        self.backend = backend
+
+        if self.backend == 'memmap':
+            self.dir = tempfile.mkdtemp(prefix='replay_buffer_', dir=memmap_dir)
+            weakref.finalize(self, shutil.rmtree, self.dir, ignore_errors=True)
+
+    def empty(self, name, shape, dtype):
+        if self.backend == 'memmap':
+            return np.memmap(os.path.join(self.dir, f'{name}.dat'), dtype=dtype, mode='w+', shape=shape)
+        elif self.backend == 'device':
+            return torch.empty(shape, dtype=as_torch_dtype(dtype), device=get_device())
+        return np.empty(shape, dtype=dtype)
+
+    def zeros(self, name, shape, dtype=np.float64):
+        if self.backend == 'memmap':
+            return self.empty(name, shape, dtype)  # fresh files read as zeros
+        elif self.backend == 'device':
+            return torch.zeros(shape, dtype=as_torch_dtype(dtype), device=get_device())
+        return np.zeros(shape, dtype=dtype)
+
+    @staticmethod
+    def as_tensor(array) -> torch.tensor:
+        """Zero-copy tensor view of an array allocated by this class."""
+        return array if isinstance(array, torch.Tensor) else torch.from_numpy(array)
+
+
+class StagingArea:
+
+    """
+    Preallocated tensors through which sampled minibatches are materialized, so that sample() allocates nothing.
+
+    For each field (key), there is a host tensor (pinned if pin_memory and cuda is available, so that copies to device
+    are asynchronous) and, on cuda, a device tensor. gather() index_selects rows of a storage tensor (a zero-copy
+    torch.from_numpy view of a buffer's placeholder array) directly into the host tensor, with the float32 conversion
+    folded into the same copy when needed, and then does a single copy to the device tensor. On cpu, the host tensor is
+    already the batch tensor.
+
+    Tensors are allocated on first use and reused for every later batch; a larger one is only allocated when a bigger
+    batch comes in (e.g., a recurrent batch with a longer episode). Batch tensors are views of these tensors, so the
+    content of a batch is only valid until the same StagingArea is used again.
+
+    Since copies to device are asynchronous, a cuda event is recorded after each of them, and host() waits for the
+    last copy out of a host tensor to finish before handing it out again; otherwise, the next batch could overwrite
+    rows that the copy of the previous one has not read yet. This only blocks when the device lags behind by a whole
+    batch, and copies of the same key are then serialized anyway.
+
+    With host_only, batches stay in the (pinned) host tensors even when cuda is available, so that they can be copied
+    to device later on (see BatchPrefetcher); uint8 images are then also normalized on the host.
+    """
+
+    def __init__(self, pin_memory=True, host_only=False):
+        self.device = 'cpu' if host_only else get_device()
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.host_tensors = {}
+        self.device_tensors = {}
+        self.copy_events = {}  # key -> cuda event recorded after the last copy out of its host tensor
+
+    @staticmethod
+    def view_of(tensors, key, shape, dtype, device, pin_memory=False) -> torch.tensor:
+        numel = int(np.prod(shape))
+        if key not in tensors or tensors[key].numel() < numel or tensors[key].dtype != dtype:
+            tensors[key] = torch.empty(numel, dtype=dtype, device=device, pin_memory=pin_memory)
+        return tensors[key][:numel].view(shape)
+
+    def host(self, key, shape, dtype=torch.float32) -> torch.tensor:
+        if key in self.copy_events:
+            self.copy_events.pop(key).synchronize()  # the previous copy out of this host tensor is done reading it
+        return self.view_of(self.host_tensors, key, shape, dtype, 'cpu', self.pin_memory)
+
+    def to_device(self, key, host_tensor: torch.tensor) -> torch.tensor:
+        if self.device == 'cpu':
+            return host_tensor
+        device_tensor = self.view_of(self.device_tensors, key, host_tensor.shape, host_tensor.dtype, self.device)
+        device_tensor.copy_(host_tensor, non_blocking=True)
+        self.copy_events[key] = torch.cuda.Event()
+        self.copy_events[key].record()  # on the current stream, which the copy was issued to
+        return device_tensor
+
+    def gather(self, key, source: torch.tensor, indices: torch.tensor, dtype=torch.float32) -> torch.tensor:
+        if source.device.type != 'cpu':  # storage already on device (see ArrayStorage); nothing to copy over
+            out = self.view_of(self.device_tensors, key, (len(indices), *source.shape[1:]), dtype, source.device)
+            return torch.index_select(source, 0, indices, out=out)
+        host_tensor = self.host(key, (len(indices), *source.shape[1:]), dtype)
+        if source.dtype == dtype:
+            torch.index_select(source, 0, indices, out=host_tensor)
+        else:
+            host_tensor.copy_(source[indices])  # e.g., float64 storage; casts while copying
+        return self.to_device(key, host_tensor)
+
+    def from_numpy(self, key, np_array: np.array, dtype=torch.float32) -> torch.tensor:
+        host_tensor = self.host(key, np_array.shape, dtype)
+        host_tensor.copy_(torch.from_numpy(np.ascontiguousarray(np_array)))  # also casts, e.g., float64 -> float32
+        return self.to_device(key, host_tensor)
+
+    def as_normalized_image(self, key, uint8_images: torch.tensor) -> torch.tensor:
+        """Normalization happens after the copy to device, which is done in uint8 (4x fewer bytes than float32)."""
+        out = self.view_of(
+            self.device_tensors, f'{key} (normalized)', uint8_images.shape, torch.float32, self.device
+        )
+        return torch.div(uint8_images, 255, out=out)
@@ -0,0 +1,73 @@
+import numpy as np
+
+
+class SumTree:
+
+    """
+    Array-backed sum tree for proportional sampling; used by prioritized replay.
+
+    The tree is stored in a flat array: node 1 is the root, node i has children 2i and 2i+1, and leaf j is node
+    num_leaves + j. The number of leaves is padded to a power of 2 so that all leaves have the same depth, which lets
+    both update and find process a whole batch of leaves at once, one tree level at a time (O(batch_size * log N)
+    work in depth-many numpy calls).
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.depth = int(np.ceil(np.log2(max(capacity, 2))))
+        self.num_leaves = 2 ** self.depth
+        self.tree = np.zeros((2 * self.num_leaves,), dtype=np.float64)
+
+    @property
+    def total(self) -> float:
+        return float(self.tree[1])
+
+    @property
+    def leaves(self) -> np.array:
+        """View of the leaves; call rebuild after writing to it directly."""
+        return self.tree[self.num_leaves:]
+
+    def get(self, indices: np.array) -> np.array:
+        return self.tree[indices + self.num_leaves]
+
+    def update(self, indices: np.array, values) -> None:
+
+        nodes = np.asarray(indices, dtype=np.int64) + self.num_leaves
+        self.tree[nodes] = values
+
+        # recomputing a parent from its children is idempotent, so duplicate nodes need no special care
+
+        for _ in range(self.depth):
+            nodes = nodes // 2
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def update_one(self, index: int, value: float) -> None:
+        """Same as update for a single leaf (e.g., on each push), with scalar indexing rather than depth numpy calls."""
+        node = int(index) + self.num_leaves
+        self.tree[node] = value
+        for _ in range(self.depth):
+            node //= 2
+            self.tree[node] = self.tree[2 * node] + self.tree[2 * node + 1]
+
+    def rebuild(self) -> None:
+        """Recomputes all internal nodes from the leaves, one level at a time (bottom-up)."""
+        for level in range(self.depth - 1, -1, -1):
+            nodes = np.arange(2 ** level, 2 ** (level + 1))
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, prefix_sums: np.array) -> np.array:
+
+        """For each value in prefix_sums (within [0, total)), return the leaf whose cumulative range contains it."""
+
+        values = np.array(prefix_sums, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+
+        for _ in range(self.depth):
+            left_children = 2 * nodes
+            left_sums = self.tree[left_children]
+            # never step into an empty right subtree, which could otherwise happen due to round-off errors
+            go_right = (values >= left_sums) & (self.tree[left_children + 1] > 0)
+            values -= left_sums * go_right
+            nodes = left_children + go_right
+
+        return nodes - self.num_leaves
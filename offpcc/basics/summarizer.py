@@ -1,6 +1,8 @@
 import gin
 
+import torch
 import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 
 @gin.configurable(module=__name__)
@@ -19,9 +21,56 @@ class Summarizer(nn.Module):
         else:
             raise ValueError(f"{recurrent_type} not recognized")
 
-    def forward(self, observations, hidden=None, return_hidden=False):
+        self.hidden_dim = hidden_dim
+        self.num_layers = num_layers
+        self.recurrent_type = recurrent_type
+
+    @property
+    def hidden_state_size(self) -> int:
+        """Size of a flattened hidden state (see flatten_hidden); lstms have both h and c."""
+        return self.num_layers * self.hidden_dim * (2 if self.recurrent_type == 'lstm' else 1)
+
+    def flatten_hidden(self, hidden, batch_size=1) -> torch.tensor:
+        """(batch_size, hidden_state_size) tensor of a hidden state as returned by forward (zeros if None)."""
+        if hidden is None:
+            return torch.zeros(batch_size, self.hidden_state_size, device=next(self.parameters()).device)
+        hidden = torch.cat(hidden, dim=0) if self.recurrent_type == 'lstm' else hidden  # (2 * num_layers, bs, dim)
+        return hidden.permute(1, 0, 2).reshape(hidden.shape[1], -1)
+
+    def unflatten_hidden(self, flat_hidden: torch.tensor):
+        """Inverse of flatten_hidden."""
+        hidden = flat_hidden.view(flat_hidden.shape[0], -1, self.hidden_dim).permute(1, 0, 2).contiguous()
+        return tuple(torch.split(hidden, self.num_layers, dim=0)) if self.recurrent_type == 'lstm' else hidden
+
+    def burn_in(self, flat_hidden: torch.tensor, observations: torch.tensor, mask: torch.tensor):
+        """
+        Hidden state after running over observations (a burn-in prefix) from flat_hidden, without gradients. Items
+        with an empty prefix (mask = 0) keep flat_hidden, which is then the zero state of the start of an episode.
+        """
+        hidden = self.unflatten_hidden(flat_hidden)
+        if observations.shape[1] == 0:
+            return hidden
+        with torch.no_grad():
+            self.rnn.flatten_parameters()
+            _, burnt_in = self.rnn(observations, hidden)
+        keep = mask[:, 0, 0].view(1, -1, 1)
+        if self.recurrent_type == 'lstm':
+            return tuple(keep * new + (1 - keep) * old for new, old in zip(burnt_in, hidden))
+        return keep * burnt_in + (1 - keep) * hidden
+
+    def forward(self, observations, hidden=None, return_hidden=False, lengths=None):
+        """
+        lengths (on cpu) is the number of valid steps of each sequence, if any. On cuda, sequences are then packed so
+        that cuDNN skips padded steps; on cpu, where packed rnns are slower than padded ones (in backward), they are
+        not. Either way, summaries of padded steps should be ignored.
+        """
         self.rnn.flatten_parameters()
-        summary, hidden = self.rnn(observations, hidden)
+        if lengths is None or not observations.is_cuda:
+            summary, hidden = self.rnn(observations, hidden)
+        else:
+            packed = pack_padded_sequence(observations, lengths, batch_first=True, enforce_sorted=False)
+            summary, hidden = self.rnn(packed, hidden)
+            summary, _ = pad_packed_sequence(summary, batch_first=True, total_length=observations.shape[1])
         if return_hidden:
             return summary, hidden
         else:
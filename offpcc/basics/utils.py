@@ -1,6 +1,9 @@
+import functools
+import logging
 import os
 
 import random
+import warnings
 from copy import deepcopy
 import numpy as np
 import torch
@@ -36,13 +39,68 @@ def get_device():
 def polyak_update(targ_net: nn.Module, pred_net: nn.Module, polyak: float) -> None:
     with torch.no_grad():  # no grad is not actually required here; only for sanity check
         for targ_p, p in zip(targ_net.parameters(), pred_net.parameters()):
-            targ_p.data.copy_(targ_p.data * polyak + p.data * (1 - polyak))
+            targ_p.data.lerp_(p.data, 1 - polyak)  # targ_p * polyak + p * (1 - polyak), in place
+
+
+class TargetNetworks:
+
+    """
+    All (target, prediction) network pairs of an algorithm, registered once, so that a Polyak update of all target
+    networks is a single multi-tensor call (torch._foreach_lerp_) over the parameters of every pair, instead of one
+    polyak_update per pair with a Python loop and two temporaries per parameter. Falls back to an in-place lerp_ per
+    parameter on versions of torch without _foreach_lerp_.
+
+    Parameters are held by reference, so pairs stay registered through load_state_dict (e.g., copy_networks_from) and
+    deepcopy (along with the networks of the algorithm that owns this object).
+    """
+
+    def __init__(self, pairs):
+        self.targ_params, self.pred_params = [], []
+        for targ_net, pred_net in pairs:
+            for targ_p, p in zip(targ_net.parameters(), pred_net.parameters()):
+                assert targ_p.shape == p.shape
+                self.targ_params.append(targ_p)
+                self.pred_params.append(p)
+
+    def update(self, polyak: float) -> None:
+        with torch.no_grad():
+            if hasattr(torch, '_foreach_lerp_'):
+                torch._foreach_lerp_(self.targ_params, self.pred_params, 1 - polyak)
+            else:
+                for targ_p, p in zip(self.targ_params, self.pred_params):
+                    targ_p.lerp_(p, 1 - polyak)
 
 
 def mean_of_unmasked_elements(tensor: torch.tensor, mask: torch.tensor) -> torch.tensor:
     return torch.mean(tensor * mask) / mask.sum() * np.prod(mask.shape)
 
 
+def correlation_of_unmasked_elements(x: torch.tensor, y: torch.tensor, mask: torch.tensor) -> torch.tensor:
+    """Pearson correlation of the unmasked elements of x and y, computed on device (no boolean indexing, no numpy)."""
+    num_unmasked = mask.sum()
+    x_centered = (x - torch.sum(x * mask) / num_unmasked) * mask
+    y_centered = (y - torch.sum(y * mask) / num_unmasked) * mask
+    return torch.sum(x_centered * y_centered) / torch.sqrt(torch.sum(x_centered ** 2) * torch.sum(y_centered ** 2))
+
+
+def make_valid_timesteps_selector(lengths: torch.tensor, num_bptt: int, device) -> callable:
+    """
+    Returns a function that maps a (bs, num_bptt, dim) tensor to a (num_valid, 1, dim) tensor of its valid timesteps
+    (the first lengths[i] ones of item i), so that recurrent algorithms can evaluate MLP heads (and losses) on valid
+    timesteps only. lengths is on cpu, as in RecurrentBatch.
+    """
+    valid = torch.arange(num_bptt).unsqueeze(0) < lengths.unsqueeze(1)
+    items, steps = [indices.to(device) for indices in torch.nonzero(valid, as_tuple=True)]
+    return lambda tensor: tensor[items, steps].unsqueeze(1)
+
+
+def mean_of_weighted_elements(tensor: torch.tensor, weights: torch.tensor) -> torch.tensor:
+    """weights are importance-sampling weights from prioritized replay; None means uniform replay."""
+    if weights is None:
+        return torch.mean(tensor)
+    return torch.mean(tensor * weights)
+
+
 def save_net(net: nn.Module, save_dir: str, save_name: str) -> None:
     torch.save(net.state_dict(), os.path.join(save_dir, save_name))
 
@@ -62,3 +120,110 @@ def create_target(net: nn.Module) -> nn.Module:
     target = deepcopy(net)
     set_requires_grad_flag(target, False)
     return target
+
+
+class StatsTracker:
+
+    """
+    Running sums of the stats dicts returned by update_networks, whose values are (detached) tensors on the compute
+    device, so that tracking them never blocks on the host. The sums are only copied to host (as floats) by mean(),
+    i.e., once per logging interval, which also resets them. Python numbers are summed as they are.
+    """
+
+    def __init__(self):
+        self.sums, self.count = {}, 0
+
+    def add(self, stats: dict) -> None:
+        for key, value in stats.items():
+            self.sums[key] = self.sums[key] + value if key in self.sums else value
+        self.count += 1
+
+    def mean(self) -> dict:
+        """Means over the stats added since the last call ({} if none)."""
+        means = {key: float(value) / self.count for key, value in self.sums.items()}
+        self.sums, self.count = {}, 0
+        return means
+
+
+class EagerFallbackWarnings(logging.Handler):
+
+    """
+    Turns what dynamo logs when a frame falls back to eager mode (a suppressed compilation error, e.g., no C++
+    compiler for inductor, or its recompile limit being hit, e.g., by the step wrapper that all optimizers share) into
+    warnings about fn_name, for the duration of a with block. Repeated warnings are filtered out as usual.
+    """
+
+    def __init__(self, fn_name: str):
+        super().__init__(level=logging.WARNING)
+        self.fn_name = fn_name
+        self.logger = logging.getLogger('torch._dynamo.convert_frame')  # which logs both fallbacks
+
+    def emit(self, record: logging.LogRecord) -> None:
+        warnings.warn(f"part of {self.fn_name} runs eagerly: {record.getMessage().splitlines()[0]}")
+
+    def __enter__(self):
+        self.logger.addHandler(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.logger.removeHandler(self)
+
+
+def compile_or_none(fn: callable):
+
+    """
+    torch.compile(fn), or None (with a warning) where torch.compile is unavailable.
+
+    Frames of fn that fail to compile run eagerly instead of raising: dynamo's suppress_errors is only set for calls
+    to the returned function (not globally, so other uses of torch.compile still raise), and each fallback to eager
+    mode comes with a warning (see EagerFallbackWarnings).
+    """
+
+    if not hasattr(torch, 'compile'):
+        warnings.warn(f"torch {torch.__version__} has no torch.compile; {fn.__qualname__} runs eagerly")
+        return None
+    try:
+        compiled_fn = torch.compile(fn)
+    except RuntimeError as e:  # e.g., a Python version that dynamo does not support yet
+        warnings.warn(f"torch.compile is unavailable ({e}); {fn.__qualname__} runs eagerly")
+        return None
+
+    eager_fallback_warnings = EagerFallbackWarnings(fn.__qualname__)
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        with torch._dynamo.config.patch(suppress_errors=True), eager_fallback_warnings:
+            return compiled_fn(*args, **kwargs)
+
+    return run
+
+
+def compilable_update(update_networks: callable) -> callable:
+
+    """
+    Decorator for update_networks that runs it through torch.compile when the algorithm has compile_update set (a
+    gin-configurable argument of each algorithm), so that the loss computations, backward passes and optimizer steps
+    are traced into a few graphs, in which small elementwise ops (e.g., the tanh-squash log-prob math, td targets,
+    Adam's update) are fused. Each backward must come from a single loss per graph, hence the summed critic losses.
+
+    The function is compiled once per class, on first use, and shared by all instances (e.g., a recurrent algorithm
+    and its clone), which dynamo tells apart through its guards. Falls back to eager mode when compilation is
+    unavailable (see compile_or_none). Random ops inside compiled graphs draw from a different stream than in eager
+    mode, so sampled noise differs for the same seed.
+
+    Graphs are specialized to batch shapes, so recurrent algorithms should be given fixed-shape batches (segment_len
+    in RecurrentReplayBuffer): every new episode length recompiles, until dynamo's recompile limit is hit and the
+    affected frames run eagerly (with a warning).
+    """
+
+    compiled = []  # [compiled update_networks, or None if unavailable], after the first call with compile_update
+
+    @functools.wraps(update_networks)
+    def wrapper(self, *args, **kwargs):
+        if not self.compile_update:
+            return update_networks(self, *args, **kwargs)
+        if len(compiled) == 0:
+            compiled.append(compile_or_none(update_networks))
+        return (compiled[0] or update_networks)(self, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,381 @@
+"""
+Micro-benchmarks for the update step (and act) of the algorithms, on data collected by a uniformly random policy.
+
+Example usage:
+python benchmark_algorithms.py --benchmark packed --env cartpole-balance-pomdp-v0
+python benchmark_algorithms.py --benchmark buckets --env cartpole-balance-pomdp-v0 --num_length_buckets 4
+python benchmark_algorithms.py --benchmark burn_in --env cartpole-balance-pomdp-v0 --segment_len 50 --burn_in 20
+python benchmark_algorithms.py --benchmark critic_ensemble --env cartpole-balance-pomdp-v0
+python benchmark_algorithms.py --benchmark polyak --env cartpole-balance-pomdp-v0
+python benchmark_algorithms.py --benchmark compile --env cartpole-balance-pomdp-v0
+python benchmark_algorithms.py --benchmark act --env cartpole-balance-pomdp-v0
+"""
+
+import argparse
+import copy
+
+import gym
+import numpy as np
+import torch
+
+from domains import *
+from basics.abstract_algorithms import RecurrentOffPolicyRLAlgorithm
+from basics.replay_buffer import ReplayBuffer
+from basics.replay_buffer_recurrent import RecurrentReplayBuffer
+from basics.storage import StagingArea
+from algorithms import *
+from algorithms_recurrent import *
+from basics.utils import polyak_update
+from benchmark_buffers import time_per_call
+
+
+def fill_buffer_from_env(env, buffer, num_episodes, algorithm=None) -> list:
+
+    """
+    Pushes num_episodes episodes of a uniformly random policy (done / cutoff as in train); returns their lengths. If
+    algorithm is given (with burn_in set), it is stepped along only to record the hidden states to push.
+    """
+
+    ep_lens = []
+
+    for _ in range(num_episodes):
+
+        state, episode_len, done, cutoff = env.reset(), 0, False, False
+        if algorithm is not None:
+            algorithm.reinitialize_hidden()
+
+        while not (done or cutoff):
+            action = env.action_space.sample()
+            next_state, reward, done, info = env.step(action)
+            episode_len += 1
+            if episode_len == env.spec.max_episode_steps:
+                cutoff = info.get('TimeLimit.truncated', False)
+                done = not cutoff
+            if algorithm is None:
+                buffer.push(state, action, reward, next_state, done, cutoff)
+            else:
+                algorithm.act(state, deterministic=True)
+                buffer.push(state, action, reward, next_state, done, cutoff,
+                            hidden_state=algorithm.recorded_hidden_state)
+            state = next_state
+
+        ep_lens.append(episode_len)
+
+    return ep_lens
+
+
+def benchmark_packed(args):
+
+    """Update time of recurrent algorithms with padded vs packed full-episode batches (return_lengths)."""
+
+    env = gym.make(args.env)
+    o_dim, a_dim = env.observation_space.shape[0], env.action_space.shape[0]
+
+    buffer = RecurrentReplayBuffer(o_dim=o_dim, a_dim=a_dim, max_episode_len=env.spec.max_episode_steps,
+                                   capacity=args.num_episodes, batch_size=args.batch_size)
+    ep_lens = fill_buffer_from_env(env, buffer, num_episodes=args.num_episodes)
+
+    # a fixed set of batches, each in its own staging area so that they are all valid at the same time
+
+    batches = {}
+    for return_lengths in [False, True]:
+        buffer.return_lengths = return_lengths
+        np.random.seed(args.seed)
+        batches[return_lengths] = [buffer.sample(staging=StagingArea()) for _ in range(10)]
+
+    padding_ratio = 1 - np.mean([float(b.m.mean()) for b in batches[False]])
+    print(f'{args.env}: mean episode length {np.mean(ep_lens):.1f}, {padding_ratio:.1%} of batch timesteps are padding')
+
+    for algorithm_class in [RecurrentDDPG, RecurrentTD3, RecurrentSAC]:
+
+        torch.manual_seed(args.seed)
+        algorithm = algorithm_class(input_dim=o_dim, action_dim=a_dim)
+
+        # RecurrentDDPG's update involves no sampling, so both paths must return the same stats
+
+        if algorithm_class is RecurrentDDPG:
+            stats = {return_lengths: copy.deepcopy(algorithm).update_networks(batches[return_lengths][0])
+                     for return_lengths in [False, True]}
+            assert all(np.isclose(float(stats[False][key]), float(stats[True][key]), rtol=1e-4, atol=1e-5)
+                       for key in stats[False])
+
+        for return_lengths in [False, True]:
+            algorithm_copy, batch_iterator = copy.deepcopy(algorithm), iter(batches[return_lengths] * args.num_calls)
+            seconds = time_per_call(lambda: algorithm_copy.update_networks(next(batch_iterator)),
+                                    num_calls=args.num_calls, num_warmup_calls=2)
+            mode = 'packed' if return_lengths else 'padded'
+            print(f'{algorithm_class.__name__:>13} {mode}: {seconds * 1e3:8.1f} ms/update')
+
+
+def benchmark_burn_in(args):
+
+    """
+    Update time of recurrent algorithms on full episodes vs on segments of segment_len steps that start from stored
+    hidden states, after burn_in steps without gradients (same batch_size, hence fewer steps per batch).
+    """
+
+    env = gym.make(args.env)
+    o_dim, a_dim = env.observation_space.shape[0], env.action_space.shape[0]
+    max_episode_len = env.spec.max_episode_steps
+
+    for algorithm_class in [RecurrentDDPG, RecurrentTD3, RecurrentSAC]:
+
+        torch.manual_seed(args.seed)
+        np.random.seed(args.seed)
+        algorithm = algorithm_class(input_dim=o_dim, action_dim=a_dim, burn_in=args.burn_in)
+
+        buffers = {
+            'full episodes': RecurrentReplayBuffer(
+                o_dim=o_dim, a_dim=a_dim, max_episode_len=max_episode_len,
+                capacity=args.num_episodes, batch_size=args.batch_size
+            ),
+            f'segments ({args.segment_len} + {args.burn_in} burn-in)': RecurrentReplayBuffer(
+                o_dim=o_dim, a_dim=a_dim, max_episode_len=max_episode_len, segment_len=args.segment_len,
+                capacity=args.num_episodes, batch_size=args.batch_size,
+                hidden_state_size=algorithm.hidden_state_size, burn_in=args.burn_in
+            ),
+        }
+
+        for mode, buffer in buffers.items():
+            fill_buffer_from_env(env, buffer, num_episodes=args.num_episodes, algorithm=copy.deepcopy(algorithm))
+            batches = [buffer.sample(staging=StagingArea()) for _ in range(10)]
+            algorithm_copy, batch_iterator = copy.deepcopy(algorithm), iter(batches * args.num_calls)
+            seconds = time_per_call(lambda: algorithm_copy.update_networks(next(batch_iterator)),
+                                    num_calls=args.num_calls, num_warmup_calls=2)
+            print(f'{algorithm_class.__name__:>13} {mode}: {seconds * 1e3:8.1f} ms/update')
+
+
+def benchmark_buckets(args):
+
+    """Padding ratio and update time of recurrent algorithms on full-episode batches without vs with length buckets."""
+
+    env = gym.make(args.env)
+    o_dim, a_dim = env.observation_space.shape[0], env.action_space.shape[0]
+
+    buffer = RecurrentReplayBuffer(o_dim=o_dim, a_dim=a_dim, max_episode_len=env.spec.max_episode_steps,
+                                   capacity=args.num_episodes, batch_size=args.batch_size,
+                                   num_length_buckets=args.num_length_buckets)
+    ep_lens = fill_buffer_from_env(env, buffer, num_episodes=args.num_episodes)
+    print(f'{args.env}: episode lengths from {np.min(ep_lens)} to {np.max(ep_lens)} (mean {np.mean(ep_lens):.1f})')
+
+    # a fixed set of batches for each number of buckets, as in benchmark_packed
+
+    batches, padding_ratios = {}, {}
+    for num_length_buckets in [1, args.num_length_buckets]:
+        buffer.num_length_buckets = num_length_buckets
+        np.random.seed(args.seed)
+        batches[num_length_buckets], padding_ratios[num_length_buckets] = [], []
+        for _ in range(10):
+            batches[num_length_buckets].append(buffer.sample(staging=StagingArea()))
+            padding_ratios[num_length_buckets].append(buffer.padding_ratio)
+
+    for algorithm_class in [RecurrentDDPG, RecurrentTD3, RecurrentSAC]:
+
+        torch.manual_seed(args.seed)
+        algorithm = algorithm_class(input_dim=o_dim, action_dim=a_dim)
+
+        for num_length_buckets in [1, args.num_length_buckets]:
+            algorithm_copy = copy.deepcopy(algorithm)
+            batch_iterator = iter(batches[num_length_buckets] * args.num_calls)
+            seconds = time_per_call(lambda: algorithm_copy.update_networks(next(batch_iterator)),
+                                    num_calls=args.num_calls, num_warmup_calls=2)
+            print(f'{algorithm_class.__name__:>13} {num_length_buckets} length bucket(s): '
+                  f'{np.mean(padding_ratios[num_length_buckets]):6.1%} padding, {seconds * 1e3:8.1f} ms/update')
+
+
+def benchmark_critic_ensemble(args):
+
+    """
+    Update time of TD3 / SAC and their recurrent variants with two separate critics vs a single MLPCriticEnsemble.
+    Recurrent algorithms are given full-episode batches, others transition batches.
+    """
+
+    env = gym.make(args.env)
+    o_dim, a_dim = env.observation_space.shape[0], env.action_space.shape[0]
+
+    buffers = {  # by whether algorithms are recurrent
+        False: ReplayBuffer(input_shape=(o_dim,), action_dim=a_dim, batch_size=args.transition_batch_size,
+                            capacity=args.num_episodes * env.spec.max_episode_steps),
+        True: RecurrentReplayBuffer(o_dim=o_dim, a_dim=a_dim, max_episode_len=env.spec.max_episode_steps,
+                                    capacity=args.num_episodes, batch_size=args.batch_size),
+    }
+
+    batches = {}
+    for recurrent, buffer in buffers.items():
+        fill_buffer_from_env(env, buffer, num_episodes=args.num_episodes)
+        np.random.seed(args.seed)
+        batches[recurrent] = [buffer.sample(staging=StagingArea()) for _ in range(10)]
+
+    for algorithm_class in [TD3, SAC, RecurrentTD3, RecurrentSAC]:
+        recurrent = issubclass(algorithm_class, RecurrentOffPolicyRLAlgorithm)
+        for critic_ensemble in [False, True]:
+            torch.manual_seed(args.seed)
+            algorithm = algorithm_class(input_dim=o_dim, action_dim=a_dim, critic_ensemble=critic_ensemble)
+            batch_iterator = iter(batches[recurrent] * args.num_calls)
+            seconds = time_per_call(lambda: algorithm.update_networks(next(batch_iterator)),
+                                    num_calls=args.num_calls, num_warmup_calls=2)
+            mode = 'critic ensemble' if critic_ensemble else 'separate critics'
+            print(f'{algorithm_class.__name__:>13} {mode}: {seconds * 1e3:8.1f} ms/update')
+
+
+def benchmark_polyak(args):
+
+    """Time of a Polyak update of all target networks: one polyak_update per pair vs a single TargetNetworks.update."""
+
+    env = gym.make(args.env)
+    o_dim, a_dim = env.observation_space.shape[0], env.action_space.shape[0]
+
+    def copy_with_temporaries(targ_net, pred_net, polyak):  # polyak_update before TargetNetworks
+        with torch.no_grad():
+            for targ_p, p in zip(targ_net.parameters(), pred_net.parameters()):
+                targ_p.data.copy_(targ_p.data * polyak + p.data * (1 - polyak))
+
+    for algorithm_class in [RecurrentDDPG, RecurrentTD3, RecurrentSAC]:
+
+        torch.manual_seed(args.seed)
+        algorithm = algorithm_class(input_dim=o_dim, action_dim=a_dim)
+        pairs = [(algorithm.__dict__[name], algorithm.__dict__[name[:-len('_targ')]])
+                 for name in algorithm.__dict__ if name.endswith('_targ')]
+        num_params = len(algorithm.target_networks.targ_params)
+
+        # both must leave target networks in the same state
+
+        reference, algorithm_copy = copy.deepcopy(algorithm), copy.deepcopy(algorithm)
+        for name in reference.__dict__:
+            if name.endswith('_targ'):
+                copy_with_temporaries(reference.__dict__[name], reference.__dict__[name[:-len('_targ')]], 0.9)
+        algorithm_copy.target_networks.update(0.9)
+        assert all(torch.allclose(p_ref, p) for p_ref, p in
+                   zip(reference.target_networks.targ_params, algorithm_copy.target_networks.targ_params))
+
+        modes = {
+            'copy_ with temporaries, per pair': lambda: [copy_with_temporaries(*p, algorithm.polyak) for p in pairs],
+            'in-place lerp_, per pair': lambda: [polyak_update(*p, algorithm.polyak) for p in pairs],
+            'TargetNetworks.update': lambda: algorithm.target_networks.update(algorithm.polyak),
+        }
+        for mode, update in modes.items():
+            seconds = time_per_call(update, num_calls=args.num_calls * 50, num_warmup_calls=10)
+            print(f'{algorithm_class.__name__:>13} ({len(pairs)} pairs, {num_params} tensors) {mode}: '
+                  f'{seconds * 1e6:8.1f} us/update')
+
+
+def benchmark_compile(args):
+
+    """
+    Updates per second of all (vector-observation) algorithms in eager mode vs with compile_update, after checking
+    that both give the same stats over a few updates from the same weights. Random ops in compiled graphs use eager
+    mode's generator for this (inductor's fallback_random), since they otherwise draw different noise. Recurrent
+    algorithms are given segments of segment_len steps, so that batch shapes are fixed (see compilable_update).
+    """
+
+    import torch._inductor.config
+    torch._inductor.config.fallback_random = True
+
+    env = gym.make(args.env)
+    o_dim, a_dim = env.observation_space.shape[0], env.action_space.shape[0]
+
+    buffers = {  # by whether algorithms are recurrent
+        False: ReplayBuffer(input_shape=(o_dim,), action_dim=a_dim, batch_size=args.transition_batch_size,
+                            capacity=args.num_episodes * env.spec.max_episode_steps),
+        True: RecurrentReplayBuffer(o_dim=o_dim, a_dim=a_dim, max_episode_len=env.spec.max_episode_steps,
+                                    segment_len=args.segment_len, capacity=args.num_episodes,
+                                    batch_size=args.batch_size),
+    }
+
+    batches = {}
+    for recurrent, buffer in buffers.items():
+        fill_buffer_from_env(env, buffer, num_episodes=args.num_episodes)
+        np.random.seed(args.seed)
+        batches[recurrent] = [buffer.sample(staging=StagingArea()) for _ in range(10)]
+
+    for algorithm_class in [DDPG, TD3, SAC, RecurrentDDPG, RecurrentTD3, RecurrentSAC, RecurrentSACSharing]:
+
+        torch.manual_seed(args.seed)
+        algorithms = {False: algorithm_class(input_dim=o_dim, action_dim=a_dim)}
+        algorithms[True] = copy.deepcopy(algorithms[False])
+        algorithms[True].compile_update = True
+
+        recurrent = isinstance(algorithms[False], RecurrentOffPolicyRLAlgorithm)
+
+        # correctness check (which also compiles)
+
+        stats = {}
+        for compile_update, algorithm in algorithms.items():
+            torch.manual_seed(args.seed)
+            stats[compile_update] = [algorithm.update_networks(b) for b in batches[recurrent][:4]]
+        max_abs_diff = max(abs(float(eager_stats[key]) - float(compiled_stats[key]))
+                           for eager_stats, compiled_stats in zip(stats[False], stats[True]) for key in eager_stats)
+        assert max_abs_diff < 1e-3, f"{algorithm_class.__name__}: compiled stats differ by up to {max_abs_diff}"
+
+        for compile_update, algorithm in algorithms.items():
+            batch_iterator = iter(batches[recurrent] * args.num_calls)
+            seconds = time_per_call(lambda: algorithm.update_networks(next(batch_iterator)),
+                                    num_calls=args.num_calls, num_warmup_calls=2)
+            mode = 'compiled' if compile_update else 'eager'
+            print(f'{algorithm_class.__name__:>19} {mode:>8}: {1 / seconds:8.1f} updates/s '
+                  f'(stats max abs diff {max_abs_diff:.1e})')
+
+
+def benchmark_act(args):
+
+    """
+    Actions per second of act (as called once per environment step in train), for each algorithm, with the numpy
+    forward pass (numpy_act, vector-observation algorithms on cpu only) and with the torch forward pass. Hidden states
+    of recurrent algorithms are reset every max_episode_steps calls, like at the end of an episode.
+    """
+
+    env = gym.make(args.env)
+    o_dim, a_dim = env.observation_space.shape[0], env.action_space.shape[0]
+
+    np.random.seed(args.seed)
+    observations = np.random.randn(env.spec.max_episode_steps, o_dim)
+
+    for algorithm_class in [DDPG, TD3, SAC, RecurrentDDPG, RecurrentTD3, RecurrentSAC, RecurrentSACSharing]:
+
+        recurrent = issubclass(algorithm_class, RecurrentOffPolicyRLAlgorithm)
+
+        for numpy_act in ([False] if recurrent else [False, True]):
+
+            torch.manual_seed(args.seed)
+            algorithm = algorithm_class(input_dim=o_dim, action_dim=a_dim) if recurrent else \
+                algorithm_class(input_dim=o_dim, action_dim=a_dim, numpy_act=numpy_act)
+            if numpy_act and not algorithm.numpy_act:
+                continue  # not on cpu
+
+            def act(t=iter(range(10 ** 9))):
+                t = next(t) % len(observations)
+                if recurrent and t == 0:
+                    algorithm.reinitialize_hidden()
+                return algorithm.act(observations[t], deterministic=False)
+
+            seconds = time_per_call(act, num_calls=args.num_calls * 250, num_warmup_calls=100)
+            mode = 'numpy' if numpy_act else 'torch'
+            print(f'{algorithm_class.__name__:>19} {mode:>5}: {1 / seconds:8.1f} actions/s')
+
+
+benchmarks = {
+    'packed': benchmark_packed,
+    'burn_in': benchmark_burn_in,
+    'buckets': benchmark_buckets,
+    'critic_ensemble': benchmark_critic_ensemble,
+    'polyak': benchmark_polyak,
+    'compile': benchmark_compile,
+    'act': benchmark_act,
+}
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmark', type=str, required=True, choices=list(benchmarks.keys()))
+    parser.add_argument('--env', type=str, default='cartpole-balance-pomdp-v0')
+    parser.add_argument('--num_episodes', type=int, default=200)
+    parser.add_argument('--batch_size', type=int, default=10)
+    parser.add_argument('--transition_batch_size', type=int, default=100)  # for non-recurrent algorithms
+    parser.add_argument('--num_calls', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--segment_len', type=int, default=50)
+    parser.add_argument('--burn_in', type=int, default=20)
+    parser.add_argument('--num_length_buckets', type=int, default=4)
+    args = parser.parse_args()
+
+    benchmarks[args.benchmark](args)
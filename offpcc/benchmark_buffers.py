@@ -0,0 +1,454 @@
+"""
+Micro-benchmarks for the replay buffers. These only use random data, so no environment is needed.
+
+Example usage:
+python benchmark_buffers.py --benchmark storage
+"""
+
+import argparse
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from basics.utils import get_device
+from basics.replay_buffer import ReplayBuffer, Batch
+from basics.replay_buffer_recurrent import RecurrentReplayBuffer, RecurrentImageReplayBuffer, RecurrentBatch, as_probas
+from basics.storage import ArrayStorage, num_bytes
+
+
+def time_per_call(fn, num_calls, num_warmup_calls=10) -> float:
+    for _ in range(num_warmup_calls):
+        fn()
+    start = time.perf_counter()
+    for _ in range(num_calls):
+        fn()
+    return (time.perf_counter() - start) / num_calls
+
+
+def fill_buffer(buffer, input_shape, action_dim, num_transitions, episode_len=1000):
+    for t in range(num_transitions):
+        s, ns = np.random.rand(*input_shape), np.random.rand(*input_shape)
+        buffer.push(s, np.random.uniform(-1, 1, action_dim), np.random.randn(), ns, False, (t + 1) % episode_len == 0)
+
+
+def fill_recurrent_buffer(buffer, o_dim, a_dim, num_episodes, episode_len):
+    for _ in range(num_episodes):
+        for t in range(episode_len):
+            buffer.push(np.random.randn(o_dim), np.random.uniform(-1, 1, a_dim), np.random.randn(),
+                        np.random.randn(o_dim), False, t == episode_len - 1)
+
+
+def benchmark_storage(args):
+
+    """Sample throughput of memmap vs in-memory storage; also checks that both return the same data."""
+
+    for input_shape, capacity in [((17,), int(1e6)), ((3, 84, 84), int(1e4))]:
+
+        buffers = {}
+        for storage in ['memory', 'memmap']:
+            np.random.seed(args.seed)
+            buffers[storage] = ReplayBuffer(input_shape, action_dim=6, capacity=capacity, batch_size=256,
+                                            use_aug_for_img=False, storage=storage)
+            fill_buffer(buffers[storage], input_shape, 6, num_transitions=min(capacity, args.num_pushes))
+
+        indices = np.random.randint(buffers['memory'].num_transitions, size=256)
+        assert np.array_equal(buffers['memory'].s[indices], buffers['memmap'].s[indices])
+
+        for storage, buffer in buffers.items():
+            seconds = time_per_call(buffer.sample, num_calls=args.num_calls)
+            print(f'ReplayBuffer {input_shape} {storage:>6}: {1 / seconds:8.1f} batches/s')
+
+    buffers = {}
+    for storage in ['memory', 'memmap']:
+        np.random.seed(args.seed)
+        buffers[storage] = RecurrentReplayBuffer(o_dim=17, a_dim=6, max_episode_len=1000, segment_len=100,
+                                                 capacity=1000, batch_size=10, storage=storage)
+        fill_recurrent_buffer(buffers[storage], 17, 6, num_episodes=100, episode_len=1000)
+
+    assert np.array_equal(buffers['memory'].o, buffers['memmap'].o)
+
+    for storage, buffer in buffers.items():
+        seconds = time_per_call(buffer.sample, num_calls=args.num_calls)
+        print(f'RecurrentReplayBuffer (sl100) {storage:>6}: {1 / seconds:8.1f} batches/s')
+
+
+def as_tensor_on_device(np_array: np.array):
+    return torch.tensor(np_array).float().to(get_device())
+
+
+def sample_with_copies(buffer: ReplayBuffer) -> Batch:
+    """How ReplayBuffer.sample used to materialize batches (vector and float32 image observations only)"""
+    indices = buffer.sample_indices()
+    s = as_tensor_on_device(buffer.s[indices]).view(buffer.batch_size, *buffer.input_shape)
+    a = as_tensor_on_device(buffer.a[indices]).view(buffer.batch_size, buffer.action_dim)
+    r = as_tensor_on_device(buffer.r[indices]).view(buffer.batch_size, 1)
+    ns = as_tensor_on_device(buffer.ns[indices]).view(buffer.batch_size, *buffer.input_shape)
+    d = as_tensor_on_device(buffer.d[indices]).view(buffer.batch_size, 1)
+    return Batch(s, a, r, ns, d)
+
+
+def sample_recurrent_with_copies(buffer: RecurrentReplayBuffer) -> RecurrentBatch:
+    """How RecurrentReplayBuffer.sample used to materialize full-episode batches (fancy indexing, then copies)"""
+    choices = buffer.sample_episode_slots()
+    max_ep_len_in_batch = int(np.max(buffer.ep_len[choices]))
+    time_steps = np.arange(max_ep_len_in_batch + 1)
+    rows = np.minimum(buffer.ep_offset[choices][:, np.newaxis] + time_steps, buffer.num_rows - 1)
+    o_mask = (time_steps <= buffer.ep_len[choices][:, np.newaxis])[:, :, np.newaxis]
+    m = (time_steps[:-1] < buffer.ep_len[choices][:, np.newaxis])[:, :, np.newaxis]
+    o = as_tensor_on_device(buffer.o[rows] * o_mask)
+    a = as_tensor_on_device(buffer.a[rows[:, :-1]] * m)
+    r = as_tensor_on_device(buffer.r[rows[:, :-1]] * m)
+    d = as_tensor_on_device(buffer.d[rows[:, :-1]] * m)
+    m = as_tensor_on_device(m)
+    return RecurrentBatch(o, a, r, d, m)
+
+
+def sample_segments_with_loop(buffer: RecurrentReplayBuffer) -> RecurrentBatch:
+    """How RecurrentReplayBuffer.sample used to extract segments (one item at a time)"""
+    choices = buffer.sample_episode_slots()
+    num_segments_for_each_item = np.ceil(buffer.ep_len[choices] / buffer.segment_len).astype(int)
+    o_seg = torch.zeros(buffer.batch_size, buffer.segment_len + 1, buffer.o_dim)
+    a_seg = torch.zeros(buffer.batch_size, buffer.segment_len, buffer.a_dim)
+    r_seg, d_seg, m_seg = [torch.zeros(buffer.batch_size, buffer.segment_len, 1) for _ in range(3)]
+    for i, choice in enumerate(choices):
+        start_idx = np.random.randint(num_segments_for_each_item[i]) * buffer.segment_len
+        first_row = buffer.ep_offset[choice] + start_idx
+        num_steps = min(buffer.segment_len, buffer.ep_len[choice] - start_idx)
+        o_seg[i, :num_steps + 1] = buffer.o_tensor[first_row:first_row + num_steps + 1]
+        a_seg[i, :num_steps] = buffer.a_tensor[first_row:first_row + num_steps]
+        r_seg[i, :num_steps] = buffer.r_tensor[first_row:first_row + num_steps]
+        d_seg[i, :num_steps] = buffer.d_tensor[first_row:first_row + num_steps]
+        m_seg[i, :num_steps] = 1
+    return RecurrentBatch(*[tensor.to(get_device()) for tensor in [o_seg, a_seg, r_seg, d_seg, m_seg]])
+
+
+def compare_sample_fns(name, buffer, sample_fns: dict, num_calls, seed) -> None:
+
+    batches = {}
+    for fn_name, fn in sample_fns.items():
+        np.random.seed(seed)
+        batches[fn_name] = [tensor.clone() for tensor in fn() if isinstance(tensor, torch.Tensor)]
+
+    reference = batches[list(sample_fns.keys())[0]]
+    for fn_name, batch in batches.items():
+        assert all(torch.equal(x, y) for x, y in zip(reference, batch)), f"{fn_name} returned a different batch"
+
+    for fn_name, fn in sample_fns.items():
+        seconds = time_per_call(fn, num_calls=num_calls)
+        print(f'{name} {fn_name:>20}: {seconds * 1e3:8.3f} ms/batch')
+
+
+def benchmark_sample(args):
+
+    """Sample latency with vs without preallocated staging tensors."""
+
+    for input_shape, capacity in [((17,), int(1e6)), ((3, 84, 84), int(1e4))]:
+        buffer = ReplayBuffer(input_shape, action_dim=6, capacity=capacity, batch_size=256, use_aug_for_img=False)
+        fill_buffer(buffer, input_shape, 6, num_transitions=min(capacity, args.num_pushes))
+        compare_sample_fns(f'ReplayBuffer {input_shape}', buffer, {
+            'copies (before)': lambda: sample_with_copies(buffer),
+            'staging (after)': buffer.sample
+        }, num_calls=args.num_calls, seed=args.seed)
+
+    buffer = RecurrentReplayBuffer(o_dim=17, a_dim=6, max_episode_len=1000, capacity=200, batch_size=10)
+    fill_recurrent_buffer(buffer, 17, 6, num_episodes=100, episode_len=1000)
+    compare_sample_fns('RecurrentReplayBuffer', buffer, {
+        'copies (before)': lambda: sample_recurrent_with_copies(buffer),
+        'staging (after)': buffer.sample
+    }, num_calls=args.num_calls, seed=args.seed)
+
+
+def benchmark_layouts(args):
+
+    """
+    Storage size and sample throughput of the observation layouts of ReplayBuffer for (3, 84, 84) images: full s and
+    ns vs deduplicate_ns, float32 vs uint8 frames, and frame_stack=3 (observations of 3 stacked (1, 84, 84) frames).
+    """
+
+    input_shape, capacity = (3, 84, 84), min(int(1e4), args.num_pushes)
+
+    layouts = {
+        'plain float32': dict(),
+        'dedup float32': dict(deduplicate_ns=True),
+        'plain uint8': dict(store_img_as_uint8=True),
+        'dedup uint8': dict(deduplicate_ns=True, store_img_as_uint8=True),
+        'frame_stack=3 uint8': dict(frame_stack=3, store_img_as_uint8=True),
+    }
+
+    for name, kwargs in layouts.items():
+        np.random.seed(args.seed)
+        buffer = ReplayBuffer(input_shape, action_dim=6, capacity=capacity, batch_size=256, use_aug_for_img=False,
+                              **kwargs)
+        fill_buffer(buffer, input_shape, 6, num_transitions=capacity)
+        storage_size, naive_storage_size = buffer.get_storage_size_in_gb()
+        seconds = time_per_call(buffer.sample, num_calls=args.num_calls)
+        print(f'ReplayBuffer {input_shape} {name:>19}: {storage_size:7.3f} GB '
+              f'(full s and ns: {naive_storage_size:7.3f} GB), {1 / seconds:8.1f} batches/s')
+
+
+def benchmark_device(args):
+
+    """Sample latency with device-resident storage (pure torch) vs in-memory storage."""
+
+    print(f'Device: {get_device()}')
+
+    for storage in ['memory', 'device']:
+        np.random.seed(args.seed)
+        buffer = ReplayBuffer((5,), action_dim=1, capacity=int(1e6), batch_size=256, storage=storage)
+        fill_buffer(buffer, (5,), 1, num_transitions=args.num_pushes, episode_len=200)
+        seconds = time_per_call(buffer.sample, num_calls=args.num_calls)
+        print(f'ReplayBuffer (5,) {storage:>6}: {seconds * 1e3:8.3f} ms/batch')
+
+
+def benchmark_push(args):
+
+    """Insertion throughput of push_batch vs push (one transition at a time); also checks that both agree."""
+
+    num_transitions, episode_len = args.num_pushes, 200
+
+    s = np.random.rand(num_transitions, 17)
+    a = np.random.uniform(-1, 1, (num_transitions, 6))
+    r = np.random.randn(num_transitions)
+    ns = np.random.rand(num_transitions, 17)
+    d = np.zeros(num_transitions)
+    cutoff = (np.arange(num_transitions) + 1) % episode_len == 0
+
+    for storage in ArrayStorage.BACKENDS:
+
+        buffers = {}
+        for push_fn in ['push', 'push_batch']:
+            buffer = ReplayBuffer((17,), action_dim=6, capacity=num_transitions // 2, storage=storage)
+            start = time.perf_counter()
+            if push_fn == 'push':
+                for i in range(num_transitions):
+                    buffer.push(s[i], a[i], r[i], ns[i], d[i], cutoff[i])
+            else:
+                buffer.push_batch(s, a, r, ns, d, cutoff)
+            seconds = time.perf_counter() - start
+            print(f'ReplayBuffer (17,) {storage:>6} {push_fn:>10}: {num_transitions / seconds:12.1f} transitions/s')
+            buffers[push_fn] = buffer
+
+        assert buffers['push'].ptr == buffers['push_batch'].ptr
+        assert all(torch.equal(ArrayStorage.as_tensor(getattr(buffers['push'], key)),
+                               ArrayStorage.as_tensor(getattr(buffers['push_batch'], key))) for key in 's a r ns d'.split())
+
+    buffers = {}
+    for push_fn in ['push', 'push_batch']:
+        buffer = RecurrentReplayBuffer(o_dim=17, a_dim=6, max_episode_len=episode_len, capacity=1000, batch_size=10)
+        start = time.perf_counter()
+        if push_fn == 'push':
+            for i in range(num_transitions):
+                buffer.push(s[i], a[i], r[i], ns[i], d[i], cutoff[i])
+        else:
+            buffer.push_batch(s, a, r, ns, d, cutoff)
+        seconds = time.perf_counter() - start
+        print(f'RecurrentReplayBuffer {push_fn:>10}: {num_transitions / seconds:12.1f} transitions/s')
+        buffers[push_fn] = buffer
+
+    assert all(np.array_equal(getattr(buffers['push'], key), getattr(buffers['push_batch'], key))
+               for key in 'o a r d ep_offset ep_len ready_for_sampling'.split())
+
+
+def benchmark_snapshot(args):
+
+    """Save / load time of a full buffer snapshot, with and without compression; also checks the round trip."""
+
+    num_transitions = args.num_pushes
+    buffer = ReplayBuffer((17,), action_dim=6, capacity=num_transitions, batch_size=256)
+    buffer.push_batch(np.random.rand(num_transitions, 17), np.random.uniform(-1, 1, (num_transitions, 6)),
+                      np.random.randn(num_transitions), np.random.rand(num_transitions, 17),
+                      np.zeros(num_transitions), (np.arange(num_transitions) + 1) % 1000 == 0)
+
+    for compress in [False, True]:
+
+        with tempfile.TemporaryDirectory() as save_dir:
+
+            start = time.perf_counter()
+            buffer.save(save_dir, compress=compress)
+            save_seconds = time.perf_counter() - start
+
+            restored = ReplayBuffer((17,), action_dim=6, capacity=num_transitions, batch_size=256)
+            start = time.perf_counter()
+            restored.load(save_dir)
+            load_seconds = time.perf_counter() - start
+
+        assert restored.ptr == buffer.ptr and restored.num_transitions == buffer.num_transitions
+        assert all(np.array_equal(getattr(restored, key), getattr(buffer, key)) for key in 's a r ns d'.split())
+        np.random.seed(args.seed)
+        expected = buffer.sample_indices()
+        np.random.seed(args.seed)
+        assert np.array_equal(restored.sample_indices(), expected)
+
+        print(f'ReplayBuffer (17,) {num_transitions} transitions (compress={compress}): '
+              f'save {save_seconds:.2f} s, load {load_seconds:.2f} s')
+
+
+def benchmark_ragged(args):
+
+    """Number of episodes held by padded vs ragged storage of the same size, with early termination; sample latency."""
+
+    max_episode_len, num_transitions = 1000, args.num_pushes
+    ep_lens = np.minimum(np.random.geometric(1 / 100, size=num_transitions), max_episode_len)  # e.g., cartpole
+    ep_ends = np.cumsum(ep_lens)
+    cutoff = np.zeros(num_transitions, dtype=bool)
+    cutoff[ep_ends[ep_ends <= num_transitions] - 1] = True
+
+    o, no = np.random.randn(num_transitions, 5), np.random.randn(num_transitions, 5)
+    a, r = np.random.uniform(-1, 1, (num_transitions, 1)), np.random.randn(num_transitions)
+
+    for ragged in [False, True]:
+        buffer = RecurrentReplayBuffer(o_dim=5, a_dim=1, max_episode_len=max_episode_len, capacity=100, batch_size=10,
+                                       ragged=ragged)
+        buffer.push_batch(o, a, r, no, np.zeros(num_transitions), cutoff)
+        num_stored_transitions = int(np.sum(buffer.ep_len[buffer.ready_for_sampling]))
+        seconds = time_per_call(buffer.sample, num_calls=args.num_calls)
+        print(f'RecurrentReplayBuffer (ragged={ragged!s:>5}) {buffer.num_rows} rows: {buffer.num_episodes:5d} episodes, '
+              f'{num_stored_transitions:6d} transitions, {seconds * 1e3:.3f} ms/batch')
+
+
+def benchmark_segment(args):
+
+    """Segment sampling with a per-item loop vs a single gather, as in template_recurrent_1m_sl100_pybullet.gin."""
+
+    buffer = RecurrentReplayBuffer(o_dim=17, a_dim=6, max_episode_len=1000, segment_len=100, capacity=1000,
+                                   batch_size=10)
+    fill_recurrent_buffer(buffer, 17, 6, num_episodes=max(10, args.num_pushes // 1000), episode_len=1000)
+
+    compare_sample_fns('RecurrentReplayBuffer (sl100)', buffer, {
+        'loop (before)': lambda: sample_segments_with_loop(buffer),
+        'gather (after)': buffer.sample
+    }, num_calls=args.num_calls, seed=args.seed)
+
+    buffer.batch_size = 256
+    compare_sample_fns('RecurrentReplayBuffer (sl100, bs256)', buffer, {
+        'loop (before)': lambda: sample_segments_with_loop(buffer),
+        'gather (after)': buffer.sample
+    }, num_calls=args.num_calls, seed=args.seed)
+
+
+def sample_episode_slots_with_choice(buffer: RecurrentReplayBuffer) -> np.array:
+    """How RecurrentReplayBuffer used to sample episodes (O(num_episode_slots) work per batch)"""
+    options = np.where(buffer.ready_for_sampling == 1)[0]
+    return np.random.choice(options, p=as_probas(buffer.ep_len[options]), size=buffer.batch_size)
+
+
+def benchmark_episodes(args):
+
+    """Latency of drawing a batch of episode slots with np.random.choice vs the sum tree; also checks frequencies."""
+
+    # capacity of template_recurrent_200k_gru.gin, with uniform episode lengths (padded) or short ones (ragged)
+
+    for ragged, mean_ep_len in [(False, 100), (True, 10)]:
+
+        buffer = RecurrentReplayBuffer(o_dim=1, a_dim=1, max_episode_len=200, capacity=5000, batch_size=10,
+                                       ragged=ragged)
+        ep_lens = np.minimum(np.random.geometric(1 / mean_ep_len, size=args.num_pushes // mean_ep_len), 200)
+        cutoff = np.zeros(np.sum(ep_lens), dtype=bool)
+        cutoff[np.cumsum(ep_lens) - 1] = True
+        zeros = np.zeros((len(cutoff), 1))
+        buffer.push_batch(zeros, zeros, zeros, zeros, zeros, cutoff)
+
+        buffer.batch_size = 100000
+        counts = np.bincount(buffer.sample_episode_slots(), minlength=buffer.num_episode_slots)
+        expected_counts = buffer.batch_size * as_probas(buffer.ep_len * buffer.ready_for_sampling)
+        assert np.all(np.abs(counts - expected_counts) < 6 * np.sqrt(expected_counts) + 1)
+        buffer.batch_size = 10
+
+        name = f'RecurrentReplayBuffer ({buffer.num_episode_slots} slots, {buffer.num_episodes} episodes)'
+        for fn_name, fn in [('choice (before)', lambda: sample_episode_slots_with_choice(buffer)),
+                            ('sum tree (after)', buffer.sample_episode_slots)]:
+            seconds = time_per_call(fn, num_calls=args.num_calls)
+            print(f'{name} {fn_name:>16}: {seconds * 1e3:8.3f} ms/batch')
+
+
+def benchmark_buckets(args):
+
+    """
+    Padding ratio of full-episode batches without vs with length buckets, for episodes of mixed lengths (uniform in
+    [10, 200], roughly like pendulum-var-len); also checks that episodes are still sampled proportionally to length.
+    """
+
+    ep_lens = np.random.randint(10, 201, size=args.num_pushes // 100)
+    cutoff = np.zeros(np.sum(ep_lens), dtype=bool)
+    cutoff[np.cumsum(ep_lens) - 1] = True
+    zeros = np.zeros((len(cutoff), 1))
+
+    for num_length_buckets in [1, 4, 8]:
+
+        buffer = RecurrentReplayBuffer(o_dim=1, a_dim=1, max_episode_len=200, capacity=len(ep_lens), batch_size=10,
+                                       num_length_buckets=num_length_buckets)
+        buffer.push_batch(zeros, zeros, zeros, zeros, zeros, cutoff)
+
+        counts = np.bincount(np.concatenate([buffer.sample_episode_slots() for _ in range(10000)]),
+                             minlength=buffer.num_episode_slots)
+        expected_counts = np.sum(counts) * as_probas(buffer.ep_len * buffer.ready_for_sampling)
+        assert np.all(np.abs(counts - expected_counts) < 6 * np.sqrt(expected_counts) + 1)
+
+        padding_ratios = []
+        for _ in range(args.num_calls):
+            buffer.sample()
+            padding_ratios.append(buffer.padding_ratio)
+
+        seconds = time_per_call(buffer.sample, num_calls=args.num_calls)
+        print(f'RecurrentReplayBuffer ({num_length_buckets} length buckets): {np.mean(padding_ratios):6.1%} padding, '
+              f'{seconds * 1e3:8.3f} ms/batch')
+
+
+def benchmark_recurrent_images(args):
+
+    """
+    Storage size and sample throughput of RecurrentImageReplayBuffer at a capacity of 1000 episodes of 200 (3, 84, 84)
+    frames, memory-mapped (files are sparse, so only the pushed episodes take disk space), with and without random
+    shifts; full-episode (bs 8) and segment (sl 50, bs 32) batches.
+    """
+
+    o_shape, max_episode_len, num_episodes = (3, 84, 84), 200, max(args.num_pushes // 2000, 8)
+
+    for segment_len, batch_size in [(None, 8), (50, 32)]:
+
+        buffer = RecurrentImageReplayBuffer(o_shape, 1, max_episode_len, segment_len=segment_len, capacity=1000,
+                                            batch_size=batch_size, storage='memmap')
+        for _ in range(num_episodes):
+            frames = np.random.randint(0, 256, size=(max_episode_len + 1, *o_shape), dtype=np.uint8)
+            cutoff = np.arange(max_episode_len) == max_episode_len - 1
+            zeros = np.zeros((max_episode_len, 1))
+            buffer.push_batch(frames[:-1], zeros, zeros, frames[1:], zeros, cutoff)
+
+        frames_num_bytes = num_bytes(buffer.o)  # all rows, pushed or not
+        print(f'RecurrentImageReplayBuffer (sl {segment_len}, bs {batch_size}) storage: '
+              f'{frames_num_bytes / 1e9:.3f} GB of uint8 frames (float32 frames: {4 * frames_num_bytes / 1e9:.3f} GB)')
+
+        for use_aug_for_img in [False, True]:
+            buffer.use_aug_for_img = use_aug_for_img
+            seconds = time_per_call(buffer.sample, num_calls=args.num_calls, num_warmup_calls=2)
+            num_frames = batch_size * (max_episode_len + 1 if segment_len is None else segment_len + 1)
+            print(f'RecurrentImageReplayBuffer (sl {segment_len}, bs {batch_size}, aug {use_aug_for_img}): '
+                  f'{1 / seconds:8.1f} batches/s, {num_frames / seconds:10.0f} frames/s')
+
+
+benchmarks = {
+    'storage': benchmark_storage,
+    'sample': benchmark_sample,
+    'layouts': benchmark_layouts,
+    'device': benchmark_device,
+    'push': benchmark_push,
+    'snapshot': benchmark_snapshot,
+    'ragged': benchmark_ragged,
+    'segment': benchmark_segment,
+    'episodes': benchmark_episodes,
+    'buckets': benchmark_buckets,
+    'recurrent_images': benchmark_recurrent_images,
+}
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmark', type=str, required=True, choices=list(benchmarks.keys()))
+    parser.add_argument('--num_calls', type=int, default=1000)
+    parser.add_argument('--num_pushes', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    benchmarks[args.benchmark](args)
@@ -79,7 +79,7 @@ register(
 
 register(
     id='cartpole-balance-pomdp-v0',
-    entry_point='domains.cartpole_balance:pomdp',
+    entry_point='domains.cartpole_balance:p',
     max_episode_steps=200,
 )
 
@@ -101,7 +101,9 @@ for run_id in args.run_id:  # args.run_id is a list of ints; could contain more
             buffer = RecurrentReplayBuffer(
                 o_dim=example_env.observation_space.shape[0],
                 a_dim=example_env.action_space.shape[0],
-                max_episode_len=example_env.spec.max_episode_steps
+                max_episode_len=example_env.spec.max_episode_steps,
+                hidden_state_size=0 if algorithm.burn_in is None else algorithm.hidden_state_size,
+                burn_in=algorithm.burn_in or 0
             )
         elif isinstance(algorithm, OffPolicyRLAlgorithm):
             buffer = ReplayBuffer(
@@ -109,6 +111,9 @@ for run_id in args.run_id:  # args.run_id is a list of ints; could contain more
                 action_dim=example_env.action_space.shape[0]
             )
 
+        if buffer.storage.backend == 'memmap':
+            print(f"=> Replay buffer arrays are memory-mapped in {buffer.storage.dir}")
+
         train(
             env_fn=env_fn,
             algorithm=algorithm,
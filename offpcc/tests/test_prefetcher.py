@@ -0,0 +1,33 @@
+import numpy as np
+import torch
+
+from algorithms_recurrent.recurrent_sac import RecurrentSAC
+from basics.prefetcher import BatchPrefetcher
+from basics.replay_buffer_recurrent import RecurrentReplayBuffer
+from basics.utils import get_device
+
+
+def test_recurrent_update_from_prefetched_batch_with_lengths():
+
+    np.random.seed(0)
+    torch.manual_seed(0)
+
+    buffer = RecurrentReplayBuffer(o_dim=3, a_dim=2, max_episode_len=10, capacity=20, batch_size=4,
+                                   return_lengths=True)
+    for episode_len in [3, 10, 6, 1, 8, 5]:
+        for t in range(episode_len):
+            buffer.push(np.random.randn(3), np.random.uniform(-1, 1, 2), np.random.randn(), np.random.randn(3),
+                        d=False, cutoff=t == episode_len - 1)
+
+    algorithm = RecurrentSAC(input_dim=3, action_dim=2, hidden_dim=16)
+    prefetcher = BatchPrefetcher(buffer, num_batches=2)
+
+    try:
+        for _ in range(3):
+            batch = prefetcher.sample()
+            assert batch.l.device.type == 'cpu'  # pack_padded_sequence only takes cpu lengths
+            assert batch.o.device.type == torch.device(get_device()).type
+            stats = algorithm.update_networks(batch)
+            assert all(np.isfinite(float(value)) for value in stats.values())
+    finally:
+        prefetcher.close()
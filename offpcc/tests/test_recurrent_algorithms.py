@@ -0,0 +1,16 @@
+import pytest
+import torch
+
+from algorithms_recurrent import RecurrentDDPG, RecurrentTD3, RecurrentSAC, RecurrentSACSharing
+from basics.replay_buffer_recurrent import RecurrentBatch
+
+
+@pytest.mark.parametrize('algorithm_class', [RecurrentDDPG, RecurrentTD3, RecurrentSAC, RecurrentSACSharing])
+def test_lengths_off_cpu_are_rejected(algorithm_class):
+    algorithm = algorithm_class(input_dim=3, action_dim=2, hidden_dim=16)
+    batch = RecurrentBatch(
+        o=torch.randn(4, 6, 3), a=torch.rand(4, 5, 2), r=torch.randn(4, 5, 1), d=torch.zeros(4, 5, 1),
+        m=torch.ones(4, 5, 1), l=torch.full((4,), 5, device='meta')  # stands for lengths moved to cuda
+    )
+    with pytest.raises(AssertionError, match='must be on cpu'):
+        algorithm.update_networks(batch)
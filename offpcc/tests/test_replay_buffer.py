@@ -0,0 +1,132 @@
+import numpy as np
+import pytest
+import torch
+
+from basics.replay_buffer import ReplayBuffer
+
+
+def push_episodes(buffer, episode_lens, input_shape, frame_stack=1):
+
+    """
+    Pushes random episodes one transition at a time and returns the pushed transitions (s, a, r, ns, d) as float32
+    arrays, in push order. With frame_stack > 1, observations stack the last frame_stack frames (oldest first, zeros
+    before the start of the episode), like ConcatImages.
+    """
+
+    frame_shape = (input_shape[0] // frame_stack, *input_shape[1:])
+    transitions = []
+
+    for episode_len in episode_lens:
+
+        frames = [np.zeros(frame_shape, dtype=np.float32)] * (frame_stack - 1) + \
+            [np.random.rand(*frame_shape).astype(np.float32) for _ in range(episode_len + 1)]
+        observations = [np.concatenate(frames[t:t + frame_stack]) for t in range(episode_len + 1)]
+        done = np.random.rand() < 0.5  # otherwise, the episode is cut off
+
+        for t in range(episode_len):
+            s, ns = observations[t], observations[t + 1]
+            a = np.random.uniform(-1, 1, 2).astype(np.float32)
+            r = np.float32(np.random.randn())
+            d = np.float32(done and t == episode_len - 1)
+            buffer.push(s, a, r, ns, d, cutoff=t == episode_len - 1)
+            transitions.append((s, a, r, ns, d))
+
+    return transitions
+
+
+def assert_batch_from(batch, transitions):
+    """Each item of batch must be one of transitions, which are looked up by their (unique, random) action."""
+    by_action = {a.tobytes(): (s, r, ns, d) for s, a, r, ns, d in transitions}
+    for s, a, r, ns, d in zip(*[field.numpy() for field in batch[:5]]):
+        assert a.tobytes() in by_action, "sampled a transition that was never pushed or was overwritten"
+        expected_s, expected_r, expected_ns, expected_d = by_action[a.tobytes()]
+        np.testing.assert_array_equal(s, expected_s)
+        np.testing.assert_array_equal(ns, expected_ns)
+        assert r[0] == expected_r and d[0] == expected_d
+
+
+@pytest.mark.parametrize('deduplicate_ns', [False, True])
+def test_samples_match_pushed_transitions_after_wrapping(deduplicate_ns):
+
+    np.random.seed(0)
+
+    buffer = ReplayBuffer((4,), action_dim=2, capacity=50, batch_size=32, deduplicate_ns=deduplicate_ns)
+    transitions = push_episodes(buffer, np.random.randint(1, 12, size=20), (4,))
+    assert len(transitions) > buffer.capacity  # the ring has wrapped around
+
+    for _ in range(20):
+        # transitions older than the last capacity ones have been overwritten
+        assert_batch_from(buffer.sample(), transitions[-buffer.capacity:])
+
+
+def test_frame_stack_rebuilds_stacked_observations():
+
+    np.random.seed(0)
+
+    input_shape = (3, 5, 5)  # 3 stacked (1, 5, 5) frames
+    buffer = ReplayBuffer(input_shape, action_dim=2, capacity=40, batch_size=32, use_aug_for_img=False,
+                          frame_stack=3)
+    transitions = push_episodes(buffer, np.random.randint(1, 8, size=15), input_shape, frame_stack=3)
+    assert len(transitions) > buffer.capacity
+
+    for _ in range(20):
+        assert_batch_from(buffer.sample(), transitions[-buffer.capacity:])
+
+
+def test_batch_is_reused_by_the_next_sample():
+
+    np.random.seed(0)
+
+    buffer = ReplayBuffer((4,), action_dim=2, capacity=100, batch_size=16)
+    transitions = push_episodes(buffer, [30, 30], (4,))
+
+    first_batch = buffer.sample()
+    first_copy = [tensor.clone() for tensor in first_batch[:5]]
+    second_batch = buffer.sample()
+
+    # batches are views of the same staging tensors, so sampling again allocates nothing (and overwrites them)
+    for first_tensor, second_tensor in zip(first_batch[:5], second_batch[:5]):
+        assert first_tensor.data_ptr() == second_tensor.data_ptr()
+
+    assert_batch_from(first_copy, transitions)
+    assert_batch_from(second_batch, transitions)
+
+
+def test_save_load_round_trip_after_wrapping(tmp_path):
+
+    np.random.seed(0)
+
+    def make_buffer():
+        return ReplayBuffer((4,), action_dim=2, capacity=50, batch_size=32, deduplicate_ns=True)
+
+    buffer = make_buffer()
+    transitions = push_episodes(buffer, np.random.randint(1, 12, size=20), (4,))
+    assert len(transitions) > buffer.capacity and buffer.num_transitions == buffer.capacity
+    buffer.save(tmp_path)
+
+    loaded_buffer = make_buffer()
+    loaded_buffer.load(tmp_path)  # also restores numpy's RNG state at save time
+
+    for name in ['s', 'a', 'r', 'd', 'valid', 'ep_step']:
+        np.testing.assert_array_equal(getattr(loaded_buffer, name), getattr(buffer, name))
+    assert (loaded_buffer.ptr, loaded_buffer.num_transitions) == (buffer.ptr, buffer.num_transitions)
+
+    for _ in range(5):
+        rng_state = np.random.get_state()
+        loaded_batch = [tensor.clone() for tensor in loaded_buffer.sample()[:5]]
+        np.random.set_state(rng_state)
+        batch = buffer.sample()
+        for tensor, loaded_tensor in zip(batch[:5], loaded_batch):
+            assert torch.equal(loaded_tensor, tensor)
+        assert_batch_from(loaded_batch, transitions[-buffer.capacity:])
+
+
+def test_load_rejects_a_snapshot_without_state(tmp_path):
+
+    buffer = ReplayBuffer((4,), action_dim=2, capacity=50, batch_size=8, deduplicate_ns=True)
+    push_episodes(buffer, [10, 10], (4,))
+    buffer.save(tmp_path)
+    (tmp_path / 'state.pkl').unlink()  # as if saving had been interrupted before the state was written
+
+    with pytest.raises(FileNotFoundError, match='no complete snapshot'):
+        ReplayBuffer((4,), action_dim=2, capacity=50, batch_size=8, deduplicate_ns=True).load(tmp_path)
@@ -0,0 +1,231 @@
+from collections import deque
+
+import numpy as np
+import pytest
+
+from basics.replay_buffer_recurrent import RecurrentReplayBuffer
+
+O_DIM, A_DIM, HIDDEN_STATE_SIZE = 3, 2, 4
+
+
+def make_episode(episode_id, episode_len):
+    """Random episode whose observations start with (episode_id, t), so that sampled items can be traced back."""
+    o = np.random.randn(episode_len + 1, O_DIM).astype(np.float32)
+    o[:, 0], o[:, 1] = episode_id, np.arange(episode_len + 1)
+    return dict(
+        o=o,
+        a=np.random.uniform(-1, 1, (episode_len, A_DIM)).astype(np.float32),
+        r=np.random.randn(episode_len).astype(np.float32),
+        d=np.arange(episode_len) == episode_len - 1 if np.random.rand() < 0.5 else np.zeros(episode_len, dtype=bool),
+        h=np.random.randn(episode_len, HIDDEN_STATE_SIZE).astype(np.float32),  # before each of o[:-1]
+    )
+
+
+def push_episodes(buffer, episode_lens, first_episode_id=1):
+    episodes = {}
+    for episode_id, episode_len in enumerate(episode_lens, start=first_episode_id):
+        episode = episodes[episode_id] = make_episode(episode_id, episode_len)
+        for t in range(episode_len):
+            buffer.push(episode['o'][t], episode['a'][t], episode['r'][t], episode['o'][t + 1], episode['d'][t],
+                        cutoff=t == episode_len - 1,
+                        hidden_state=episode['h'][t] if buffer.hidden_state_size > 0 else None)
+    return episodes
+
+
+def reference_item(episode, start_step, num_steps):
+    """Item of num_steps steps from start_step, padded with zeros past the end of the episode."""
+    episode_len = len(episode['a'])
+    item = dict(
+        o=np.zeros((num_steps + 1, O_DIM)), a=np.zeros((num_steps, A_DIM)), r=np.zeros((num_steps, 1)),
+        d=np.zeros((num_steps, 1)), m=np.zeros((num_steps, 1))
+    )
+    for k in range(num_steps + 1):
+        t = start_step + k
+        if t <= episode_len:
+            item['o'][k] = episode['o'][t]
+        if k < num_steps and t < episode_len:
+            item['a'][k], item['r'][k], item['d'][k] = episode['a'][t], episode['r'][t], episode['d'][t]
+            item['m'][k] = 1
+    item['l'] = int(np.clip(episode_len - start_step, 0, num_steps))
+    return item
+
+
+def check_batch(buffer, batch, episodes, stored_episode_ids):
+
+    """Checks each item of batch against the episode it comes from, and returns the ids of these episodes."""
+
+    num_steps = batch.a.shape[1]
+    if buffer.segment_len is not None:
+        assert num_steps == buffer.segment_len
+
+    episode_ids = []
+
+    for i in range(buffer.batch_size):
+
+        episode_id, start_step = int(batch.o[i, 0, 0]), int(batch.o[i, 0, 1])
+        assert episode_id in stored_episode_ids, "sampled an episode that was never pushed or was evicted"
+        episode_ids.append(episode_id)
+
+        episode = episodes[episode_id]
+        item = reference_item(episode, start_step, num_steps)
+        for key in 'oardm':
+            np.testing.assert_array_equal(getattr(batch, key)[i].numpy(), item[key])
+        if buffer.return_lengths:
+            assert int(batch.l[i]) == item['l']
+
+        if buffer.segment_len is None:
+            assert start_step == 0
+        else:
+            assert start_step % buffer.segment_len == 0
+
+        if buffer.hidden_state_size > 0:
+            burn_in_start = start_step - buffer.burn_in
+            if start_step == 0:  # starts from the zero state, without burn-in
+                assert not batch.h[i].any() and not batch.bo[i].any() and not batch.bm[i].any()
+            else:
+                np.testing.assert_array_equal(batch.h[i].numpy(), episode['h'][burn_in_start])
+                np.testing.assert_array_equal(batch.bo[i].numpy(), episode['o'][burn_in_start:start_step])
+                assert batch.bm[i].all()
+
+    if buffer.segment_len is None:  # padded up to the longest episode in the batch
+        assert num_steps == max(len(episodes[episode_id]['a']) for episode_id in episode_ids)
+
+    return episode_ids
+
+
+@pytest.mark.parametrize('segment_len', [None, 5])
+def test_samples_match_pushed_episodes(segment_len):
+
+    np.random.seed(0)
+
+    buffer = RecurrentReplayBuffer(O_DIM, A_DIM, max_episode_len=10, segment_len=segment_len, capacity=8,
+                                   batch_size=8, return_lengths=True)
+    episodes = push_episodes(buffer, np.random.randint(1, 11, size=30))
+
+    assert buffer.num_episodes == buffer.capacity
+    stored_episode_ids = set(list(episodes)[-buffer.capacity:])  # first-in-first-out
+
+    for _ in range(20):
+        check_batch(buffer, buffer.sample(), episodes, stored_episode_ids)
+
+
+def reference_ragged_episode_ids(buffer, episode_lens):
+
+    """
+    Ids of the episodes that a ragged buffer should still hold: episodes are laid out one after the other, starting
+    over from the first row when the longest possible one would not fit, and the oldest ones are evicted when their
+    rows get overwritten (or when there are no episode slots left).
+    """
+
+    stored = deque()  # (episode_id, start_row, end_row), oldest first
+    row_ptr = 0
+
+    def evict_overlapping(start_row, end_row):
+        while stored and stored[0][1] < end_row and stored[0][2] > start_row:
+            stored.popleft()
+
+    for episode_id, episode_len in enumerate(episode_lens, start=1):
+        if len(stored) == buffer.num_episode_slots:
+            stored.popleft()
+        if row_ptr + buffer.max_episode_len + 1 > buffer.num_rows:
+            evict_overlapping(row_ptr, buffer.num_rows)
+            row_ptr = 0
+        evict_overlapping(row_ptr, row_ptr + episode_len + 1)
+        stored.append((episode_id, row_ptr, row_ptr + episode_len + 1))
+        row_ptr += episode_len + 1
+
+    return [episode_id for episode_id, _, _ in stored]
+
+
+def test_ragged_buffer_evicts_oldest_episodes_first():
+
+    np.random.seed(0)
+
+    buffer = RecurrentReplayBuffer(O_DIM, A_DIM, max_episode_len=10, capacity=6, batch_size=8, ragged=True,
+                                   return_lengths=True)
+    episode_lens = np.random.choice([1, 2, 3, 10], size=60)
+    episodes = push_episodes(buffer, episode_lens)
+
+    expected_episode_ids = reference_ragged_episode_ids(buffer, episode_lens)
+    assert expected_episode_ids == list(episodes)[-len(expected_episode_ids):]  # a suffix of the pushed episodes
+    assert buffer.num_episodes == len(expected_episode_ids) > buffer.capacity  # short episodes take fewer rows
+
+    sampled_episode_ids = set()
+    for _ in range(50):
+        sampled_episode_ids.update(check_batch(buffer, buffer.sample(), episodes, set(expected_episode_ids)))
+    assert sampled_episode_ids == set(expected_episode_ids)
+
+
+def test_each_batch_is_drawn_from_a_single_length_bucket():
+
+    np.random.seed(0)
+
+    buffer = RecurrentReplayBuffer(O_DIM, A_DIM, max_episode_len=27, capacity=28, batch_size=8, return_lengths=True,
+                                   num_length_buckets=3)
+    # buckets [1, 3], [4, 9] and [10, 27], with similar total lengths (which buckets are drawn proportionally to)
+    episodes = push_episodes(buffer, np.random.permutation([2] * 20 + [6] * 6 + [20] * 2))
+
+    sampled_buckets = set()
+    for _ in range(50):
+        episode_ids = check_batch(buffer, buffer.sample(), episodes, set(episodes))
+        buckets = set(buffer.length_buckets(np.array([len(episodes[episode_id]['a']) for episode_id in episode_ids])))
+        assert len(buckets) == 1
+        sampled_buckets.update(buckets)
+    assert sampled_buckets == {0, 1, 2}
+
+
+def test_segments_come_with_the_hidden_states_and_observations_of_their_burn_in_prefix():
+
+    np.random.seed(0)
+
+    buffer = RecurrentReplayBuffer(O_DIM, A_DIM, max_episode_len=12, segment_len=4, capacity=8, batch_size=8,
+                                   hidden_state_size=HIDDEN_STATE_SIZE, burn_in=2)
+    episodes = push_episodes(buffer, np.random.randint(1, 13, size=15))
+
+    for _ in range(20):
+        batch = buffer.sample()
+        assert batch.h.shape == (8, HIDDEN_STATE_SIZE) and batch.bo.shape == (8, 2, O_DIM)
+        check_batch(buffer, batch, episodes, set(list(episodes)[-buffer.capacity:]))
+
+
+@pytest.mark.parametrize('kwargs', [
+    dict(ragged=True, return_lengths=True, num_length_buckets=2),
+    dict(segment_len=4, hidden_state_size=HIDDEN_STATE_SIZE, burn_in=2),
+])
+def test_save_load_sample_round_trip(tmp_path, kwargs):
+
+    def make_buffer():
+        return RecurrentReplayBuffer(O_DIM, A_DIM, max_episode_len=12, capacity=6, batch_size=4, **kwargs)
+
+    np.random.seed(0)
+
+    buffer = make_buffer()
+    episodes = push_episodes(buffer, np.random.randint(1, 13, size=20))
+    for t in range(3):  # an unfinished episode, which is dropped by load
+        buffer.push(np.ones(O_DIM), np.zeros(A_DIM), 0, np.ones(O_DIM), d=False, cutoff=False,
+                    hidden_state=np.zeros(HIDDEN_STATE_SIZE))
+    buffer.save(tmp_path)
+
+    loaded_buffer = make_buffer()
+    loaded_buffer.load(tmp_path)  # also restores numpy's RNG state at save time
+
+    for key, array in buffer.get_snapshot_arrays(buffer.num_rows_used, buffer.num_episode_slots_used).items():
+        np.testing.assert_array_equal(
+            loaded_buffer.get_snapshot_arrays(buffer.num_rows_used, buffer.num_episode_slots_used)[key], array
+        )
+    assert loaded_buffer.num_episodes == buffer.num_episodes
+
+    rng_state = np.random.get_state()
+    loaded_batch = loaded_buffer.sample()
+    np.random.set_state(rng_state)
+    # the unfinished episode is not sampled by the original buffer either
+    batch = buffer.sample()
+
+    for field, loaded_field in zip(batch, loaded_batch):
+        if field is not None:
+            np.testing.assert_array_equal(loaded_field.numpy(), field.numpy())
+    check_batch(loaded_buffer, loaded_batch, episodes, set(episodes))
+
+    # pushing resumes with a new episode
+    new_episodes = push_episodes(loaded_buffer, [12] * 6, first_episode_id=100)
+    check_batch(loaded_buffer, loaded_buffer.sample(), new_episodes, set(new_episodes))
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+import torch
+
+from basics.replay_buffer import ReplayBuffer
+from basics.storage import StagingArea
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="copies to device are only asynchronous on cuda")
+def test_back_to_back_samples_do_not_corrupt_the_first_batch():
+
+    # large batches, so that the copy of the first one is still running while the second one is gathered
+
+    buffer = ReplayBuffer(input_shape=(64,), action_dim=8, capacity=100_000, batch_size=8192)
+    num_transitions = 100_000
+    buffer.push_batch(
+        np.random.randn(num_transitions, 64), np.random.uniform(-1, 1, (num_transitions, 8)),
+        np.random.randn(num_transitions), np.random.randn(num_transitions, 64), np.zeros(num_transitions)
+    )
+
+    np.random.seed(0)
+    indices = torch.from_numpy(buffer.sample_indices())
+    expected = [field[indices].float().cuda() for field in (buffer.s_tensor, buffer.a_tensor, buffer.r_tensor,
+                                                            buffer.ns_tensor, buffer.d_tensor)]  # blocking copies
+
+    np.random.seed(0)
+    first_batch = buffer.sample()
+    first_batch = [tensor.clone() for tensor in first_batch[:5]]  # queued after the copies, on the same stream
+    buffer.sample()  # refills the same host tensors
+    torch.cuda.synchronize()
+
+    for tensor, expected_tensor in zip(first_batch, expected):
+        assert torch.equal(tensor, expected_tensor)
+
+
+def test_staging_area_reuses_its_tensors_until_a_bigger_batch_comes_in():
+
+    staging = StagingArea()
+    source = torch.arange(60, dtype=torch.float64).view(20, 3)  # float64, so the cast is folded into the copy
+
+    first = staging.gather('s', source, torch.tensor([3, 1, 4, 1]))
+    assert first.dtype == torch.float32 and torch.equal(first.cpu(), source[[3, 1, 4, 1]].float())
+
+    second = staging.gather('s', source, torch.tensor([5, 9]))  # smaller batch: a view of the same tensor
+    assert second.data_ptr() == first.data_ptr()
+    assert torch.equal(second.cpu(), source[[5, 9]].float())
+
+    third = staging.gather('s', source, torch.arange(20))  # bigger batch: a new tensor
+    assert third.data_ptr() != first.data_ptr()
+    assert torch.equal(third.cpu(), source.float())
+    assert staging.gather('s', source, torch.tensor([0])).data_ptr() == third.data_ptr()
+
+    uint8_source = torch.randint(0, 256, (20, 2, 2), dtype=torch.uint8)  # new dtype: a new tensor
+    images = staging.as_normalized_image('o', staging.gather('o', uint8_source, torch.tensor([7, 2]), torch.uint8))
+    assert torch.allclose(images.cpu(), uint8_source[[7, 2]].float() / 255)
+
+    from_numpy = staging.from_numpy('a', np.ones((4, 2)))
+    assert from_numpy.dtype == torch.float32 and torch.equal(from_numpy.cpu(), torch.ones(4, 2))
+
+
+def test_host_only_staging_area_keeps_batches_on_the_host():
+
+    staging = StagingArea(host_only=True)
+    batch = staging.gather('s', torch.randn(10, 3), torch.tensor([1, 2]))
+    assert batch.device.type == 'cpu'
+    assert not staging.copy_events
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="pinned memory and copy events are only used on cuda")
+def test_staging_area_pins_host_tensors_and_records_copy_events():
+
+    staging = StagingArea()
+    batch = staging.gather('s', torch.randn(10, 3), torch.tensor([1, 2]))
+    assert batch.is_cuda
+    assert staging.host_tensors['s'].is_pinned()
+    assert 's' in staging.copy_events
+
+    staging.host('s', (2, 3))  # waits for the copy out of the host tensor before handing it out again
+    assert 's' not in staging.copy_events
@@ -0,0 +1,60 @@
+import numpy as np
+
+from basics.sum_tree import SumTree
+
+
+def reference_find(priorities, prefix_sums):
+    """Linear scan: the first leaf whose cumulative sum exceeds the prefix sum."""
+    return np.searchsorted(np.cumsum(priorities), prefix_sums, side='right')
+
+
+def test_find_matches_a_linear_scan_after_updates():
+
+    np.random.seed(0)
+
+    capacity = 37  # not a power of 2, so there are padding leaves
+    tree = SumTree(capacity)
+    priorities = np.zeros(capacity)
+
+    for _ in range(50):
+        indices = np.random.randint(capacity, size=8)  # with duplicates; the last write wins, as for numpy
+        values = np.random.choice([0, 0.5, 1, 3.25], size=8)
+        tree.update(indices, values)
+        priorities[indices] = values
+
+        assert np.isclose(tree.total, priorities.sum())
+        np.testing.assert_array_equal(tree.get(np.arange(capacity)), priorities)
+        if tree.total > 0:
+            prefix_sums = np.random.uniform(0, tree.total, size=64)
+            np.testing.assert_array_equal(tree.find(prefix_sums), reference_find(priorities, prefix_sums))
+
+
+def test_find_never_returns_an_empty_leaf():
+
+    tree = SumTree(6)
+    tree.update(np.arange(6), [0, 1, 0, 0, 2, 0])
+
+    leaves = tree.find(np.array([0, 0.5, 1, 2.999999, np.nextafter(tree.total, 0)]))
+    np.testing.assert_array_equal(leaves, [1, 1, 4, 4, 4])
+
+
+def test_update_one_and_rebuild_agree_with_update():
+
+    np.random.seed(0)
+
+    capacity = 20
+    values = np.random.rand(capacity)
+
+    batched = SumTree(capacity)
+    batched.update(np.arange(capacity), values)
+
+    one_by_one = SumTree(capacity)
+    for index, value in enumerate(values):
+        one_by_one.update_one(index, value)
+
+    rebuilt = SumTree(capacity)
+    rebuilt.leaves[:capacity] = values
+    rebuilt.rebuild()
+
+    np.testing.assert_allclose(one_by_one.tree, batched.tree)
+    np.testing.assert_allclose(rebuilt.tree, batched.tree)
@@ -0,0 +1,23 @@
+import warnings
+
+import torch
+import torch._dynamo
+
+from basics.utils import compile_or_none
+
+
+def test_compiled_function_warns_when_it_falls_back_to_eager_mode():
+
+    def double_sin(x):
+        return torch.sin(x) * 2
+
+    compiled_double_sin = compile_or_none(double_sin)
+
+    with warnings.catch_warnings(record=True) as caught, torch._dynamo.config.patch(recompile_limit=1):
+        warnings.simplefilter('always')
+        for dtype in [torch.float32, torch.float64]:  # the second dtype would need a recompilation
+            x = torch.randn(3, dtype=dtype)
+            assert torch.allclose(compiled_double_sin(x), double_sin(x))
+
+    assert any('double_sin runs eagerly' in str(warning.message) for warning in caught)
+    assert not torch._dynamo.config.suppress_errors  # only set within calls to compiled_double_sin